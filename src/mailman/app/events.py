@@ -21,6 +21,7 @@ from mailman.app import (
     domain, membership, moderator, registrar, subscriptions)
 from mailman.core import i18n, switchboard
 from mailman.languages import manager as language_manager
+from mailman.model import listmanager, recipientcache
 from mailman.styles import manager as style_manager
 from mailman.utilities import passwords
 from zope import event
@@ -33,9 +34,13 @@ def initialize():
         domain.handle_DomainDeletingEvent,
         i18n.handle_ConfigurationUpdatedEvent,
         language_manager.handle_ConfigurationUpdatedEvent,
+        listmanager.handle_ListCreatedEvent,
+        listmanager.handle_ListDeletedEvent,
         membership.handle_SubscriptionEvent,
         moderator.handle_ListDeletingEvent,
         passwords.handle_ConfigurationUpdatedEvent,
+        recipientcache.handle_ListDeletedEvent,
+        recipientcache.handle_MembershipChangeEvent,
         registrar.handle_ConfirmationNeededEvent,
         style_manager.handle_ConfigurationUpdatedEvent,
         subscriptions.handle_ListDeletingEvent,
@@ -60,6 +60,7 @@ def inject_message(mlist, msg, recipients=None, switchboard=None, **kws):
     msgdata = dict(
         listid=mlist.list_id,
         original_size=msg.original_size,
+        priority=mlist.queue_priority,
         )
     msgdata.update(kws)
     if recipients is not None:
@@ -22,6 +22,7 @@ import logging
 
 from email.utils import formatdate, getaddresses, make_msgid
 from mailman.app.membership import delete_member
+from mailman.app.senders import SENDERS_KEY
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.email.message import UserNotification
@@ -60,8 +61,11 @@ def hold_message(mlist, msg, msgdata=None, reason=None):
     else:
         # Make a copy of msgdata so that subsequent changes won't corrupt the
         # request database.  TBD: remove the `filebase' key since this will
-        # not be relevant when the message is resurrected.
+        # not be relevant when the message is resurrected.  The resolution
+        # context of the senders only lives as long as the message is being
+        # processed.
         msgdata = msgdata.copy()
+        msgdata.pop(SENDERS_KEY, None)
     if reason is None:
         reason = ''
     # Add the message to the message store.  It is required to have a
@@ -0,0 +1,159 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Resolving the senders of a message.
+
+While a runner processes a message, the runner itself, the moderation rules,
+the hold chain and several handlers all look up the membership of the same
+senders.  The results are remembered in a resolution context, which travels
+with the message in its metadata.  Its key starts with an underscore, so the
+context is never written to the queues; every runner resolves the senders
+afresh.
+"""
+
+from mailman.interfaces.bans import IBanManager
+from mailman.interfaces.member import MemberRole
+from mailman.interfaces.usermanager import IUserManager
+from zope.component import getUtility
+
+
+# The key of the resolution context in the message metadata.
+SENDERS_KEY = '_senders'
+# Marks lookups which were not made yet.
+_missing = object()
+
+
+@public
+class SenderResolution:
+    """The remembered lookups of the senders of a message."""
+
+    def __init__(self, mlist, msg):
+        self.mlist = mlist
+        self.msg = msg
+        self._sender = None
+        self._senders = None
+        self._members = {}
+        self._users = {}
+        self._bans = {}
+        self._sender_member = _missing
+
+    @property
+    def senders(self):
+        """The senders of the message, as in `msg.senders`."""
+        if self._senders is None:
+            self._senders = self.msg.senders
+        return self._senders
+
+    @property
+    def sender(self):
+        """The sender of the message, as in `msg.sender`."""
+        if self._sender is None:
+            self._sender = self.msg.sender
+        return self._sender
+
+    def get_member(self, email, role=MemberRole.member):
+        """The member of the mailing list with the given email and role.
+
+        :param email: The email address.
+        :param role: The role of the member, either `MemberRole.member` or
+            `MemberRole.nonmember`.
+        :return: The member, or None if the email is not subscribed with the
+            role.
+        """
+        key = (role, email)
+        member = self._members.get(key, _missing)
+        if member is _missing:
+            roster = (self.mlist.members if role is MemberRole.member
+                      else self.mlist.nonmembers)
+            member = self._members[key] = roster.get_member(email)
+        return member
+
+    def get_user(self, email):
+        """The user linked to the email address, or None."""
+        user = self._users.get(email, _missing)
+        if user is _missing:
+            user = self._users[email] = getUtility(
+                IUserManager).get_user(email)
+        return user
+
+    def is_banned(self, email):
+        """Whether the email address is banned from the mailing list."""
+        banned = self._bans.get(email)
+        if banned is None:
+            banned = self._bans[email] = IBanManager(
+                self.mlist).is_banned(email)
+        return banned
+
+    @property
+    def sender_member(self):
+        """The first member found for any of the senders, or None.
+
+        A sender's email address is checked first.  If it is not a member,
+        then all the addresses of the user it is linked to are checked.
+        """
+        if self._sender_member is _missing:
+            self._sender_member = self._find_sender_member()
+        return self._sender_member
+
+    def _find_sender_member(self):
+        for sender in self.senders:
+            member = self.get_member(sender)
+            if member is not None:
+                return member
+            user = self.get_user(sender)
+            if user is not None:
+                for address in user.addresses:
+                    member = self.get_member(address.email)
+                    if member is not None:
+                        return member
+        return None
+
+    def subscribe(self, address, role):
+        """Subscribe an address of a sender to the mailing list.
+
+        The new member replaces what was remembered about the address.
+
+        :param address: The address to subscribe.
+        :type address: `IAddress`
+        :param role: The role of the subscription.
+        :return: The new member.
+        """
+        member = self.mlist.subscribe(address, role)
+        self._members[(role, address.email)] = member
+        if role is MemberRole.member:
+            self._sender_member = _missing
+        return member
+
+
+@public
+def resolve_senders(mlist, msg, msgdata):
+    """The resolution context of a message's senders.
+
+    The context is created the first time it is asked for, and kept in the
+    message metadata.
+
+    :param mlist: The mailing list.
+    :param msg: The message.
+    :param msgdata: The message metadata.
+    :return: The resolution context.
+    :rtype: `SenderResolution`
+    """
+    resolution = msgdata.get(SENDERS_KEY)
+    if (resolution is None or resolution.mlist is not mlist
+            or resolution.msg is not msg):
+        resolution = msgdata[SENDERS_KEY] = SenderResolution(mlist, msg)
+    return resolution
@@ -0,0 +1,156 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the resolution of the senders of a message."""
+
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.app.moderator import hold_message
+from mailman.app.senders import SENDERS_KEY, resolve_senders
+from mailman.config import config
+from mailman.interfaces.bans import IBanManager
+from mailman.interfaces.member import MemberRole
+from mailman.interfaces.requests import IListRequests
+from mailman.interfaces.usermanager import IUserManager
+from mailman.rules.moderation import MemberModeration, NonmemberModeration
+from mailman.testing.helpers import (
+    counted_statements, get_queue_messages,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+from zope.component import getUtility
+
+
+class TestSenders(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        self._user_manager = getUtility(IUserManager)
+        self._anne = self._user_manager.create_address('anne@example.com')
+        self._bart = self._user_manager.create_address('bart@example.com')
+        self._msg = mfs("""\
+From: anne@example.com
+Sender: bart@example.com
+To: ant@example.com
+Message-ID: <ant>
+
+A message body.
+""")
+
+    def test_reused(self):
+        msgdata = {}
+        senders = resolve_senders(self._mlist, self._msg, msgdata)
+        self.assertIs(msgdata[SENDERS_KEY], senders)
+        self.assertIs(resolve_senders(self._mlist, self._msg, msgdata),
+                      senders)
+        self.assertEqual(senders.sender, 'anne@example.com')
+        self.assertEqual(senders.senders, self._msg.senders)
+
+    def test_other_message(self):
+        # A context left behind by another message is replaced.
+        msgdata = {}
+        senders = resolve_senders(self._mlist, self._msg, msgdata)
+        msg = mfs("""\
+From: cris@example.com
+
+""")
+        other = resolve_senders(self._mlist, msg, msgdata)
+        self.assertIsNot(other, senders)
+        self.assertEqual(other.sender, 'cris@example.com')
+
+    def test_lookups_remembered(self):
+        self._mlist.subscribe(self._anne)
+        IBanManager(self._mlist).ban('bart@example.com')
+        senders = resolve_senders(self._mlist, self._msg, {})
+        member = senders.get_member('anne@example.com')
+        self.assertEqual(member.address, self._anne)
+        self.assertIsNone(
+            senders.get_member('bart@example.com', MemberRole.nonmember))
+        self.assertTrue(senders.is_banned('bart@example.com'))
+        self.assertFalse(senders.is_banned('anne@example.com'))
+        self.assertIsNone(senders.get_user('anne@example.com'))
+        self.assertEqual(senders.sender_member, member)
+        with counted_statements() as statements:
+            self.assertEqual(senders.get_member('anne@example.com'), member)
+            self.assertIsNone(
+                senders.get_member('bart@example.com', MemberRole.nonmember))
+            self.assertTrue(senders.is_banned('bart@example.com'))
+            self.assertFalse(senders.is_banned('anne@example.com'))
+            self.assertIsNone(senders.get_user('anne@example.com'))
+            self.assertEqual(senders.sender_member, member)
+        self.assertEqual(statements, [])
+
+    def test_sender_member_through_user(self):
+        # A sender's user can be subscribed with another address.
+        user = self._user_manager.create_user('bart@example.org')
+        user.link(self._bart)
+        member = self._mlist.subscribe(
+            self._user_manager.get_address('bart@example.org'))
+        senders = resolve_senders(self._mlist, self._msg, {})
+        self.assertEqual(senders.sender_member, member)
+
+    def test_subscribe(self):
+        # Subscribing through the context updates what it remembers.
+        senders = resolve_senders(self._mlist, self._msg, {})
+        self.assertIsNone(senders.sender_member)
+        self.assertIsNone(
+            senders.get_member('anne@example.com', MemberRole.nonmember))
+        nonmember = senders.subscribe(self._anne, MemberRole.nonmember)
+        self.assertEqual(
+            senders.get_member('anne@example.com', MemberRole.nonmember),
+            nonmember)
+        self.assertIsNone(senders.sender_member)
+        member = senders.subscribe(self._bart, MemberRole.member)
+        self.assertEqual(senders.get_member('bart@example.com'), member)
+        self.assertEqual(senders.sender_member, member)
+
+    def test_moderation_rules(self):
+        # Both moderation rules share the lookups, and the nonmember rule
+        # sees the nonmembers it subscribes.
+        msgdata = {}
+        self.assertFalse(
+            MemberModeration().check(self._mlist, self._msg, msgdata))
+        with counted_statements() as statements:
+            self.assertTrue(
+                NonmemberModeration().check(self._mlist, self._msg, msgdata))
+        # The senders were already checked against the bans.
+        self.assertFalse(any(
+            'FROM ban' in statement for statement in statements))
+        self.assertEqual(
+            sorted(member.address.email
+                   for member in self._mlist.nonmembers.members),
+            ['anne@example.com', 'bart@example.com'])
+        self.assertEqual(msgdata['moderation_sender'], 'anne@example.com')
+
+    def test_not_held(self):
+        # The context is not held with the message.
+        msgdata = dict(foo='yes')
+        resolve_senders(self._mlist, self._msg, msgdata)
+        request_id = hold_message(self._mlist, self._msg, msgdata)
+        key, data = IListRequests(self._mlist).get_request(request_id)
+        self.assertEqual(data['foo'], 'yes')
+        self.assertNotIn(SENDERS_KEY, data)
+        self.assertIn(SENDERS_KEY, msgdata)
+
+    def test_not_queued(self):
+        msgdata = {}
+        resolve_senders(self._mlist, self._msg, msgdata)
+        config.switchboards['pipeline'].enqueue(
+            self._msg, msgdata, listid='ant.example.com')
+        items = get_queue_messages('pipeline', expected_count=1)
+        self.assertNotIn(SENDERS_KEY, items[0].msgdata)
@@ -24,6 +24,7 @@ from email.mime.text import MIMEText
 from email.utils import formatdate, make_msgid
 from mailman.app.moderator import hold_message
 from mailman.app.replybot import can_acknowledge
+from mailman.app.senders import resolve_senders
 from mailman.chains.base import TerminalChainBase
 from mailman.config import config
 from mailman.core.i18n import _
@@ -146,7 +147,8 @@ class HoldChain(TerminalChainBase):
         # Get the language to send the response in.  If the sender is a
         # member, then send it in the member's language, otherwise send it in
         # the mailing list's preferred language.
-        member = mlist.members.get_member(msg.sender)
+        senders = resolve_senders(mlist, msg, msgdata)
+        member = senders.get_member(senders.sender)
         language = (member.preferred_language
                     if member else mlist.preferred_language)
         # A substitution dictionary for the email templates.
@@ -17,9 +17,11 @@
 
 """Getting information out of a qfile."""
 
-import pickle
+import os
 
+from mailman.config import config
 from mailman.core.i18n import _
+from mailman.core.switchboard import load_entry
 from mailman.interfaces.command import ICLISubCommand
 from mailman.utilities.interact import interact
 from pprint import PrettyPrinter
@@ -63,12 +65,19 @@ class QFile:
         """See `ICLISubCommand`."""
         printer = PrettyPrinter(indent=4)
         assert len(args.qfile) == 1, 'Wrong number of positional arguments'
-        with open(args.qfile[0], 'rb') as fp:
-            while True:
-                try:
-                    m.append(pickle.load(fp))
-                except EOFError:
+        qfile = args.qfile[0]
+        if not os.path.exists(qfile):
+            # In a sharded queue, the file lives in a subdirectory of the
+            # queue directory.
+            directory, basename = os.path.split(os.path.abspath(qfile))
+            filebase, extension = os.path.splitext(basename)
+            for switchboard in config.switchboards.values():
+                if (hasattr(switchboard, 'path') and directory ==
+                        os.path.abspath(switchboard.queue_directory)):
+                    qfile = switchboard.path(filebase, extension)
                     break
+        with open(qfile, 'rb') as fp:
+            m.extend(load_entry(fp))
         if args.doprint:
             print(_('[----- start pickle -----]'))
             for i, obj in enumerate(m):
@@ -0,0 +1,62 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the qfile subcommand."""
+
+import os
+import unittest
+
+from contextlib import redirect_stdout
+from io import StringIO
+from mailman.commands.cli_qfile import QFile, m
+from mailman.config import config
+from mailman.testing.helpers import (
+    configuration, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+class FakeArgs:
+    interactive = False
+    doprint = True
+    qfile = []
+
+
+class TestQFile(unittest.TestCase):
+    layer = ConfigLayer
+
+    @configuration('runner.shunt',
+                   switchboard='mailman.core.switchboard.ShardedSwitchboard')
+    def test_sharded_queue_file(self):
+        # The file of a sharded queue can be named as if it was directly in
+        # the queue directory.
+        shuntq = config.switchboards['shunt']
+        filebase = shuntq.enqueue(mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+"""), foo=7)
+        # The dumped objects are left in a module global.
+        self.addCleanup(m.clear)
+        args = FakeArgs()
+        args.qfile = [os.path.join(shuntq.queue_directory, filebase + '.pck')]
+        self.assertFalse(os.path.exists(args.qfile[0]))
+        output = StringIO()
+        with redirect_stdout(output):
+            QFile().process(args)
+        self.assertIn('Message-ID: <ant>', output.getvalue())
+        self.assertIn("'foo': 7", output.getvalue())
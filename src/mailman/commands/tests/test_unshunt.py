@@ -0,0 +1,57 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the unshunt subcommand."""
+
+import unittest
+
+from mailman.commands.cli_unshunt import Unshunt
+from mailman.config import config
+from mailman.core.switchboard import ShardedSwitchboard
+from mailman.testing.helpers import (
+    configuration, get_queue_messages,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+class FakeArgs:
+    discard = False
+
+
+class TestUnshunt(unittest.TestCase):
+    layer = ConfigLayer
+
+    @configuration('runner.shunt',
+                   switchboard='mailman.core.switchboard.ShardedSwitchboard')
+    def test_sharded_shunt_queue(self):
+        # Messages are moved back from a sharded shunt queue.
+        shuntq = config.switchboards['shunt']
+        self.assertIsInstance(shuntq, ShardedSwitchboard)
+        for i in range(3):
+            shuntq.enqueue(mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant{}>
+
+""".format(i)), whichq='in')
+        Unshunt().process(FakeArgs())
+        self.assertEqual(shuntq.files, [])
+        self.assertEqual(shuntq.get_files('.bak'), [])
+        items = get_queue_messages('in', sort_on='message-id',
+                                   expected_count=3)
+        self.assertEqual([item.msg['message-id'] for item in items],
+                         ['<ant0>', '<ant1>', '<ant2>'])
@@ -0,0 +1,300 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact sets of recipients stored outside of the queue entries.
+
+The recipients of a posting to a big mailing list make up most of the
+metadata of its queue entries.  Instead of being written into every entry the
+message passes through, they are stored once in a recipients file next to the
+entry.  The addresses in the file are sorted, front coded, i.e. each one only
+records what it doesn't share with the previous one, and compressed.
+
+Queue entries with the same recipients have hard links to the same file, so
+the file goes away along with the last entry using it.  An entry which only
+goes to some of the recipients in the file, e.g. the ones to retry after a
+temporary failure, records which ones as run lengths.
+"""
+
+import os
+import zlib
+import bisect
+import struct
+
+from collections.abc import Set
+from itertools import repeat
+
+
+# The recipients file starts with a magic string, the format version and the
+# number of addresses in it.
+MAGIC = b'MMRS'
+VERSION = 1
+HEADER = struct.Struct('>4sBI')
+# The length of the shared prefix is stored in a single byte.
+MAX_PREFIX = 255
+# How much of the compressed addresses to read at once.
+BLOCK_SIZE = 65536
+
+
+def _write(path, addresses):
+    """Durably write a recipients file.
+
+    :param path: The path of the file.
+    :type path: str
+    :param addresses: The addresses, sorted and without duplicates.
+    :type addresses: sequence of str
+    """
+    compressor = zlib.compressobj()
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(addresses)))
+        previous = b''
+        for address in addresses:
+            data = address.encode('utf-8', 'surrogateescape')
+            prefix = min(len(os.path.commonprefix([previous, data])),
+                         MAX_PREFIX)
+            fp.write(compressor.compress(
+                bytes((prefix,)) + data[prefix:] + b'\n'))
+            previous = data
+        fp.write(compressor.flush())
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmpfile, path)
+
+
+@public
+class RecipientSet(Set):
+    """An immutable set of recipient addresses.
+
+    Iterating over the set produces the addresses in sorted order.  Once the
+    set is stored in a recipients file, it reads the addresses from the file
+    as they are needed.
+    """
+
+    def __init__(self, addresses=()):
+        """Create a recipient set which isn't stored yet.
+
+        :param addresses: The recipient addresses.
+        :type addresses: iterable of str
+        """
+        self._addresses = sorted(set(addresses))
+        self._size = len(self._addresses)
+        self._path = None
+        self._file = None
+        # Which of the addresses in the file are in this set, as alternating
+        # numbers of excluded and included addresses.  None means all.
+        self.runs = None
+
+    @classmethod
+    def stored(cls, size, runs=None):
+        """Create a recipient set which is stored in a file.
+
+        The set must be bound to its file before it can be iterated over.
+
+        :param size: The number of addresses in the set.
+        :type size: int
+        :param runs: Which addresses of the file are in the set, as
+            alternating numbers of excluded and included addresses, or None
+            for all of them.
+        :type runs: list of int or None
+        :return: The recipient set.
+        :rtype: `RecipientSet`
+        """
+        recipients = cls()
+        recipients._addresses = None
+        recipients._size = size
+        recipients.runs = runs
+        return recipients
+
+    def bind(self, path):
+        """Read the set from its recipients file.
+
+        The file is kept open, so the set stays readable after the file is
+        removed, e.g. when the queue entry is finished.
+
+        :param path: The path of the recipients file.
+        :type path: str
+        :raises ValueError: when the file is not a recipients file.
+        """
+        fp = open(path, 'rb')
+        magic, version, count = HEADER.unpack(fp.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            fp.close()
+            raise ValueError('Not a recipients file: {}'.format(path))
+        self._path = path
+        self._file = fp
+        if self.runs is None:
+            self._size = count
+
+    def store(self, path):
+        """Store the set in a recipients file.
+
+        A set which is already stored is linked to the new path instead of
+        being written again.  A set which isn't stored yet is bound to the
+        new file, so that storing it again only makes another link.
+
+        :param path: The path of the recipients file.
+        :type path: str
+        """
+        if self._file is None:
+            if self._addresses is None:
+                raise ValueError('Unbound recipient set')
+            _write(path, self._addresses)
+            self.bind(path)
+            return
+        try:
+            os.link(self._path, path)
+        except OSError:
+            # The file we were read from is gone, but we still have it open,
+            # or it is on another file system.  Make a copy and link to that
+            # from now on.
+            self._copy(path)
+            self._path = path
+
+    def close(self):
+        """Close the recipients file of a stored set.
+
+        The subsets of the set share its file, so they can't be read
+        afterward either.
+        """
+        if self._file is not None:
+            self._file.close()
+
+    def _copy(self, path):
+        """Durably copy the open recipients file."""
+        fd = self._file.fileno()
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'wb') as fp:
+            offset = 0
+            while True:
+                block = os.pread(fd, BLOCK_SIZE, offset)
+                if not block:
+                    break
+                fp.write(block)
+                offset += len(block)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmpfile, path)
+
+    def _stored_addresses(self):
+        """Read all the addresses in the recipients file."""
+        if self._file is None:
+            raise ValueError('Unbound recipient set')
+        # Read with explicit offsets so that several iterations can be in
+        # progress at the same time.
+        fd = self._file.fileno()
+        offset = HEADER.size
+        decompressor = zlib.decompressobj()
+        previous = b''
+        pending = b''
+        while True:
+            block = os.pread(fd, BLOCK_SIZE, offset)
+            offset += len(block)
+            if block:
+                pending += decompressor.decompress(block)
+            else:
+                pending += decompressor.flush()
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                previous = previous[:line[0]] + line[1:]
+                yield previous.decode('utf-8', 'surrogateescape')
+            if not block:
+                break
+
+    def _flags(self):
+        """Whether each address of the recipients file is in the set."""
+        if self.runs is None:
+            return repeat(True)
+        return (include
+                for index, length in enumerate(self.runs)
+                for include in repeat(index % 2 == 1, length))
+
+    def __iter__(self):
+        if self._addresses is not None:
+            return iter(self._addresses)
+        return (address
+                for address, include in zip(
+                    self._stored_addresses(), self._flags())
+                if include)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, address):
+        if self._addresses is None:
+            self._addresses = list(self)
+        index = bisect.bisect_left(self._addresses, address)
+        return (index < len(self._addresses) and
+                self._addresses[index] == address)
+
+    def __repr__(self):
+        return '<RecipientSet of {} recipients>'.format(self._size)
+
+    @classmethod
+    def _from_iterable(cls, addresses):
+        # The results of set operations are ordinary sets.
+        return frozenset(addresses)
+
+    def subset(self, addresses):
+        """The addresses of this set which are also in the given ones.
+
+        A stored set's subset shares its recipients file, and only records
+        which of the addresses in the file it contains.
+
+        :param addresses: The addresses to keep.
+        :type addresses: iterable of str
+        :return: The subset.
+        :rtype: `RecipientSet`
+        """
+        wanted = set(addresses)
+        return self._select(lambda address: address in wanted)
+
+    def excluding(self, addresses):
+        """The addresses of this set which are not in the given ones.
+
+        Like `subset()`, the result shares the recipients file of a stored
+        set, which is only read once.
+
+        :param addresses: The addresses to leave out.
+        :type addresses: iterable of str
+        :return: The subset.
+        :rtype: `RecipientSet`
+        """
+        unwanted = set(addresses)
+        return self._select(lambda address: address not in unwanted)
+
+    def _select(self, keep):
+        """The subset of the addresses for which `keep` returns true."""
+        if self._file is None:
+            return RecipientSet(address for address in self if keep(address))
+        runs = []
+        size = 0
+        current = False
+        length = 0
+        for address, include in zip(self._stored_addresses(), self._flags()):
+            include = include and keep(address)
+            if include != current:
+                runs.append(length)
+                current = include
+                length = 0
+            length += 1
+            size += include
+        runs.append(length)
+        subset = RecipientSet.stored(size, runs)
+        subset._path = self._path
+        subset._file = self._file
+        return subset
@@ -25,13 +25,15 @@ import traceback
 from contextlib import suppress
 from io import StringIO
 from lazr.config import as_boolean, as_timedelta
+from mailman.app.senders import resolve_senders
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.core.logging import reopen
-from mailman.core.switchboard import Switchboard
+from mailman.core.switchboard import staged_enqueues
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.runner import IRunner, RunnerCrashEvent
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 from zope.component import getUtility
 from zope.event import notify
@@ -66,7 +68,8 @@ class Runner:
         # should not have queue_directory or switchboard instance.
         if self.is_queue_runner:
             self.queue_directory = expand(section.path, substitutions)
-            self.switchboard = Switchboard(
+            switchboard_class = find_name(section.switchboard)
+            self.switchboard = switchboard_class(
                 name, self.queue_directory, slice, numslices, True)
         else:
             self.queue_directory = None
@@ -77,6 +80,9 @@ class Runner:
                             self.sleep_time.seconds +
                             self.sleep_time.microseconds / 1.0e6)
         self.max_restarts = int(section.max_restarts)
+        self.batch_size = int(section.batch_size)
+        self.batch_time = as_timedelta(section.batch_time)
+        self.wakeup_on_enqueue = as_boolean(section.wakeup_on_enqueue)
         self.start = as_boolean(section.start)
         self._stop = False
         self.status = 0
@@ -135,68 +141,166 @@ class Runner:
         # List all the files in our queue directory.  The switchboard is
         # guaranteed to hand us the files in FIFO order.
         files = self.switchboard.files
-        for filebase in files:
-            dlog.debug('[%s] processing filebase: %s', me, filebase)
-            try:
-                # Ask the switchboard for the message and metadata objects
-                # associated with this queue file.
-                msg, msgdata = self.switchboard.dequeue(filebase)
-            except Exception as error:
-                # This used to just catch email.Errors.MessageParseError, but
-                # other problems can occur in message parsing, e.g.
-                # ValueError, and exceptions can occur in unpickling too.  We
-                # don't want the runner to die, so we just log and skip this
-                # entry, but preserve it for analysis.
-                self._log(error)
-                elog.error('Skipping and preserving unparseable message: %s',
-                           filebase)
-                self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
-                continue
+        if self.batch_size > 1:
+            self._process_batches(files)
+        else:
+            for filebase in files:
+                if not self._process_filebase(filebase):
+                    continue
+                # Other work we want to do each time through the loop.
+                dlog.debug('[%s] doing periodic', me)
+                self._do_periodic()
+                dlog.debug('[%s] committing transaction', me)
+                config.db.commit()
+                dlog.debug('[%s] checking short circuit', me)
+                if self._short_circuit():
+                    dlog.debug('[%s] short circuiting', me)
+                    break
+        dlog.debug('[%s] ending oneloop: %s', me, len(files))
+        return len(files)
+
+    def _dequeue(self, filebase):
+        """Dequeue a file, preserving it if it can't be read.
+
+        :return: The message and metadata, or None if the file was
+            unparseable.
+        """
+        try:
+            # Ask the switchboard for the message and metadata objects
+            # associated with this queue file.
+            return self.switchboard.dequeue(filebase)
+        except Exception as error:
+            # This used to just catch email.Errors.MessageParseError, but
+            # other problems can occur in message parsing, e.g. ValueError,
+            # and exceptions can occur in unpickling too.  We don't want the
+            # runner to die, so we just log and skip this entry, but preserve
+            # it for analysis.
+            self._log(error)
+            elog.error('Skipping and preserving unparseable message: %s',
+                       filebase)
+            self.switchboard.finish(filebase, preserve=True)
+            return None
+
+    def _process_filebase(self, filebase):
+        """Process and finish one queue file, shunting it on failure.
+
+        :return: False if the file could not be dequeued, otherwise True.
+        """
+        me = self.__class__.__name__
+        dlog.debug('[%s] processing filebase: %s', me, filebase)
+        dequeued = self._dequeue(filebase)
+        if dequeued is None:
+            config.db.abort()
+            return False
+        msg, msgdata = dequeued
+        try:
+            dlog.debug('[%s] processing onefile', me)
+            self._process_one_file(msg, msgdata)
+            dlog.debug('[%s] finishing filebase: %s', me, filebase)
+            self.switchboard.finish(filebase)
+        except Exception as error:
+            # All runners that implement _dispose() must guarantee that
+            # exceptions are caught and dealt with properly.  Still, there may
+            # be a bug in the infrastructure, and we do not want those to
+            # cause messages to be lost.  Any uncaught exceptions will cause
+            # the message to be stored in the shunt queue for human
+            # intervention.
+            self._log(error)
+            # Put a marker in the metadata for unshunting.
+            msgdata['whichq'] = self.switchboard.name
+            # It is possible that shunting can throw an exception, e.g. a
+            # permissions problem or a MemoryError due to a really large
+            # message.  Try to be graceful.
             try:
-                dlog.debug('[%s] processing onefile', me)
-                self._process_one_file(msg, msgdata)
-                dlog.debug('[%s] finishing filebase: %s', me, filebase)
+                shunt = config.switchboards['shunt']
+                new_filebase = shunt.enqueue(msg, msgdata)
+                elog.error('SHUNTING: %s', new_filebase)
                 self.switchboard.finish(filebase)
             except Exception as error:
-                # All runners that implement _dispose() must guarantee that
-                # exceptions are caught and dealt with properly.  Still, there
-                # may be a bug in the infrastructure, and we do not want those
-                # to cause messages to be lost.  Any uncaught exceptions will
-                # cause the message to be stored in the shunt queue for human
-                # intervention.
+                # The message wasn't successfully shunted.  Log the exception
+                # and try to preserve the original queue entry for possible
+                # analysis.
                 self._log(error)
-                # Put a marker in the metadata for unshunting.
-                msgdata['whichq'] = self.switchboard.name
-                # It is possible that shunting can throw an exception, e.g. a
-                # permissions problem or a MemoryError due to a really large
-                # message.  Try to be graceful.
-                try:
-                    shunt = config.switchboards['shunt']
-                    new_filebase = shunt.enqueue(msg, msgdata)
-                    elog.error('SHUNTING: %s', new_filebase)
-                    self.switchboard.finish(filebase)
-                except Exception as error:
-                    # The message wasn't successfully shunted.  Log the
-                    # exception and try to preserve the original queue entry
-                    # for possible analysis.
-                    self._log(error)
-                    elog.error(
-                        'SHUNTING FAILED, preserving original entry: %s',
-                        filebase)
-                    self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
-            # Other work we want to do each time through the loop.
-            dlog.debug('[%s] doing periodic', me)
-            self._do_periodic()
-            dlog.debug('[%s] committing transaction', me)
-            config.db.commit()
+                elog.error(
+                    'SHUNTING FAILED, preserving original entry: %s',
+                    filebase)
+                self.switchboard.finish(filebase, preserve=True)
+            config.db.abort()
+        return True
+
+    def _process_batches(self, files):
+        """Process the files in batches, one transaction per batch."""
+        me = self.__class__.__name__
+        # Every batch takes its files from the same iterator, so the rest of
+        # the list is never copied.
+        remaining = len(files)
+        files = iter(files)
+        while remaining > 0:
+            remaining -= self._process_batch(files)
             dlog.debug('[%s] checking short circuit', me)
             if self._short_circuit():
                 dlog.debug('[%s] short circuiting', me)
                 break
-        dlog.debug('[%s] ending oneloop: %s', me, len(files))
-        return len(files)
+
+    def _process_batch(self, files):
+        """Process the next files of an iterator in a single transaction.
+
+        Files are processed until `batch_size` of them have been processed,
+        or until `batch_time` has elapsed.  Everything they enqueue is held
+        back until the batch is committed.  If processing any of them fails,
+        the transaction is rolled back and the batch is replayed one file at
+        a time, so that the failing file is shunted exactly as it would be
+        without batching.
+
+        :param files: The file bases to process, in order.  The files of the
+            batch are consumed from it, the rest are left for the next batch.
+        :type files: iterator
+        :return: The number of files consumed from the iterator.
+        :rtype: int
+        """
+        me = self.__class__.__name__
+        deadline = time.time() + self.batch_time.total_seconds()
+        consumed = 0
+        processed = []
+        try:
+            with staged_enqueues():
+                for filebase in files:
+                    consumed += 1
+                    dlog.debug('[%s] batching filebase: %s', me, filebase)
+                    dequeued = self._dequeue(filebase)
+                    if dequeued is None:
+                        continue
+                    processed.append(filebase)
+                    msg, msgdata = dequeued
+                    self._process_one_file(msg, msgdata)
+                    dlog.debug('[%s] doing periodic', me)
+                    self._do_periodic()
+                    if (len(processed) >= self.batch_size or
+                            time.time() >= deadline or
+                            self._short_circuit()):
+                        break
+                # Commit before the staged entries are stored, so that they
+                # are dropped if the commit fails.
+                dlog.debug('[%s] committing batch of %s files',
+                           me, len(processed))
+                config.db.commit()
+        except Exception as error:
+            # Throw away everything this batch did, and replay the files one
+            # at a time to isolate the failure.
+            elog.error('Uncaught runner exception in batch: %s', error)
+            elog.error('Replaying batch of %s files: %s',
+                       len(processed), self.switchboard.name)
+            config.db.abort()
+            for filebase in processed:
+                self.switchboard.restore(filebase)
+            for filebase in processed:
+                if self._process_filebase(filebase):
+                    self._do_periodic()
+                    config.db.commit()
+            return consumed
+        for filebase in processed:
+            self.switchboard.finish(filebase)
+        return consumed
 
     def _process_one_file(self, msg, msgdata):
         """See `IRunner`."""
@@ -239,7 +343,8 @@ class Runner:
             language_manager = getUtility(ILanguageManager)
             language = language_manager[config.mailman.default_language]
         elif msg.sender:
-            member = mlist.members.get_member(msg.sender)
+            senders = resolve_senders(mlist, msg, msgdata)
+            member = senders.get_member(senders.sender)
             language = (member.preferred_language
                         if member is not None
                         else mlist.preferred_language)
@@ -278,7 +383,10 @@ class Runner:
         """See `IRunner`."""
         if filecnt or self.sleep_float <= 0:
             return
-        time.sleep(self.sleep_float)
+        if self.wakeup_on_enqueue and self.switchboard is not None:
+            self.switchboard.wait(self.sleep_float)
+        else:
+            time.sleep(self.sleep_float)
 
     def _short_circuit(self):
         """See `IRunner`."""
@@ -0,0 +1,236 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A switchboard keeping its queue entries in an embedded SQLite database.
+
+All the entries of a queue live in a single database file inside the queue
+directory.  Entries are kept in insertion (i.e. FIFO) order by an index over
+their state, so finding the entries for a runner's slice never has to list,
+parse and sort the contents of a potentially huge directory.
+
+This backend does not put every entry in the database though.  Large
+messages shared between entries and stored recipient sets are still written
+as ``.msg`` and ``.rcp`` sidecar files next to the database, exactly as the
+default switchboard writes them, because they are linked between queues
+and read in place rather than copied with each entry.  Such entries still
+create files in the queue directory, but the directory is never listed to
+find them.
+"""
+
+import os
+import sqlite3
+import logging
+import threading
+
+from io import BytesIO
+from mailman.core.switchboard import (
+    BaseSwitchboard, MAX_BAK_COUNT, filebase_bucket, slice_buckets)
+
+
+# The name of the database file inside the queue directory.
+DATABASE = 'queue.db'
+# The states of an entry, which correspond to the .pck and .bak files of the
+# default switchboard.
+QUEUED = 0
+BACKUP = 1
+STATES = {
+    '.pck': QUEUED,
+    '.bak': BACKUP,
+    }
+# How long to wait for another process to release the database, in seconds.
+TIMEOUT = 30
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS entry (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filebase TEXT NOT NULL UNIQUE,
+    hash INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    data BLOB NOT NULL
+    );
+CREATE INDEX IF NOT EXISTS ix_entry_state ON entry (state);
+CREATE INDEX IF NOT EXISTS ix_entry_slice
+    ON entry (state, hash, id, filebase);
+"""
+
+# The entries of a runner's slice, in FIFO order.  The slice index covers
+# this query, so only the slice's own entries are read, never the table.
+SELECT_SLICE = """\
+SELECT filebase FROM entry
+WHERE state = ? AND hash BETWEEN ? AND ?
+ORDER BY id"""
+
+elog = logging.getLogger('mailman.error')
+
+
+@public
+class SQLiteSwitchboard(BaseSwitchboard):
+    """A switchboard storing all its queue entries in one SQLite file."""
+
+    def __init__(self, name, queue_directory,
+                 slice=None, numslices=1, recover=False):
+        """See `BaseSwitchboard`."""
+        self.database = os.path.join(queue_directory, DATABASE)
+        # Every thread has its own connection.
+        self._local = threading.local()
+        # Slices are ranges of the slicing buckets stored with each entry.
+        self._buckets = None
+        if slice is not None and numslices != 1:
+            self._buckets = slice_buckets(slice, numslices)
+        super().__init__(name, queue_directory, slice, numslices, recover)
+
+    @property
+    def _db(self):
+        # SQLite connections must not be shared across a fork(), and the
+        # master creates the global switchboards before starting the runner
+        # subprocesses.  Open the connection lazily in every process, and in
+        # every thread, e.g. of the LMTP server.
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            connection = sqlite3.connect(
+                self.database, timeout=TIMEOUT, isolation_level=None)
+            # Write-ahead logging lets the runner read its slice while other
+            # processes are enqueuing.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            local.connection = connection
+            local.pid = pid
+        return local.connection
+
+    def _store(self, filebase, entry):
+        """See `BaseSwitchboard`."""
+        db = self._db
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute("""
+                INSERT INTO entry (filebase, hash, state, data)
+                VALUES (?, ?, ?, ?)""", (
+                    filebase, filebase_bucket(filebase), QUEUED, entry))
+
+    def _checkout(self, filebase):
+        """See `BaseSwitchboard`."""
+        db = self._db
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(
+                'SELECT id, data FROM entry WHERE filebase = ? AND state = ?',
+                (filebase, QUEUED)).fetchone()
+            if row is None:
+                raise FileNotFoundError(filebase)
+            entry_id, entry = row
+            db.execute('UPDATE entry SET state = ? WHERE id = ?',
+                       (BACKUP, entry_id))
+        return BytesIO(entry)
+
+    def restore(self, filebase):
+        """See `ISwitchboard`."""
+        db = self._db
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'UPDATE entry SET state = ? WHERE filebase = ? AND state = ?',
+                (QUEUED, filebase, BACKUP))
+
+    def finish(self, filebase, preserve=False):
+        """See `ISwitchboard`."""
+        db = self._db
+        try:
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                if preserve:
+                    row = db.execute("""
+                        SELECT data FROM entry
+                        WHERE filebase = ? AND state = ?""", (
+                            filebase, BACKUP)).fetchone()
+                    if row is not None:
+                        self._preserve(filebase, row[0])
+                db.execute(
+                    'DELETE FROM entry WHERE filebase = ? AND state = ?',
+                    (filebase, BACKUP))
+        except (EnvironmentError, sqlite3.Error):
+            elog.exception(
+                'Failed to delete/preserve backup entry: %s', filebase)
+        self._finish_sidecars(filebase, preserve)
+
+    def _list(self, extension):
+        """See `BaseSwitchboard`."""
+        state = STATES.get(extension)
+        if state is None:
+            return []
+        if self._buckets is None:
+            cursor = self._db.execute(
+                'SELECT filebase FROM entry WHERE state = ? ORDER BY id',
+                (state,))
+        else:
+            cursor = self._db.execute(
+                SELECT_SLICE, (state,) + self._buckets)
+        return [filebase for (filebase,) in cursor]
+
+    def count(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        state = STATES.get(extension)
+        if state is None:
+            return 0
+        if self._buckets is None:
+            cursor = self._db.execute(
+                'SELECT COUNT(*) FROM entry WHERE state = ?', (state,))
+        else:
+            cursor = self._db.execute("""
+                SELECT COUNT(*) FROM entry
+                WHERE state = ? AND hash BETWEEN ? AND ?""", (
+                    (state,) + self._buckets))
+        return cursor.fetchone()[0]
+
+    def recover_backup_files(self):
+        """See `ISwitchboard`."""
+        # Move all backup entries in our slice back to the queued state,
+        # counting the number of times each entry has been recovered.  When
+        # the count reaches MAX_BAK_COUNT, the entry is preserved in the bad
+        # queue instead.
+        db = self._db
+        for filebase in self._list('.bak'):
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                row = db.execute(
+                    'SELECT id, data FROM entry '
+                    'WHERE filebase = ? AND state = ?',
+                    (filebase, BACKUP)).fetchone()
+                if row is None:
+                    # Another process got to it first.
+                    continue
+                entry_id, entry = row
+                fp = BytesIO(entry)
+                try:
+                    bak_count = self._bump_bak_count(fp)
+                except Exception as error:
+                    # If unpickling throws any exception, just log and
+                    # preserve this entry.
+                    elog.error('Unpickling .bak exception: %s\n'
+                               'Preserving entry: %s', error, filebase)
+                    preserve = True
+                else:
+                    preserve = (bak_count >= MAX_BAK_COUNT)
+                    if preserve:
+                        elog.error('.bak entry max count, preserving: %s',
+                                   filebase)
+                    db.execute(
+                        'UPDATE entry SET state = ?, data = ? WHERE id = ?',
+                        (BACKUP if preserve else QUEUED, fp.getvalue(),
+                         entry_id))
+            if preserve:
+                self.finish(filebase, preserve=True)
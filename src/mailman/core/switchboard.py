@@ -15,34 +15,74 @@
 # You should have received a copy of the GNU General Public License along with
 # GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Queuing and dequeuing message/metadata pickle files.
+"""Queuing and dequeuing message/metadata queue files.
 
 Messages are represented as email.message.Message objects (or an instance ofa
 subclass).  Metadata is represented as a Python dictionary.  For every
-message/metadata pair in a queue, a single file containing two pickles is
-written.  First, the message is written to the pickle, then the metadata
-dictionary is written.
+message/metadata pair in a queue, a single entry is written.  It starts with
+a small binary header, followed by the metadata dictionary encoded as JSON,
+followed by the message as raw RFC 5322 bytes.  Entries written by older
+versions of Mailman, consisting of a message pickle followed by a metadata
+pickle, can still be read.
+
+Big messages and big sets of recipients are kept in files of their own next
+to the entry.  The entries of the same message, e.g. for each mailing list
+it was posted to, share these files through hard links, so they are written
+only once and go away along with the last entry using them.
+
+Where the entries are stored is up to the switchboard class configured for
+the queue.  By default, each entry is written to its own file in the queue
+directory.
 """
 
 import os
+import json
 import time
+import uuid
 import email
-import pickle
+import errno
+import heapq
+import base64
 import hashlib
+import pickle
+import select
+import struct
 import logging
+import binascii
+import threading
 
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.generator import BytesGenerator
+from functools import partial
+from io import BytesIO
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
-from mailman.email.message import Message
+from mailman.core.recipients import RecipientSet
+from mailman.email.message import LazyMessage, Message, UserNotification
 from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 from mailman.interfaces.switchboard import ISwitchboard
 from mailman.utilities.filesystem import makedirs
+from mailman.utilities.modules import find_name
 from mailman.utilities.string import expand
 from zope.interface import implementer
 
 
-# 20 bytes of all bits set, maximum hashlib.sha.digest() value.  We do it this
-# way for Python 2/3 compatibility.
-shamax = int('0xffffffffffffffffffffffffffffffffffffffff', 16)
+# Queue files are split between the parallel runners of a queue by the leading
+# hex digits of the unique id in their file base.  Each runner handles a
+# contiguous range of these buckets, so a queue can have any number of
+# runners up to the number of buckets.
+SLICE_DIGITS = 4
+SLICE_BUCKETS = 16 ** SLICE_DIGITS
+# Queue entries have a priority in this range, and the higher ones are
+# processed first.  The priority is the last part of the file base.
+MIN_PRIORITY = 0
+MAX_PRIORITY = 9
+# The file base also ends with this many hex digits of a hash of the entry's
+# list id, so that fair queuing can tell the lists apart without reading the
+# entries.
+LIST_KEY_DIGITS = 8
 # Small increment to add to time in case two entries have the same time.  This
 # prevents skipping one of two entries with the same time until the next pass.
 DELTA = .0001
@@ -50,14 +90,438 @@ DELTA = .0001
 # In order to prevent loops and a message flood, when the count reaches this
 # value, we move the file to the bad queue as a .psv.
 MAX_BAK_COUNT = 3
+# Idle runners wait for new entries in their slice on a named pipe in the
+# queue directory, and enqueuing processes write a byte to it.  The slice
+# number is appended to this file name.
+WAKEUP_FIFO = '.wakeup-'
+# The number of leading digest digits naming the subdirectory of a queue file
+# in a sharded queue.
+SHARD_DIGITS = 2
+# Queue entries start with this header: a magic string which can never start
+# a legacy pickle entry, the entry format version, the kind of message
+# serialization, and the length of the metadata section.
+ENTRY_HEADER = struct.Struct('>4sBBI')
+ENTRY_MAGIC = b'MMQ\0'
+ENTRY_VERSION = 1
+# The message is stored as raw RFC 5322 bytes, as unparsed text (with
+# `_plaintext`), or as a pickle when it cannot be flattened to bytes.
+MESSAGE_BYTES = 0
+MESSAGE_TEXT = 1
+MESSAGE_PICKLE = 2
+# This bit is set in the message serialization kind when the message is
+# stored in a message file next to the entry instead of in the entry itself.
+MESSAGE_SHARED = 0x80
+# The attributes every message object has.  Any others, e.g. the recipients
+# of a UserNotification, are stored along with the metadata.
+MESSAGE_ATTRIBUTES = frozenset(Message().__dict__)
+# Sets of at least this many recipients are stored in a recipients file next
+# to the queue entry, with this extension, instead of in its metadata.
+MIN_STORED_RECIPIENTS = 100
+RECIPIENTS_EXTENSION = '.rcp'
+# Serialized messages of at least this many bytes are stored in a message
+# file next to the queue entry, with this extension, instead of in the entry.
+MIN_SHARED_MESSAGE = 65536
+MESSAGE_EXTENSION = '.msg'
+# The number of recently stored message files which new queue entries with
+# the same message link to.
+SHARED_CACHE_SIZE = 16
 
 elog = logging.getLogger('mailman.error')
 
+# While a runner processes a batch of queue files in a single transaction,
+# new entries are held back here until the batch commits, so that a failed
+# batch can be rolled back and replayed without enqueuing anything twice.
+# Only the runner's own thread stages its entries; other threads, e.g. of
+# the LMTP server or of concurrent deliveries, keep enqueuing directly.
+_staging = threading.local()
+
+# The paths of recently stored message files, by the size and digest of the
+# serialized message.  Several threads, e.g. of the LMTP server, can be
+# enqueuing at the same time.
+_shared = OrderedDict()
+_shared_lock = threading.Lock()
+
+# The last big set of recipients stored by each thread, along with a copy of
+# the addresses it was made from.
+_last_recipients = threading.local()
+
+
+def _recipient_set(addresses):
+    """The recipient set to store for a collection of addresses.
+
+    When the same addresses are enqueued again, e.g. the same metadata to
+    several queues, the set made the last time is reused, so that its file
+    is only linked to.  The caller's addresses are never replaced.
+
+    :param addresses: The recipient addresses.
+    :type addresses: collection of str
+    :return: The recipient set.
+    :rtype: `RecipientSet`
+    """
+    last = getattr(_last_recipients, 'value', None)
+    copy = frozenset(addresses)
+    if last is not None:
+        original, addresses_copy, recipients = last
+        # The addresses may have been changed in the meantime.
+        if original is addresses and addresses_copy == copy:
+            return recipients
+    recipients = RecipientSet(copy)
+    _last_recipients.value = (addresses, copy, recipients)
+    return recipients
+
+
+@public
+def filebase_bucket(filebase):
+    """The slicing bucket of a queue file."""
+    when, digest = filebase.split('+', 1)
+    return int(digest[:SLICE_DIGITS], 16)
+
+
+@public
+def slice_buckets(slice, numslices):
+    """The first and last slicing bucket of a slice.
+
+    Bucket `b` belongs to slice `(b * numslices) // SLICE_BUCKETS`.
+    """
+    first = -(-slice * SLICE_BUCKETS // numslices)
+    last = -(-(slice + 1) * SLICE_BUCKETS // numslices) - 1
+    return first, last
+
+
+@public
+def filebase_when(filebase):
+    """The time a queue file was enqueued, or is due if it was deferred."""
+    return float(filebase.split('+', 1)[0])
+
+
+@public
+def filebase_priority(filebase):
+    """The priority of a queue file."""
+    parts = filebase.split('+')
+    if len(parts) < 3:
+        # The entry was queued before entries had priorities.
+        return int(config.priorities.default)
+    return int(parts[2])
+
+
+@public
+def filebase_list_key(filebase):
+    """The key of a queue file's mailing list, or None for older entries."""
+    parts = filebase.split('+')
+    if len(parts) < 4:
+        return None
+    return parts[3]
+
+
+@public
+def list_key(listid):
+    """The key of a mailing list in the file bases of its queue entries.
+
+    :param listid: The list id, or None for entries without one.
+    :type listid: str or None
+    :return: The list key.
+    :rtype: str
+    """
+    # List ids can contain characters which don't belong in file names.
+    digest = hashlib.sha1((listid or '').encode('utf-8')).hexdigest()
+    return digest[:LIST_KEY_DIGITS]
+
+
+def _encode(value):
+    """Turn metadata values into something JSON can represent exactly.
+
+    Values without a JSON equivalent are tagged with their type in a one item
+    dictionary.  Anything we don't know about is pickled.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        if (not all(isinstance(key, str) for key in value) or
+                (len(value) == 1 and next(iter(value)) in DECODERS)):
+            # Don't let the dictionary be confused with a tagged value.
+            return {'__dict__': [[_encode(key), _encode(item)]
+                                 for key, item in value.items()]}
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, RecipientSet):
+        # The addresses themselves are stored next to the entry.
+        return {'__recipients__': [len(value), value.runs]}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode(item) for item in value]}
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': [_encode(item) for item in value]}
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return {'__datetime__': [
+            value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond]}
+    if isinstance(value, timedelta):
+        return {'__timedelta__': [
+            value.days, value.seconds, value.microseconds]}
+    if isinstance(value, uuid.UUID):
+        return {'__uuid__': value.hex}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    return {'__pickle__': base64.b64encode(
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).decode('ascii')}
+
+
+DECODERS = {
+    '__dict__': lambda items: {
+        _decode(key): _decode(item) for key, item in items},
+    '__tuple__': lambda items: tuple(_decode(item) for item in items),
+    '__set__': lambda items: set(_decode(item) for item in items),
+    '__datetime__': lambda fields: datetime(*fields),
+    '__timedelta__': lambda fields: timedelta(*fields),
+    '__uuid__': lambda hex: uuid.UUID(hex=hex),
+    '__bytes__': lambda encoded: base64.b64decode(encoded),
+    '__pickle__': lambda encoded: pickle.loads(base64.b64decode(encoded)),
+    '__recipients__': lambda fields: RecipientSet.stored(*fields),
+    }
+
+
+def _decode(value):
+    """Reverse `_encode()`."""
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        if len(value) == 1:
+            (tag, item), = value.items()
+            if tag in DECODERS:
+                return DECODERS[tag](item)
+        return {key: _decode(item) for key, item in value.items()}
+    return value
+
+
+def _is_raw_header(value):
+    """Can the header value be written out unchanged?"""
+    if not isinstance(value, str):
+        return False
+    try:
+        # Parsed 8-bit headers contain surrogates, which go out unchanged.
+        value.encode('ascii', 'surrogateescape')
+    except UnicodeError:
+        return False
+    return True
+
+
+def _dump_headers(msg):
+    """Serialize the headers of a message the way `BytesGenerator` does.
+
+    :param msg: The message.
+    :return: The headers, including the empty line which ends them.
+    :rtype: bytes
+    """
+    # Don't fold anything, so that the headers parse back to the same values.
+    policy = msg.policy.clone(max_line_length=0)
+    lines = []
+    unixfrom = msg.get_unixfrom()
+    if unixfrom is not None:
+        lines.append(unixfrom.encode('ascii', 'surrogateescape') + b'\n')
+    for name, value in msg.raw_items():
+        lines.append(policy.fold_binary(name, value))
+    lines.append(b'\n')
+    return b''.join(lines)
+
+
+def _dump_message(msg, kind=None):
+    """Serialize a message for a queue entry.
+
+    :param msg: The message, or its text when `kind` is `MESSAGE_TEXT`.
+    :param kind: The message serialization, or None to store the message
+        as bytes if possible.
+    :return: The message serialization kind, the serialized message, and the
+        attributes of the message object which are not part of its bytes.
+    :rtype: 3-tuple of (int, bytes, dict)
+    """
+    if kind == MESSAGE_TEXT:
+        return kind, str(msg).encode('utf-8', 'surrogateescape'), {}
+    attributes = {key: value for key, value in msg.__dict__.items()
+                  if key not in MESSAGE_ATTRIBUTES}
+    lazy_data = attributes.pop('_lazy_data', None)
+    attributes.pop('_lazy_body', None)
+    if lazy_data is not None and '_headers' not in msg.__dict__:
+        # The message was dequeued and never looked at.
+        return MESSAGE_BYTES, lazy_data, attributes
+    if lazy_data is not None and all(
+            _is_raw_header(value) for value in msg.values()):
+        # Only the headers were looked at, so the body is still the bytes it
+        # was received as.  Don't generate it again.
+        body = msg.lazy_body()
+        if body is not None:
+            return MESSAGE_BYTES, _dump_headers(msg) + body, attributes
+    # Header instances, e.g. in the messages we craft ourselves, and header
+    # values containing non-ASCII text would come back as RFC 2047 encoded
+    # strings.  Keep those messages as they are.
+    if all(_is_raw_header(value)
+           for part in msg.walk() for value in part.values()):
+        try:
+            fp = BytesIO()
+            # Don't fold or mangle anything, so that the message parses back
+            # to the same headers and body.
+            BytesGenerator(fp, mangle_from_=False, maxheaderlen=0).flatten(
+                msg, unixfrom=(msg.get_unixfrom() is not None))
+        except UnicodeError:
+            # Messages containing non-ASCII text which was never encoded
+            # can't be flattened to bytes either.
+            pass
+        else:
+            return MESSAGE_BYTES, fp.getvalue(), attributes
+    return MESSAGE_PICKLE, pickle.dumps(msg, pickle.HIGHEST_PROTOCOL), {}
+
+
+def _dump_entry(kind, msgsave, attributes, data):
+    """Put a serialized message and its metadata together.
+
+    :param kind: The message serialization kind.
+    :type kind: int
+    :param msgsave: The serialized message.
+    :type msgsave: bytes
+    :param attributes: The additional attributes of the message object.
+    :type attributes: dict
+    :param data: The metadata.
+    :type data: dict
+    :return: The queue entry.
+    :rtype: bytes
+    """
+    metadata = json.dumps(
+        [_encode(data), _encode(attributes)],
+        separators=(',', ':')).encode('utf-8')
+    header = ENTRY_HEADER.pack(
+        ENTRY_MAGIC, ENTRY_VERSION, kind, len(metadata))
+    return header + metadata + msgsave
+
+
+def _load_entry(fp):
+    """Deserialize a queue entry.
+
+    :param fp: The queue entry.
+    :type fp: binary file-like object
+    :return: The message serialization kind, the serialized message, the
+        additional attributes of the message object, and the metadata.  The
+        kind is None for legacy pickle entries, whose message is returned
+        unpickled.
+    """
+    header = fp.read(ENTRY_HEADER.size)
+    if not header.startswith(ENTRY_MAGIC):
+        # This entry was written by an older version of Mailman.
+        fp.seek(0)
+        msg = pickle.load(fp)
+        data = pickle.load(fp)
+        return None, msg, {}, data
+    magic, version, kind, size = ENTRY_HEADER.unpack(header)
+    if version != ENTRY_VERSION:
+        raise ValueError('Unknown queue entry version: {}'.format(version))
+    data, attributes = json.loads(fp.read(size).decode('utf-8'))
+    return kind, fp.read(), _decode(attributes), _decode(data)
+
+
+def _store_shared(msgsave, path):
+    """Store a serialized message in a message file.
+
+    If the same message was stored recently, the new message file is a link
+    to the existing one.
+
+    :param msgsave: The serialized message.
+    :type msgsave: bytes
+    :param path: The path of the message file.
+    :type path: str
+    """
+    key = (len(msgsave), hashlib.sha1(msgsave).digest())
+    with _shared_lock:
+        source = _shared.get(key)
+    if source is not None:
+        try:
+            os.link(source, path)
+        except OSError:
+            # The file is gone, or on another file system.
+            pass
+        else:
+            return
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as fp:
+        fp.write(msgsave)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmpfile, path)
+    with _shared_lock:
+        _shared[key] = path
+        _shared.move_to_end(key)
+        if len(_shared) > SHARED_CACHE_SIZE:
+            _shared.popitem(last=False)
+
+
+@public
+def load_entry(fp, message_path=None):
+    """Read the message and metadata from a queue entry.
+
+    :param fp: The queue entry.
+    :type fp: binary file-like object
+    :param message_path: The path of the entry's message file, if it has
+        one.  By default it is next to the file `fp` was opened from.
+    :type message_path: str
+    :return: The message and the metadata dictionary.
+    :rtype: 2-tuple of (Message, dict)
+    """
+    kind, msg, attributes, data = _load_entry(fp)
+    if kind is not None and kind & MESSAGE_SHARED:
+        if message_path is None:
+            message_path = (
+                os.path.splitext(fp.name)[0] + MESSAGE_EXTENSION)
+        with open(message_path, 'rb') as message_fp:
+            msg = message_fp.read()
+        kind &= ~MESSAGE_SHARED
+    if kind == MESSAGE_BYTES:
+        msg = LazyMessage(msg)
+        msg.__dict__.update(attributes)
+    elif kind == MESSAGE_PICKLE:
+        msg = pickle.loads(msg)
+    elif kind == MESSAGE_TEXT or data.get('_parsemsg'):
+        if kind == MESSAGE_TEXT:
+            msg = msg.decode('utf-8', 'surrogateescape')
+        # Calculate the original size of the text now so that we won't
+        # have to generate the message later when we do size restriction
+        # checking.
+        original_size = len(msg)
+        msg = email.message_from_string(msg, Message)
+        msg.original_size = original_size
+        data['original_size'] = original_size
+    # Legacy entries also recorded whether the message had to be parsed.
+    data.pop('_parsemsg', None)
+    return msg, data
+
+
+@public
+@contextmanager
+def staged_enqueues():
+    """Hold back all enqueued entries until the block exits cleanly.
+
+    Entries enqueued to any switchboard by this thread are only stored when
+    the block exits without an exception.  When it raises, they are dropped.
+    The file bases returned by `ISwitchboard.enqueue()` are valid either way.
+    Entries enqueued by other threads are stored at once.
+    """
+    assert getattr(_staging, 'entries', None) is None, (
+        'Enqueues are already staged')
+    _staging.entries = []
+    try:
+        yield
+        staged = _staging.entries
+    finally:
+        _staging.entries = None
+    for switchboard, filebase, entry, sidecars in staged:
+        switchboard._commit(filebase, entry, sidecars)
+
 
 @public
 @implementer(ISwitchboard)
-class Switchboard:
-    """See `ISwitchboard`."""
+class BaseSwitchboard:
+    """Common queue entry handling for all switchboard storage backends.
+
+    Subclasses decide where the serialized queue entries live.  They must
+    implement `_store()`, `_checkout()`, `_list()`, `restore()`, `finish()`
+    and `recover_backup_files()`.
+    """
 
     def __init__(self, name, queue_directory,
                  slice=None, numslices=1, recover=False):
@@ -71,25 +535,34 @@ class Switchboard:
             None, it must be [0..`numslices`).
         :type slice: int or None
         :param numslices: The total number of slices to split this queue
-            directory into.  It must be a power of 2.
+            directory into.  When `slice` is None,
+            this switchboard handles all the slices, but it still needs to
+            know their number to wake up the runner of the right slice.
         :type numslices: int
         :param recover: True if backup files should be recovered.
         :type recover: bool
         """
-        assert (numslices & (numslices - 1)) == 0, (
-            'Not a power of 2: {}'.format(numslices))
+        assert 0 < numslices <= SLICE_BUCKETS, (
+            'Bad number of slices: {}'.format(numslices))
         self.name = name
         self.queue_directory = queue_directory
+        # The recipient sets of the dequeued entries, by file base.
+        self._bound = {}
         # If configured to, create the directory if it doesn't yet exist.
         if config.create_paths:
             makedirs(self.queue_directory, 0o770)
         # Fast track for no slices
+        self._slice = (0 if slice is None or numslices == 1 else slice)
+        self._numslices = numslices
         self._lower = None
         self._upper = None
-        # BAW: test performance and end-cases of this algorithm
-        if numslices != 1:
-            self._lower = ((shamax + 1) * slice) / numslices
-            self._upper = (((shamax + 1) * (slice + 1)) / numslices) - 1
+        self._wakeup_fds = None
+        if slice is not None and numslices != 1:
+            # Fixed width hex digits compare just like the numbers they
+            # represent, so there's no need to convert every file name.
+            first, last = slice_buckets(slice, numslices)
+            self._lower = '{:0{}x}'.format(first, SLICE_DIGITS)
+            self._upper = '{:0{}x}'.format(last, SLICE_DIGITS)
         if recover:
             self.recover_backup_files()
 
@@ -97,30 +570,62 @@ class Switchboard:
         """See `ISwitchboard`."""
         if _metadata is None:
             _metadata = {}
-        # Calculate the SHA hexdigest of the message to get a unique base
-        # filename.  We're also going to use the digest as a hash into the set
-        # of parallel runner processes.
         data = _metadata.copy()
         data.update(_kws)
-        list_id = data.get('listid', '--nolist--')
-        # Get some data for the input to the sha hash.
-        now = repr(time.time())
-        if data.get('_plaintext'):
-            protocol = 0
-            msgsave = pickle.dumps(str(_msg), protocol)
+        # Digests and notifications have their own priority, everything else
+        # has the default one unless the metadata says otherwise.
+        default = int(config.priorities.default)
+        if data.get('isdigest'):
+            implied = int(config.priorities.digest)
+        elif isinstance(_msg, UserNotification):
+            implied = int(config.priorities.notification)
         else:
-            protocol = pickle.HIGHEST_PROTOCOL
-            msgsave = pickle.dumps(_msg, protocol)
-        # The list-id field is a string but the input to the hash function must
-        # be bytes.
-        hashfood = msgsave + list_id.encode('utf-8') + now.encode('utf-8')
-        # Encode the current time into the file name for FIFO sorting.  The
-        # file name consists of two parts separated by a '+': the received
-        # time for this message (i.e. when it first showed up on this system)
-        # and the sha hex digest.
-        filebase = now + '+' + hashlib.sha1(hashfood).hexdigest()
-        filename = os.path.join(self.queue_directory, filebase + '.pck')
-        tmpfile = filename + '.tmp'
+            implied = default
+        priority = data.get('priority')
+        if priority is None:
+            priority = implied
+        if not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+            raise ValueError('Invalid queue priority: {}'.format(priority))
+        # Keep the priority in the metadata, so that the entry keeps it when
+        # it moves on to the next queue.  Notifications don't come out of the
+        # queue as UserNotification instances.
+        if priority == implied == default:
+            data.pop('priority', None)
+        else:
+            data['priority'] = priority
+        # Entries which are to be delivered later are deferred until then.
+        # The metadata holds the delivery time in Mailman's clock, the file
+        # name in the system's.
+        when = time.time()
+        deliver_after = data.get('deliver_after')
+        if deliver_after is not None:
+            # Avoid circular imports.
+            from mailman.utilities.datetime import now
+            when += max((deliver_after - now()).total_seconds(), 0)
+        # Encode the time into the file name for FIFO sorting.  The file name
+        # consists of four parts separated by a '+': the received time for
+        # this message (i.e. when it first showed up on this system) or the
+        # time it is due, a random unique id, which has the width of a SHA1
+        # hex digest, the priority, and the key of the mailing list.  We're
+        # also going to use the id as a hash into the set of parallel runner
+        # processes.
+        filebase = '{}+{}+{}+{}'.format(
+            repr(when),
+            binascii.hexlify(os.urandom(20)).decode('ascii'),
+            priority,
+            list_key(data.get('listid')))
+        # Big sets of recipients are stored once, next to the entry, instead
+        # of in its metadata.
+        recipients = data.get('recipients')
+        if (recipients is not None and
+                not isinstance(recipients, RecipientSet) and
+                len(recipients) >= MIN_STORED_RECIPIENTS):
+            recipients = data['recipients'] = _recipient_set(recipients)
+        # The files stored next to the entry, and how to store them.
+        sidecars = []
+        if isinstance(recipients, RecipientSet):
+            sidecars.append((RECIPIENTS_EXTENSION, recipients.store))
+        kind = (MESSAGE_TEXT if data.get('_plaintext') else None)
         # Always add the metadata schema version number
         data['version'] = config.QFILE_SCHEMA_VERSION
         # Filter out volatile entries.  Use .keys() so that we can mutate the
@@ -128,44 +633,357 @@ class Switchboard:
         for k in list(data):
             if k.startswith('_'):
                 del data[k]
-        # We have to tell the dequeue() method whether to parse the message
-        # object or not.
-        data['_parsemsg'] = (protocol == 0)
+        kind, msgsave, attributes = _dump_message(_msg, kind)
+        if len(msgsave) >= MIN_SHARED_MESSAGE:
+            # Big messages are often enqueued several times, e.g. once for
+            # each mailing list they were posted to.  Write them only once.
+            sidecars.append((MESSAGE_EXTENSION, partial(
+                _store_shared, msgsave)))
+            kind |= MESSAGE_SHARED
+            msgsave = b''
+        entry = _dump_entry(kind, msgsave, attributes, data)
+        staged = getattr(_staging, 'entries', None)
+        if staged is None:
+            self._commit(filebase, entry, sidecars)
+        else:
+            staged.append((self, filebase, entry, sidecars))
+        return filebase
+
+    def dequeue(self, filebase):
+        """See `ISwitchboard`."""
+        # Read the message object and metadata.  The backend moves the entry
+        # to its backup state before handing it to us, so that if this
+        # process crashes uncleanly the entry can be re-instated in order to
+        # try again.
+        with self._checkout(filebase) as fp:
+            msg, data = load_entry(
+                fp, self._sidecar_path(filebase, MESSAGE_EXTENSION))
+        recipients = data.get('recipients')
+        if isinstance(recipients, RecipientSet):
+            recipients.bind(
+                self._sidecar_path(filebase, RECIPIENTS_EXTENSION))
+            # Close the file when the entry is finished.
+            self._bound[filebase] = recipients
+        return msg, data
+
+    @property
+    def files(self):
+        """See `ISwitchboard`."""
+        return self.get_files()
+
+    def get_files(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        cutoff = time.time()
+        return self._prioritize([
+            filebase for filebase in self._list(extension)
+            if filebase_when(filebase) <= cutoff])
+
+    def get_deferred(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        cutoff = time.time()
+        return sorted(
+            (filebase for filebase in self._list(extension)
+             if filebase_when(filebase) > cutoff),
+            key=filebase_when)
+
+    def get_depths(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        return dict(Counter(
+            filebase_priority(filebase)
+            for filebase in self.get_files(extension)))
+
+    def count(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        return len(self._list(extension))
+
+    def _prioritize(self, filebases):
+        """Put the file bases of the queue entries into processing order.
+
+        Entries with a higher priority come first.  Entries with the same
+        priority, and the entries which have been waiting for longer than
+        the configured maximum, come in the order they are given in, which
+        is expected to be FIFO order.  With fair queuing, entries with the
+        same priority take turns by mailing list instead, each list's
+        entries in the order they are given in.
+
+        :param filebases: The file bases in FIFO order.
+        :type filebases: list of str
+        :return: The file bases in processing order.
+        :rtype: list of str
+        """
+        if len(filebases) < 2:
+            return filebases
+        max_wait = as_timedelta(config.priorities.max_wait).total_seconds()
+        # Anything queued before this time is overdue.
+        overdue = (time.time() - max_wait if max_wait > 0 else None)
+        # Switchboards without a runner, e.g. in the tests, are plain FIFO.
+        section = getattr(config, 'runner.' + self.name, None)
+        fair = (section is not None and as_boolean(section.fair_queuing))
+        # With fair queuing, the n-th entry of each list within a priority
+        # goes out in the n-th round.
+        turns = Counter()
+        ranked = []
+        for position, filebase in enumerate(filebases):
+            when = filebase_when(filebase)
+            turn = 0
+            if overdue is not None and when < overdue:
+                # Don't let a steady stream of higher priority entries starve
+                # this one any longer.
+                rank = MAX_PRIORITY + 1
+            else:
+                rank = filebase_priority(filebase)
+                if fair:
+                    key = (rank, filebase_list_key(filebase))
+                    turn = turns[key]
+                    turns[key] += 1
+            ranked.append((-rank, turn, position, filebase))
+        ranked.sort()
+        return [filebase for rank, turn, position, filebase in ranked]
+
+    def wait(self, timeout):
+        """See `ISwitchboard`."""
+        if self._wakeup_fds is None:
+            path = os.path.join(
+                self.queue_directory, WAKEUP_FIFO + str(self._slice))
+            try:
+                os.mkfifo(path, 0o660)
+            except FileExistsError:
+                pass
+            # Keep a writer open ourselves, otherwise the pipe reports
+            # end-of-file, and thus readability, forever once the first
+            # enqueuing process has closed it.
+            reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            writer = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            self._wakeup_fds = (reader, writer)
+        reader = self._wakeup_fds[0]
+        readable, writable, exceptional = select.select(
+            [reader], [], [], timeout)
+        if readable:
+            # Drain all the pending notifications; one pass through the
+            # queue will pick up all the new entries.
+            try:
+                while os.read(reader, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def _notify(self, filebase):
+        """Wake up the runner for the new entry's slice, if it's waiting."""
+        if filebase_when(filebase) > time.time():
+            # The runner will find the deferred entry the first time it looks
+            # at the queue after the entry is due.
+            return
+        bucket = filebase_bucket(filebase)
+        slice = (bucket * self._numslices) // SLICE_BUCKETS
+        path = os.path.join(self.queue_directory, WAKEUP_FIFO + str(slice))
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as error:
+            # Either no runner has ever waited on this slice (ENOENT), or
+            # no runner is waiting right now (ENXIO).  It will find the
+            # entry the next time it looks at the queue.
+            if error.errno in (errno.ENOENT, errno.ENXIO):
+                return
+            raise
+        try:
+            os.write(fd, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the runner has plenty of wake up calls.
+            pass
+        finally:
+            os.close(fd)
+
+    def _commit(self, filebase, entry, sidecars):
+        """Store a serialized entry and wake up its runner.
+
+        :param filebase: The base name of the new queue entry.
+        :type filebase: str
+        :param entry: The serialized message and metadata.
+        :type entry: bytes
+        :param sidecars: The extensions of the files to store next to the
+            entry, and the functions storing them given their path.
+        :type sidecars: list of 2-tuples of (str, callable)
+        """
+        # The entry must never be seen without its files.
+        for extension, store in sidecars:
+            self._store_sidecar(filebase, extension, store)
+        self._store(filebase, entry)
+        self._notify(filebase)
+
+    def _sidecar_path(self, filebase, extension):
+        """The path of a file stored next to a queue entry.
+
+        :param filebase: The base name of the queue entry.
+        :type filebase: str
+        :param extension: The extension of the file.
+        :type extension: str
+        :return: The full path to the file.
+        :rtype: str
+        """
+        return os.path.join(self.queue_directory, filebase + extension)
+
+    def _store_sidecar(self, filebase, extension, store):
+        """Store a file next to a new queue entry.
+
+        :param filebase: The base name of the new queue entry.
+        :type filebase: str
+        :param extension: The extension of the file.
+        :type extension: str
+        :param store: The function storing the file, given its path.
+        :type store: callable
+        """
+        store(self._sidecar_path(filebase, extension))
+
+    def _finish_sidecars(self, filebase, preserve):
+        """Remove or preserve the files next to a finished entry.
+
+        The recipients file of a dequeued entry is closed too.
+
+        :param filebase: The base name of the queue entry.
+        :type filebase: str
+        :param preserve: True if the entry is preserved in the bad queue.
+        :type preserve: bool
+        """
+        recipients = self._bound.pop(filebase, None)
+        if recipients is not None:
+            recipients.close()
+        for extension in (RECIPIENTS_EXTENSION, MESSAGE_EXTENSION):
+            path = self._sidecar_path(filebase, extension)
+            try:
+                if preserve:
+                    bad_dir = config.switchboards['bad'].queue_directory
+                    os.rename(path, os.path.join(
+                        bad_dir, filebase + extension))
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                # Most entries are stored all by themselves.
+                pass
+            except EnvironmentError:
+                elog.exception(
+                    'Failed to unlink/preserve file: %s', path)
+
+    def _store(self, filebase, entry):
+        """Durably add a serialized entry to the queue.
+
+        :param filebase: The base name of the new queue entry.
+        :type filebase: str
+        :param entry: The serialized message and metadata.
+        :type entry: bytes
+        """
+        raise NotImplementedError
+
+    def _list(self, extension):
+        """List the queue entries in this switchboard's slice.
+
+        :param extension: The state of the entries to list, as the extension
+            their files would have in the default backend.
+        :type extension: str
+        :return: The file bases of the entries in FIFO order, including the
+            entries which are not due yet.
+        :rtype: list of str
+        """
+        raise NotImplementedError
+
+    def _checkout(self, filebase):
+        """Move a queued entry to its backup state and return its contents.
+
+        :param filebase: The base name of the queue entry.
+        :type filebase: str
+        :return: A binary file-like object positioned at the start of the
+            serialized message and metadata.
+        :raises FileNotFoundError: when there is no such queued entry.
+        """
+        raise NotImplementedError
+
+    def _bump_bak_count(self, fp):
+        """Increment the recovery count in a serialized entry, in place.
+
+        :param fp: The serialized entry, opened for reading and writing.
+        :type fp: binary file-like object
+        :return: The new recovery count.
+        :rtype: int
+        """
+        kind, msgsave, attributes, data = _load_entry(fp)
+        data['_bak_count'] = data.get('_bak_count', 0) + 1
+        if kind is None:
+            # Upgrade legacy entries while we're at it.
+            if data.pop('_parsemsg', False):
+                kind = MESSAGE_TEXT
+            kind, msgsave, attributes = _dump_message(msgsave, kind)
+        fp.seek(0)
+        fp.write(_dump_entry(kind, msgsave, attributes, data))
+        fp.truncate()
+        return data['_bak_count']
+
+    def _preserve(self, filebase, entry):
+        """Preserve a serialized entry as a .psv file in the bad queue.
+
+        :param filebase: The base name of the queue entry.
+        :type filebase: str
+        :param entry: The serialized message and metadata.
+        :type entry: bytes
+        """
+        bad_dir = config.switchboards['bad'].queue_directory
+        psvfile = os.path.join(bad_dir, filebase + '.psv')
+        with open(psvfile, 'wb') as fp:
+            fp.write(entry)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+@public
+class Switchboard(BaseSwitchboard):
+    """A switchboard storing each queue entry in its own file.
+
+    This is the default storage backend.
+    """
+
+    def path(self, filebase, extension='.pck'):
+        """The path of a queue file.
+
+        :param filebase: The base name of the queue entry.
+        :type filebase: str
+        :param extension: The extension of the queue file.
+        :type extension: str
+        :return: The full path to the queue file.
+        :rtype: str
+        """
+        return os.path.join(self.queue_directory, filebase + extension)
+
+    def _sidecar_path(self, filebase, extension):
+        """See `BaseSwitchboard`."""
+        return self.path(filebase, extension)
+
+    def _store(self, filebase, entry):
+        """See `BaseSwitchboard`."""
+        filename = self.path(filebase)
+        tmpfile = filename + '.tmp'
         # Write to the pickle file the message object and metadata.
         with open(tmpfile, 'wb') as fp:
-            fp.write(msgsave)
-            pickle.dump(data, fp, protocol)
+            fp.write(entry)
             fp.flush()
             os.fsync(fp.fileno())
         os.rename(tmpfile, filename)
-        return filebase
 
-    def dequeue(self, filebase):
-        """See `ISwitchboard`."""
+    def _checkout(self, filebase):
+        """See `BaseSwitchboard`."""
         # Calculate the filename from the given filebase.
-        filename = os.path.join(self.queue_directory, filebase + '.pck')
-        backfile = os.path.join(self.queue_directory, filebase + '.bak')
-        # Read the message object and metadata.
-        with open(filename, 'rb') as fp:
-            # Move the file to the backup file name for processing.  If this
-            # process crashes uncleanly the .bak file will be used to
-            # re-instate the .pck file in order to try again.
-            os.rename(filename, backfile)
-            msg = pickle.load(fp)
-            data = pickle.load(fp)
-        if data.get('_parsemsg'):
-            # Calculate the original size of the text now so that we won't
-            # have to generate the message later when we do size restriction
-            # checking.
-            original_size = len(msg)
-            msg = email.message_from_string(msg, Message)
-            msg.original_size = original_size
-            data['original_size'] = original_size
-        return msg, data
+        filename = self.path(filebase)
+        backfile = self.path(filebase, '.bak')
+        # Move the file to the backup file name for processing.  If this
+        # process crashes uncleanly the .bak file will be used to re-instate
+        # the .pck file in order to try again.
+        os.rename(filename, backfile)
+        return open(backfile, 'rb')
+
+    def restore(self, filebase):
+        """See `ISwitchboard`."""
+        os.rename(self.path(filebase, '.bak'), self.path(filebase))
 
     def finish(self, filebase, preserve=False):
         """See `ISwitchboard`."""
-        bakfile = os.path.join(self.queue_directory, filebase + '.bak')
+        bakfile = self.path(filebase, '.bak')
         try:
             if preserve:
                 bad_dir = config.switchboards['bad'].queue_directory
@@ -176,14 +994,10 @@ class Switchboard:
         except EnvironmentError:
             elog.exception(
                 'Failed to unlink/preserve backup file: %s', bakfile)
+        self._finish_sidecars(filebase, preserve)
 
-    @property
-    def files(self):
-        """See `ISwitchboard`."""
-        return self.get_files()
-
-    def get_files(self, extension='.pck'):
-        """See `ISwitchboard`."""
+    def _list(self, extension):
+        """See `BaseSwitchboard`."""
         times = {}
         lower = self._lower
         upper = self._upper
@@ -194,10 +1008,9 @@ class Switchboard:
             if ext != extension:
                 continue
             when, digest = filebase.split('+', 1)
-            # Throw out any files which don't match our bitrange.  BAW: test
-            # performance and end-cases of this algorithm.  MAS: both
-            # comparisons need to be <= to get complete range.
-            if lower is None or (lower <= int(digest, 16) <= upper):
+            # Throw out any files which don't belong to our slice.  Both
+            # comparisons need to be <= to get the complete range.
+            if lower is None or (lower <= digest[:SLICE_DIGITS] <= upper):
                 key = float(when)
                 while key in times:
                     key += DELTA
@@ -205,6 +1018,14 @@ class Switchboard:
         # FIFO sort
         return [times[k] for k in sorted(times)]
 
+    def count(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        if self._lower is not None:
+            return super().count(extension)
+        # Don't bother parsing and sorting the file names.
+        return sum(1 for filename in os.listdir(self.queue_directory)
+                   if filename.endswith(extension))
+
     def recover_backup_files(self):
         """See `ISwitchboard`."""
         # Move all .bak files in our slice to .pck.  It's impossible for both
@@ -213,15 +1034,12 @@ class Switchboard:
         # _bak_count in the metadata of the number of times we recover this
         # file.  When the count reaches MAX_BAK_COUNT, we move the .bak file
         # to a .psv file in the bad queue.
-        for filebase in self.get_files('.bak'):
-            src = os.path.join(self.queue_directory, filebase + '.bak')
-            dst = os.path.join(self.queue_directory, filebase + '.pck')
+        for filebase in self._list('.bak'):
+            src = self.path(filebase, '.bak')
+            dst = self.path(filebase)
             with open(src, 'rb+') as fp:
                 try:
-                    # Throw away the message object.
-                    pickle.load(fp)
-                    data_pos = fp.tell()
-                    data = pickle.load(fp)
+                    bak_count = self._bump_bak_count(fp)
                 except Exception as error:
                     # If unpickling throws any exception, just log and
                     # preserve this entry
@@ -229,17 +1047,9 @@ class Switchboard:
                                'Preserving file: %s', error, filebase)
                     self.finish(filebase, preserve=True)
                 else:
-                    data['_bak_count'] = data.get('_bak_count', 0) + 1
-                    fp.seek(data_pos)
-                    if data.get('_parsemsg'):
-                        protocol = 0
-                    else:
-                        protocol = 1
-                    pickle.dump(data, fp, protocol)
-                    fp.truncate()
                     fp.flush()
                     os.fsync(fp.fileno())
-                    if data['_bak_count'] >= MAX_BAK_COUNT:
+                    if bak_count >= MAX_BAK_COUNT:
                         elog.error('.bak file max count, preserving file: %s',
                                    filebase)
                         self.finish(filebase, preserve=True)
@@ -247,6 +1057,123 @@ class Switchboard:
                         os.rename(src, dst)
 
 
+@public
+class ShardedSwitchboard(Switchboard):
+    """A switchboard spreading its queue files over subdirectories.
+
+    Each queue file lives in a subdirectory named after the leading digits of
+    its digest.  A runner only lists the subdirectories which overlap its
+    slice, so a huge backlog in a queue doesn't make every pass through it
+    list and sort one enormous directory.
+    """
+
+    def path(self, filebase, extension='.pck'):
+        """See `Switchboard`."""
+        when, digest = filebase.split('+', 1)
+        return os.path.join(
+            self.queue_directory, digest[:SHARD_DIGITS], filebase + extension)
+
+    def _store(self, filebase, entry):
+        """See `BaseSwitchboard`."""
+        try:
+            super()._store(filebase, entry)
+        except FileNotFoundError:
+            # This is the first entry in its subdirectory.
+            makedirs(os.path.dirname(self.path(filebase)), 0o770)
+            super()._store(filebase, entry)
+
+    def _store_sidecar(self, filebase, extension, store):
+        """See `BaseSwitchboard`."""
+        try:
+            super()._store_sidecar(filebase, extension, store)
+        except FileNotFoundError:
+            # This is the first entry in its subdirectory.
+            makedirs(os.path.dirname(self.path(filebase)), 0o770)
+            super()._store_sidecar(filebase, extension, store)
+
+    def _shards(self):
+        """The subdirectories overlapping this switchboard's slice.
+
+        :return: The subdirectory names, and whether the digests of the files
+            in them must be checked against the slice.
+        :rtype: sequence of 2-tuples of (str, bool)
+        """
+        width = 16 ** (SLICE_DIGITS - SHARD_DIGITS)
+        lower, upper = slice_buckets(self._slice, self._numslices)
+        for prefix in range(16 ** SHARD_DIGITS):
+            first = prefix * width
+            last = first + width - 1
+            if self._lower is None:
+                check = False
+            elif last < lower or first > upper:
+                continue
+            else:
+                check = (first < lower or last > upper)
+            yield '{:0{}x}'.format(prefix, SHARD_DIGITS), check
+
+    def _list(self, extension):
+        """See `BaseSwitchboard`."""
+        lower = self._lower
+        upper = self._upper
+        shards = []
+        for shard, check in self._shards():
+            try:
+                filenames = os.listdir(
+                    os.path.join(self.queue_directory, shard))
+            except FileNotFoundError:
+                continue
+            entries = []
+            for f in filenames:
+                # By ignoring anything that doesn't end in .pck, we ignore
+                # tempfiles and avoid a race condition.
+                filebase, ext = os.path.splitext(f)
+                if ext != extension:
+                    continue
+                when, digest = filebase.split('+', 1)
+                # Only the subdirectories at the edges of our slice can
+                # contain files which belong to another slice.
+                if check and not (lower <= digest[:SLICE_DIGITS] <= upper):
+                    continue
+                entries.append((float(when), filebase))
+            # FIFO sort within the subdirectory.
+            entries.sort()
+            shards.append(entries)
+        # Merge the subdirectories oldest first.
+        return [filebase for when, filebase in heapq.merge(*shards)]
+
+    def count(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        if self._lower is not None:
+            return BaseSwitchboard.count(self, extension)
+        count = 0
+        for shard, check in self._shards():
+            try:
+                filenames = os.listdir(
+                    os.path.join(self.queue_directory, shard))
+            except FileNotFoundError:
+                continue
+            count += sum(1 for filename in filenames
+                         if filename.endswith(extension))
+        return count
+
+    def recover_backup_files(self):
+        """See `ISwitchboard`."""
+        # Move the files of our slice which were queued before this queue
+        # was sharded into their subdirectories.
+        flat = Switchboard(self.name, self.queue_directory,
+                           self._slice, self._numslices)
+        # The files next to the entries go first, so that no entry is ever
+        # seen without them.
+        for extension in (RECIPIENTS_EXTENSION, MESSAGE_EXTENSION,
+                          '.bak', '.pck'):
+            for filebase in flat._list(extension):
+                dst = self.path(filebase, extension)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    makedirs(os.path.dirname(dst), 0o770)
+                os.rename(flat.path(filebase, extension), dst)
+        super().recover_backup_files()
+
+
 @public
 def handle_ConfigurationUpdatedEvent(event):
     """Initialize the global switchboards for input/output."""
@@ -263,4 +1190,6 @@ def handle_ConfigurationUpdatedEvent(event):
             substitutions = config.paths
             substitutions['name'] = name
             path = expand(conf.path, substitutions)
-            config.switchboards[name] = Switchboard(name, path)
+            switchboard_class = find_name(conf.switchboard)
+            config.switchboards[name] = switchboard_class(
+                name, path, numslices=int(conf.instances))
@@ -0,0 +1,151 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the compact recipient sets."""
+
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+
+from mailman.core.recipients import RecipientSet
+from mailman.interfaces.mta import SomeRecipientsFailed
+from unittest.mock import patch
+
+
+class TestRecipientSet(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._path = os.path.join(self._tempdir, 'recipients')
+        self._addresses = [
+            'anne@example.com',
+            'bart@example.com',
+            'bart@example.org',
+            'cris@example.com',
+            'dave@example.com',
+            'zoë@example.com',
+            ]
+
+    def _stored(self):
+        recipients = RecipientSet(reversed(self._addresses))
+        recipients.store(self._path)
+        stored = RecipientSet.stored(len(self._addresses))
+        stored.bind(self._path)
+        return stored
+
+    def test_in_memory(self):
+        recipients = RecipientSet(self._addresses + self._addresses[:2])
+        self.assertEqual(len(recipients), 6)
+        self.assertEqual(list(recipients), self._addresses)
+        self.assertEqual(recipients, set(self._addresses))
+        self.assertIn('cris@example.com', recipients)
+        self.assertNotIn('cris@example.org', recipients)
+
+    def test_stored(self):
+        recipients = self._stored()
+        self.assertEqual(len(recipients), 6)
+        self.assertEqual(list(recipients), self._addresses)
+        self.assertIn('zoë@example.com', recipients)
+        self.assertNotIn('zoe@example.com', recipients)
+        self.assertEqual(recipients - {'anne@example.com'},
+                         set(self._addresses[1:]))
+
+    def test_front_coded(self):
+        # Addresses sharing a prefix don't store it again.
+        addresses = ['person{:06}@example.com'.format(i)
+                     for i in range(10000)]
+        recipients = RecipientSet(addresses)
+        recipients.store(self._path)
+        self.assertLess(os.stat(self._path).st_size, 25000)
+        self.assertEqual(list(recipients), addresses)
+
+    def test_unbound(self):
+        recipients = RecipientSet.stored(6)
+        self.assertEqual(len(recipients), 6)
+        self.assertRaises(ValueError, list, recipients)
+        self.assertRaises(ValueError, recipients.store, self._path)
+
+    def test_not_a_recipients_file(self):
+        with open(self._path, 'wb') as fp:
+            fp.write(b'x' * 20)
+        recipients = RecipientSet.stored(6)
+        self.assertRaises(ValueError, recipients.bind, self._path)
+
+    def test_concurrent_iteration(self):
+        recipients = self._stored()
+        pairs = [(one, other)
+                 for one in recipients for other in recipients]
+        self.assertEqual(len(pairs), 36)
+
+    def test_subset(self):
+        recipients = self._stored()
+        subset = recipients.subset(
+            ['bart@example.org', 'cris@example.com', 'zoë@example.com'])
+        self.assertEqual(subset.runs, [2, 2, 1, 1])
+        self.assertEqual(len(subset), 3)
+        self.assertEqual(list(subset), [
+            'bart@example.org', 'cris@example.com', 'zoë@example.com'])
+        # Subsets of subsets are relative to the file too.
+        subsubset = subset.subset(['anne@example.com', 'zoë@example.com'])
+        self.assertEqual(subsubset.runs, [5, 1])
+        self.assertEqual(list(subsubset), ['zoë@example.com'])
+
+    def test_excluding(self):
+        recipients = self._stored()
+        subset = recipients.excluding(['bart@example.com', 'zoe@example.com'])
+        self.assertEqual(subset.runs, [0, 1, 1, 4])
+        self.assertEqual(len(subset), 5)
+        self.assertNotIn('bart@example.com', subset)
+        self.assertEqual(list(RecipientSet(self._addresses).excluding(
+            ['anne@example.com'])), self._addresses[1:])
+
+    def test_copy_across_file_systems(self):
+        # Files can't be linked across file systems, so they are copied.
+        recipients = self._stored()
+        path = os.path.join(self._tempdir, 'copy')
+        error = OSError(errno.EXDEV, 'Invalid cross-device link')
+        with patch('mailman.core.recipients.os.link', side_effect=error):
+            recipients.store(path)
+        self.assertEqual(os.stat(path).st_nlink, 1)
+        self.assertEqual(os.stat(self._path).st_nlink, 1)
+        stored = RecipientSet.stored(6)
+        stored.bind(path)
+        self.assertEqual(list(stored), self._addresses)
+
+    def test_close(self):
+        recipients = self._stored()
+        recipients.close()
+        self.assertRaises(ValueError, list, recipients)
+
+    def test_copy_when_removed(self):
+        recipients = self._stored()
+        os.unlink(self._path)
+        path = os.path.join(self._tempdir, 'copy')
+        recipients.store(path)
+        self.assertEqual(os.stat(path).st_nlink, 1)
+        recipients.store(self._path)
+        self.assertEqual(os.stat(path).st_nlink, 2)
+
+    def test_temporary_subset(self):
+        error = SomeRecipientsFailed(['cris@example.com'], [])
+        self.assertEqual(error.temporary_subset(set(self._addresses)),
+                         ['cris@example.com'])
+        subset = error.temporary_subset(self._stored())
+        self.assertEqual(subset.runs, [3, 1, 2])
+        self.assertEqual(list(subset), ['cris@example.com'])
@@ -17,6 +17,8 @@
 
 """Test some Runner base class behavior."""
 
+import os
+import time
 import unittest
 
 from mailman.app.lifecycle import create_list
@@ -24,13 +26,16 @@ from mailman.config import config
 from mailman.core.runner import Runner
 from mailman.interfaces.member import DeliveryMode
 from mailman.interfaces.runner import RunnerCrashEvent
+from mailman.interfaces.usermanager import IUserManager
 from mailman.runners.virgin import VirginRunner
 from mailman.testing.helpers import (
-    LogFileMark, configuration, event_subscribers, get_queue_messages,
-    make_digest_messages, make_testable_runner,
+    LogFileMark, configuration, counted_statements, event_subscribers,
+    get_queue_messages, make_digest_messages, make_testable_runner,
     specialized_message_from_string as mfs,
     subscribe)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
+from zope.component import getUtility
 
 
 class CrashingRunner(Runner):
@@ -38,6 +43,23 @@ class CrashingRunner(Runner):
         raise RuntimeError('borked')
 
 
+class DisposingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        self.disposed = mlist
+        return False
+
+
+class BatchingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        # Leave a trace in the database and in the out queue, then fail for
+        # one specific message.
+        getUtility(IUserManager).create_address(msg.sender)
+        config.switchboards['out'].enqueue(msg, msgdata)
+        if msg['message-id'] == '<bad>':
+            raise RuntimeError('borked')
+        return False
+
+
 class TestRunner(unittest.TestCase):
     """Test the Runner base class behavior."""
 
@@ -118,3 +140,150 @@ Message-ID: <ant>
         # The list's -request address is the original sender.
         self.assertEqual(item.msgdata['original_sender'],
                          'test-request@example.com')
+
+    @configuration('runner.in', sleep_time='10s')
+    def test_list_lookup(self):
+        # The mailing list of an entry is looked up without checking the
+        # cached names and list ids of all the lists first.
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        runner = make_testable_runner(DisposingRunner, 'in')
+        config.db.commit()
+        with counted_statements() as statements:
+            runner._process_one_file(msg, dict(listid='test.example.com'))
+        self.assertEqual(runner.disposed, self._mlist)
+        self.assertFalse(any('listgeneration' in statement
+                             for statement in statements))
+
+    def test_snooze_wakes_up_on_enqueue(self):
+        # An idle runner wakes up as soon as a message is enqueued to it.
+        runner = make_testable_runner(CrashingRunner, 'in')
+        runner.switchboard.wait(0)
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        t0 = time.time()
+        runner._snooze(0)
+        self.assertLess(time.time() - t0, 5)
+
+    @configuration('runner.in', sleep_time='0.2s', wakeup_on_enqueue='no')
+    def test_snooze_polling(self):
+        runner = make_testable_runner(CrashingRunner, 'in')
+        t0 = time.time()
+        runner._snooze(0)
+        self.assertGreaterEqual(time.time() - t0, 0.2)
+        self.assertNotIn('.wakeup-0', os.listdir(runner.queue_directory))
+
+
+class TestBatching(unittest.TestCase):
+    """Test processing queue files in batches."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        config.db.commit()
+
+    def _enqueue(self, *senders):
+        for sender in senders:
+            msg = mfs("""\
+From: {0}@example.com
+To: test@example.com
+Message-ID: <{0}>
+
+""".format(sender))
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+
+    def _out_message_ids(self):
+        return sorted(item.msg['message-id']
+                      for item in get_queue_messages('out'))
+
+    @configuration('runner.in', batch_size=10)
+    def test_one_commit_per_batch(self):
+        self._enqueue('anne', 'bart', 'cris')
+        runner = make_testable_runner(BatchingRunner, 'in')
+        with patch.object(config.db, 'commit',
+                          wraps=config.db.commit) as commit:
+            runner._one_iteration()
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual(len(config.switchboards['in'].files), 0)
+        self.assertEqual(len(config.switchboards['in'].get_files('.bak')), 0)
+        self.assertEqual(self._out_message_ids(),
+                         ['<anne>', '<bart>', '<cris>'])
+
+    @configuration('runner.in', batch_size=2)
+    def test_batch_size(self):
+        self._enqueue('anne', 'bart', 'cris')
+        runner = make_testable_runner(BatchingRunner, 'in')
+        with patch.object(config.db, 'commit',
+                          wraps=config.db.commit) as commit:
+            runner._one_iteration()
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(len(config.switchboards['in'].files), 0)
+
+    @configuration('runner.in', batch_size=2)
+    def test_batches_share_files(self):
+        # The batches take their files from one iterator, instead of copying
+        # the rest of the list for every batch.
+        self._enqueue('anne', 'bart', 'cris', 'dave', 'elly')
+        runner = make_testable_runner(BatchingRunner, 'in')
+        with patch.object(runner, '_process_batch',
+                          wraps=runner._process_batch) as process_batch:
+            runner._one_iteration()
+        self.assertEqual(process_batch.call_count, 3)
+        files = set(id(call[0][0]) for call in process_batch.call_args_list)
+        self.assertEqual(len(files), 1)
+        self.assertNotIsInstance(process_batch.call_args[0][0], list)
+        self.assertEqual(len(self._out_message_ids()), 5)
+
+    @configuration('runner.in', batch_size=10)
+    def test_failed_commit(self):
+        # When committing the batch fails, nothing it enqueued is stored,
+        # and the replayed files are only enqueued once.
+        self._enqueue('anne', 'bart')
+        runner = make_testable_runner(BatchingRunner, 'in')
+        commit = config.db.commit
+        calls = []
+
+        def failing_commit():
+            calls.append(True)
+            if len(calls) == 1:
+                raise RuntimeError('database went away')
+            commit()
+        with patch.object(config.db, 'commit', side_effect=failing_commit):
+            runner._one_iteration()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self._out_message_ids(), ['<anne>', '<bart>'])
+        self.assertEqual(len(config.switchboards['in'].files), 0)
+        self.assertEqual(len(config.switchboards['in'].get_files('.bak')), 0)
+
+    @configuration('runner.in', batch_size=10)
+    def test_failure_replays_batch(self):
+        # When one message in the batch fails, the other messages still get
+        # processed and committed exactly once, and the bad one gets shunted
+        # just like it would without batching.
+        self._enqueue('anne', 'bad', 'cris')
+        runner = make_testable_runner(BatchingRunner, 'in')
+        runner.run()
+        self.assertEqual(self._out_message_ids(),
+                         ['<anne>', '<bad>', '<cris>'])
+        items = get_queue_messages('shunt', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<bad>')
+        self.assertEqual(items[0].msgdata['whichq'], 'in')
+        self.assertEqual(len(config.switchboards['in'].files), 0)
+        self.assertEqual(len(config.switchboards['in'].get_files('.bak')), 0)
+        # The database changes of the bad message were rolled back, but
+        # those of the good messages were committed.
+        config.db.abort()
+        user_manager = getUtility(IUserManager)
+        self.assertIsNotNone(user_manager.get_address('anne@example.com'))
+        self.assertIsNotNone(user_manager.get_address('cris@example.com'))
+        self.assertIsNone(user_manager.get_address('bad@example.com'))
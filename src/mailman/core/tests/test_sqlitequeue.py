@@ -0,0 +1,204 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the SQLite switchboard storage backend."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.core.runner import Runner
+from mailman.core.sqlitequeue import QUEUED, SELECT_SLICE, SQLiteSwitchboard
+from mailman.core.switchboard import (
+    MIN_SHARED_MESSAGE, MIN_STORED_RECIPIENTS)
+from mailman.testing.helpers import (
+    configuration, get_queue_messages, make_testable_runner,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer
+
+
+class StoringRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        config.switchboards['out'].enqueue(msg, msgdata)
+        return False
+
+
+class TestSQLiteSwitchboard(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = SQLiteSwitchboard('test', self._tempdir)
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def _bad_files(self):
+        bad_dir = config.switchboards['bad'].queue_directory
+        return sorted(os.listdir(bad_dir))
+
+    def test_single_file(self):
+        # Small entries live entirely in the one database file.
+        for i in range(3):
+            self._switchboard.enqueue(self._msg, foo=i)
+        self.assertEqual(
+            [filename for filename in os.listdir(self._tempdir)
+             if not filename.startswith('queue.db-')],
+            ['queue.db'])
+        self.assertEqual(len(self._switchboard.files), 3)
+
+    def test_enqueue_dequeue_finish(self):
+        filebase = self._switchboard.enqueue(self._msg, {'foo': 1}, bar=2)
+        self.assertEqual(self._switchboard.files, [filebase])
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['foo'], 1)
+        self.assertEqual(msgdata['bar'], 2)
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        self._switchboard.finish(filebase)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+
+    def test_fifo_order(self):
+        filebases = [self._switchboard.enqueue(self._msg, foo=i)
+                     for i in range(5)]
+        self.assertEqual(self._switchboard.files, filebases)
+
+    def test_dequeue_missing(self):
+        # Like the file backend, a missing entry is a FileNotFoundError.
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self.assertRaises(FileNotFoundError,
+                          self._switchboard.dequeue, filebase)
+
+    def test_unknown_extension(self):
+        self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._switchboard.get_files('.psv'), [])
+
+    def test_slices(self):
+        filebases = set(self._switchboard.enqueue(self._msg, foo=i)
+                        for i in range(20))
+        found = []
+        for slice in range(3):
+            switchboard = SQLiteSwitchboard('test', self._tempdir, slice, 3)
+            found.extend(switchboard.files)
+        # Every entry is in exactly one slice.
+        self.assertEqual(len(found), 20)
+        self.assertEqual(set(found), filebases)
+        self.assertEqual(self._switchboard.count(), 20)
+        self.assertEqual(switchboard.count(), len(switchboard.files))
+        self.assertEqual(switchboard.count('.psv'), 0)
+
+    def test_slice_plan(self):
+        # A runner's slice is found through an index covering the query,
+        # without scanning the whole queue.
+        switchboard = SQLiteSwitchboard('test', self._tempdir, 1, 3)
+        plan = [row[-1] for row in switchboard._db.execute(
+            'EXPLAIN QUERY PLAN ' + SELECT_SLICE,
+            (QUEUED,) + switchboard._buckets)]
+        self.assertIn('COVERING INDEX ix_entry_slice', plan[0])
+        self.assertFalse(any(detail.startswith('SCAN') for detail in plan))
+
+    def test_threads(self):
+        # Every thread uses its own connection to the database.
+        filebases = []
+        thread = threading.Thread(target=lambda: filebases.append(
+            self._switchboard.enqueue(self._msg)))
+        self._switchboard.enqueue(self._msg)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(filebases), 1)
+        self.assertEqual(self._switchboard.count(), 2)
+
+    def test_recover_backup_files(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        switchboard = SQLiteSwitchboard('test', self._tempdir, recover=True)
+        self.assertEqual(switchboard.files, [filebase])
+        msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['_bak_count'], 1)
+
+    def test_recover_max_count(self):
+        # After too many recoveries, the entry is preserved in the bad queue.
+        filebase = self._switchboard.enqueue(self._msg)
+        for i in range(3):
+            self._switchboard.dequeue(filebase)
+            self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+        self.assertEqual(self._bad_files(), [filebase + '.psv'])
+
+    def test_finish_preserve(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase, preserve=True)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+        self.assertEqual(self._bad_files(), [filebase + '.psv'])
+
+    def test_stored_recipients(self):
+        # Big sets of recipients are stored next to the database.
+        recipients = set('person{:04}@example.com'.format(i)
+                         for i in range(MIN_STORED_RECIPIENTS))
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=recipients)
+        self.assertIn(filebase + '.rcp', os.listdir(self._tempdir))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['recipients'], recipients)
+        self._switchboard.finish(filebase)
+        self.assertNotIn(filebase + '.rcp', os.listdir(self._tempdir))
+
+    def test_shared_message(self):
+        # Big messages are stored next to the database.
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""" + 'x' * MIN_SHARED_MESSAGE + '\n')
+        first = self._switchboard.enqueue(msg)
+        second = self._switchboard.enqueue(msg)
+        self.assertTrue(os.path.samefile(
+            os.path.join(self._tempdir, first + '.msg'),
+            os.path.join(self._tempdir, second + '.msg')))
+        for filebase in (first, second):
+            dequeued, msgdata = self._switchboard.dequeue(filebase)
+            self.assertEqual(dequeued.as_bytes(), msg.as_bytes())
+            self._switchboard.finish(filebase)
+        self.assertFalse(any(filename.endswith('.msg')
+                             for filename in os.listdir(self._tempdir)))
+
+    @configuration('runner.in',
+                   switchboard='mailman.core.sqlitequeue.SQLiteSwitchboard')
+    def test_runner_backend(self):
+        # The switchboard class is selected by the runner configuration.
+        create_list('test@example.com')
+        self.assertIsInstance(config.switchboards['in'], SQLiteSwitchboard)
+        config.switchboards['in'].enqueue(self._msg, listid='test.example.com')
+        runner = make_testable_runner(StoringRunner, 'in')
+        self.assertIsInstance(runner.switchboard, SQLiteSwitchboard)
+        runner.run()
+        self.assertEqual(config.switchboards['in'].files, [])
+        items = get_queue_messages('out', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<ant>')
@@ -17,16 +17,41 @@
 
 """Switchboard tests."""
 
+import os
+import time
+import uuid
+import pickle
+import shutil
+import tempfile
 import unittest
+import threading
 
+from datetime import datetime, timedelta
+from email.header import Header
+from mailman.app.lifecycle import create_list
 from mailman.config import config
+from mailman.core.recipients import RecipientSet
+from mailman.core.switchboard import (
+    MIN_SHARED_MESSAGE, MIN_STORED_RECIPIENTS, SLICE_BUCKETS,
+    ShardedSwitchboard, Switchboard, filebase_bucket, filebase_list_key,
+    filebase_priority, list_key, load_entry, slice_buckets, staged_enqueues)
+from mailman.email.message import LazyMessage, Message, UserNotification
 from mailman.testing.helpers import (
-    LogFileMark,
+    LogFileMark, configuration,
     specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import now
 from unittest.mock import patch
 
 
+MESSAGE = """\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+"""
+
+
 class TestSwitchboard(unittest.TestCase):
     layer = ConfigLayer
 
@@ -51,3 +76,903 @@ Message-ID: <ant>
         traceback = error_log.read().splitlines()
         self.assertEqual(traceback[1], 'Traceback (most recent call last):')
         self.assertEqual(traceback[-1], 'OSError: Oops!')
+
+    def test_restore(self):
+        # A dequeued entry can be put back into the queue.
+        switchboard = config.switchboards['shunt']
+        filebase = switchboard.enqueue(mfs(MESSAGE))
+        switchboard.dequeue(filebase)
+        self.assertEqual(switchboard.files, [])
+        switchboard.restore(filebase)
+        self.assertEqual(switchboard.files, [filebase])
+        self.assertEqual(switchboard.get_files('.bak'), [])
+
+    def test_staged_enqueues(self):
+        # Staged entries are only stored when the block exits cleanly.
+        switchboard = config.switchboards['shunt']
+        with staged_enqueues():
+            filebase = switchboard.enqueue(mfs(MESSAGE))
+            self.assertEqual(switchboard.files, [])
+        self.assertEqual(switchboard.files, [filebase])
+
+    def test_staged_enqueues_dropped(self):
+        switchboard = config.switchboards['shunt']
+        with self.assertRaises(RuntimeError):
+            with staged_enqueues():
+                switchboard.enqueue(mfs(MESSAGE))
+                raise RuntimeError
+        self.assertEqual(switchboard.files, [])
+        # Enqueues are no longer staged.
+        switchboard.enqueue(mfs(MESSAGE))
+        self.assertEqual(len(switchboard.files), 1)
+
+    def test_staged_enqueues_other_thread(self):
+        # Entries enqueued by other threads are not held back.
+        switchboard = config.switchboards['shunt']
+        filebases = []
+
+        def enqueue():
+            filebases.append(switchboard.enqueue(mfs(MESSAGE)))
+        with self.assertRaises(RuntimeError):
+            with staged_enqueues():
+                thread = threading.Thread(target=enqueue)
+                thread.start()
+                thread.join()
+                self.assertEqual(switchboard.files, filebases)
+                raise RuntimeError
+        self.assertEqual(len(filebases), 1)
+        self.assertEqual(switchboard.files, filebases)
+
+
+class TestSlicing(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+
+    def test_slice_buckets(self):
+        # The slices split the buckets into contiguous ranges, for any
+        # number of slices.
+        for numslices in (1, 2, 3, 5, 6, 8, 100):
+            ranges = [slice_buckets(slice, numslices)
+                      for slice in range(numslices)]
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], SLICE_BUCKETS - 1)
+            for (first, last), (next_first, next_last) in zip(
+                    ranges, ranges[1:]):
+                self.assertEqual(last + 1, next_first)
+            # The range of a slice holds exactly the buckets which map to it.
+            for slice, (first, last) in enumerate(ranges):
+                for bucket in (first, last):
+                    self.assertEqual(
+                        bucket * numslices // SLICE_BUCKETS, slice)
+
+    def test_filebase_bucket(self):
+        self.assertEqual(filebase_bucket('1.0+' + '0' * 40), 0)
+        self.assertEqual(filebase_bucket('1.0+0123' + 'f' * 36), 0x123)
+
+    def _check_slices(self, switchboard_class, numslices):
+        switchboard = switchboard_class('test', self._tempdir)
+        filebases = set(switchboard.enqueue(mfs(MESSAGE), foo=i)
+                        for i in range(60))
+        found = []
+        for slice in range(numslices):
+            switchboard = switchboard_class(
+                'test', self._tempdir, slice, numslices)
+            files = switchboard.files
+            for filebase in files:
+                self.assertEqual(
+                    filebase_bucket(filebase) * numslices // SLICE_BUCKETS,
+                    slice)
+            found.extend(files)
+        # Every entry is in exactly one slice.
+        self.assertEqual(len(found), 60)
+        self.assertEqual(set(found), filebases)
+
+    def test_three_slices(self):
+        self._check_slices(Switchboard, 3)
+
+    def test_six_slices(self):
+        self._check_slices(Switchboard, 6)
+
+    def test_sharded_three_slices(self):
+        self._check_slices(ShardedSwitchboard, 3)
+
+
+class TestEntryFormat(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard('test', self._tempdir)
+
+    def _entry(self, filebase):
+        path = os.path.join(self._tempdir, filebase + '.pck')
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def test_unique_filebases(self):
+        # Enqueuing the same message twice still gives two entries.
+        msg = mfs(MESSAGE)
+        filebases = [self._switchboard.enqueue(msg) for i in range(2)]
+        self.assertNotEqual(filebases[0], filebases[1])
+        when, digest, priority, list_key = filebases[0].split('+')
+        self.assertEqual(len(digest), 40)
+
+    def test_raw_message(self):
+        # The message is stored as its bytes, not as a pickle.
+        filebase = self._switchboard.enqueue(mfs(MESSAGE))
+        self.assertTrue(self._entry(filebase).endswith(
+            MESSAGE.encode('ascii')))
+        self.assertNotIn(b'email.message', self._entry(filebase))
+
+    def test_lazy_parsing(self):
+        msg = mfs(MESSAGE)
+        msg.set_unixfrom('From bart@example.com')
+        filebase = self._switchboard.enqueue(msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, LazyMessage)
+        self.assertNotIn('_headers', msg.__dict__)
+        # The headers are parsed when they are first used...
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msg.get_unixfrom(), 'From bart@example.com')
+        self.assertNotIn('_payload', msg.__dict__)
+        # ...but the body only when it is touched.
+        del msg['to']
+        self.assertEqual(msg.get_payload(), '')
+        self.assertIsNone(msg['to'])
+
+    def test_message_attributes(self):
+        # Attributes of the message object survive the queue.
+        msg = mfs(MESSAGE)
+        filebase = self._switchboard.enqueue(msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.original_size, len(MESSAGE))
+
+    def test_metadata_types(self):
+        msgdata = dict(
+            recipients={'anne@example.com', 'bart@example.com'},
+            received_time=datetime(2016, 1, 2, 3, 4, 5, 6),
+            delay=timedelta(days=1, seconds=2),
+            token=uuid.UUID(int=7),
+            pair=('a', 1),
+            nested={'__set__': [1, 2]},
+            numbers={1: 'one'},
+            raw=b'\xff',
+            )
+        filebase = self._switchboard.enqueue(mfs(MESSAGE), msgdata)
+        msg, data = self._switchboard.dequeue(filebase)
+        for key, value in msgdata.items():
+            self.assertEqual(data[key], value)
+            self.assertEqual(type(data[key]), type(value))
+
+    def test_header_instances(self):
+        # Messages with Header instances are kept as they are.
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'Hello', 'Text')
+        filebase = self._switchboard.enqueue(msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg['subject'], Header)
+        self.assertEqual(msg.recipients, {'anne@example.com'})
+
+    def test_lazy_message_pickle(self):
+        # A pickled lazy message is a plain, fully parsed message.
+        filebase = self._switchboard.enqueue(mfs(MESSAGE))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        copy = pickle.loads(pickle.dumps(msg))
+        self.assertIs(type(copy), Message)
+        self.assertEqual(copy['message-id'], '<ant>')
+        self.assertEqual(copy.get_payload(), '')
+
+    def test_requeue_unparsed(self):
+        # A message which was never parsed is enqueued with its original
+        # bytes.
+        filebase = self._switchboard.enqueue(mfs(MESSAGE))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        filebase = self._switchboard.enqueue(msg)
+        self.assertNotIn('_headers', msg.__dict__)
+        self.assertTrue(self._entry(filebase).endswith(
+            MESSAGE.encode('ascii')))
+
+    def test_requeue_unparsed_body(self):
+        # When only the headers of a message were used, its body is enqueued
+        # as the original bytes.
+        msg = LazyMessage(b'From: anne@example.com\nMessage-ID: <ant>\n\n'
+                          b'First line\r\nSecond line\r\n')
+        msg['X-Test'] = 'yes'
+        filebase = self._switchboard.enqueue(msg)
+        self.assertNotIn('_payload', msg.__dict__)
+        self.assertTrue(self._entry(filebase).endswith(
+            b'Message-ID: <ant>\nX-Test: yes\n\n'
+            b'First line\r\nSecond line\r\n'))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['x-test'], 'yes')
+        self.assertEqual(msg.get_payload(), 'First line\r\nSecond line\r\n')
+        self.assertEqual(msgdata, dict(version=3))
+
+    def test_requeue_unparsed_body_without_separator(self):
+        # The body is generated from the parsed message when the headers
+        # don't end with an empty line.
+        msg = LazyMessage(b'From: anne@example.com\nFirst line\r\n')
+        self.assertIsNone(msg.lazy_body())
+        filebase = self._switchboard.enqueue(msg)
+        self.assertTrue(self._entry(filebase).endswith(
+            b'From: anne@example.com\n\nFirst line\n'))
+
+    def test_set_payload_unparsed(self):
+        # Changing the body of a message which was never parsed replaces the
+        # original bytes.
+        filebase = self._switchboard.enqueue(mfs(MESSAGE))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        msg.set_payload('A new body.\n')
+        filebase = self._switchboard.enqueue(msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msg.get_payload(), 'A new body.\n')
+
+    def test_set_payload_after_headers(self):
+        # The original bytes of the body are not spliced back in after the
+        # headers were used and the body was changed.
+        msg = LazyMessage(b'From: anne@example.com\nMessage-ID: <ant>\n\n'
+                          b'First line\n')
+        self.assertEqual(msg['message-id'], '<ant>')
+        msg.set_payload('A new body.\n')
+        self.assertIsNone(msg.lazy_body())
+        filebase = self._switchboard.enqueue(msg)
+        self.assertTrue(self._entry(filebase).endswith(
+            b'Message-ID: <ant>\n\nA new body.\n'))
+
+    def test_set_payload_before_parse(self):
+        # Parsing the rest of the message later does not undo the change.
+        msg = LazyMessage(b'From: anne@example.com\n\nFirst line\n')
+        msg.set_payload('A new body.\n')
+        self.assertIsNone(msg.preamble)
+        self.assertEqual(msg.get_payload(), 'A new body.\n')
+        self.assertEqual(msg['from'], 'anne@example.com')
+
+    def _write_legacy(self, msg, msgdata, protocol):
+        filebase = '1.0+' + '0' * 40
+        path = os.path.join(self._tempdir, filebase + '.bak')
+        with open(path, 'wb') as fp:
+            pickle.dump(msg, fp, protocol)
+            pickle.dump(msgdata, fp, protocol)
+        return filebase
+
+    def test_legacy_entry(self):
+        # Queue files written by older versions of Mailman can be read.
+        filebase = self._write_legacy(
+            mfs(MESSAGE), dict(foo=1, _parsemsg=False), 3)
+        self._switchboard.restore(filebase)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata, dict(foo=1))
+
+    def test_legacy_plaintext_entry(self):
+        filebase = self._write_legacy(MESSAGE, dict(_parsemsg=True), 0)
+        self._switchboard.restore(filebase)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['original_size'], len(MESSAGE))
+
+    def test_legacy_recovery(self):
+        # Recovering a legacy backup file upgrades it to the new format.
+        filebase = self._write_legacy(
+            mfs(MESSAGE), dict(foo=1, _parsemsg=False), 3)
+        self._switchboard.recover_backup_files()
+        self.assertTrue(self._entry(filebase).endswith(
+            MESSAGE.encode('ascii')))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msgdata['_bak_count'], 1)
+        self.assertEqual(msgdata['foo'], 1)
+
+
+class TestPriorities(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard('test', self._tempdir)
+        self._msg = mfs(MESSAGE)
+
+    def test_default_priority(self):
+        # Most entries have the default priority, which isn't recorded in
+        # their metadata.
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(filebase_priority(filebase), 5)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertNotIn('priority', msgdata)
+
+    def test_explicit_priority(self):
+        filebase = self._switchboard.enqueue(self._msg, priority=7)
+        self.assertEqual(filebase_priority(filebase), 7)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['priority'], 7)
+
+    def test_bad_priority(self):
+        self.assertRaises(ValueError,
+                          self._switchboard.enqueue, self._msg, priority=10)
+        self.assertRaises(ValueError,
+                          self._switchboard.enqueue, self._msg, priority=-1)
+        self.assertEqual(self._switchboard.files, [])
+
+    def test_digest_priority(self):
+        # Digests have their own priority, which sticks to them when they
+        # move on to the next queue.
+        filebase = self._switchboard.enqueue(self._msg, isdigest=True)
+        self.assertEqual(filebase_priority(filebase), 2)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['priority'], 2)
+
+    def test_notification_priority(self):
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'Welcome')
+        config.push('notification priority', """
+        [priorities]
+        notification: 8
+        """)
+        self.addCleanup(config.pop, 'notification priority')
+        filebase = self._switchboard.enqueue(msg)
+        self.assertEqual(filebase_priority(filebase), 8)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        # The entry is no longer a UserNotification instance, but keeps its
+        # priority.
+        self.assertEqual(msgdata['priority'], 8)
+        filebase = self._switchboard.enqueue(msg, msgdata)
+        self.assertEqual(filebase_priority(filebase), 8)
+
+    def test_list_priority(self):
+        # Postings to a new mailing list follow the configured default
+        # priority.
+        mlist = create_list('ant@example.com')
+        self.assertIsNone(mlist.queue_priority)
+        with configuration('priorities', default=3):
+            filebase = self._switchboard.enqueue(
+                self._msg, priority=mlist.queue_priority)
+        self.assertEqual(filebase_priority(filebase), 3)
+
+    def test_legacy_filebase(self):
+        # Entries queued before there were priorities have the default one.
+        self.assertEqual(filebase_priority('1458000000.0+' + 'a' * 40), 5)
+
+    def test_priority_order(self):
+        # Higher priorities come first, FIFO order within each priority.
+        filebases = [self._switchboard.enqueue(self._msg, priority=priority)
+                     for priority in (2, 5, 7, 5, 2, 7)]
+        self.assertEqual(self._switchboard.files, [
+            filebases[2], filebases[5],
+            filebases[1], filebases[3],
+            filebases[0], filebases[4],
+            ])
+
+    def test_starvation(self):
+        # Entries which have waited for too long come first, whatever their
+        # priority.
+        filebases = [self._switchboard.enqueue(self._msg, priority=priority)
+                     for priority in (2, 2, 7)]
+        later = time.time() + 601
+        with patch('mailman.core.switchboard.time.time', return_value=later):
+            newer = self._switchboard.enqueue(self._msg, priority=9)
+            self.assertEqual(self._switchboard.files, filebases + [newer])
+
+    def test_no_starvation_protection(self):
+        filebases = [self._switchboard.enqueue(self._msg, priority=priority)
+                     for priority in (2, 7)]
+        config.push('no max wait', """
+        [priorities]
+        max_wait: 0s
+        """)
+        self.addCleanup(config.pop, 'no max wait')
+        later = time.time() + 3600
+        with patch('mailman.core.switchboard.time.time', return_value=later):
+            self.assertEqual(self._switchboard.files,
+                             [filebases[1], filebases[0]])
+
+    def test_depths(self):
+        self.assertEqual(self._switchboard.get_depths(), {})
+        for priority in (2, 5, 5, 9):
+            self._switchboard.enqueue(self._msg, priority=priority)
+        self.assertEqual(self._switchboard.get_depths(), {2: 1, 5: 2, 9: 1})
+        filebase = self._switchboard.files[0]
+        self._switchboard.dequeue(filebase)
+        self.assertEqual(self._switchboard.get_depths(), {2: 1, 5: 2})
+        self.assertEqual(self._switchboard.get_depths('.bak'), {9: 1})
+
+    def test_count(self):
+        self.assertEqual(self._switchboard.count(), 0)
+        for priority in (2, 5, 9):
+            self._switchboard.enqueue(self._msg, priority=priority)
+        # Deferred entries are counted too.
+        self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(hours=1))
+        self._switchboard.dequeue(self._switchboard.files[0])
+        self.assertEqual(self._switchboard.count(), 3)
+        self.assertEqual(self._switchboard.count('.bak'), 1)
+
+
+class TestDeferred(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard('test', self._tempdir)
+        self._msg = mfs(MESSAGE)
+
+    def test_deferred(self):
+        # Entries to be delivered later are left out until they are due.
+        later = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(hours=2))
+        sooner = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(hours=1))
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._switchboard.files, [filebase])
+        self.assertEqual(self._switchboard.get_deferred(), [sooner, later])
+        # Two hours later, both are due.
+        future = time.time() + 7201
+        with patch('mailman.core.switchboard.time.time', return_value=future):
+            self.assertEqual(self._switchboard.files,
+                             [filebase, sooner, later])
+            self.assertEqual(self._switchboard.get_deferred(), [])
+
+    def test_past_deliver_after(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, deliver_after=now() - timedelta(hours=1))
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    def test_recover_deferred(self):
+        # Crashed deferred entries are recovered, but stay deferred.
+        filebase = self._switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(hours=1))
+        self._switchboard.dequeue(filebase)
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+        self.assertEqual(self._switchboard.get_deferred('.bak'), [filebase])
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.get_deferred(), [filebase])
+
+    def test_sharded_deferred(self):
+        switchboard = ShardedSwitchboard('test', self._tempdir)
+        filebase = switchboard.enqueue(
+            self._msg, deliver_after=now() + timedelta(hours=1))
+        self.assertEqual(switchboard.files, [])
+        self.assertEqual(switchboard.get_deferred(), [filebase])
+
+
+class TestStoredRecipients(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard('test', self._tempdir)
+        self._msg = mfs(MESSAGE)
+        self._recipients = set(
+            'person{:04}@example.com'.format(i)
+            for i in range(MIN_STORED_RECIPIENTS))
+
+    def _links(self, filebase):
+        return os.stat(self._switchboard.path(filebase, '.rcp')).st_nlink
+
+    def test_few_recipients_inline(self):
+        recipients = set(list(self._recipients)[1:])
+        filebase = self._switchboard.enqueue(self._msg, recipients=recipients)
+        self.assertFalse(os.path.exists(
+            self._switchboard.path(filebase, '.rcp')))
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['recipients'], recipients)
+        self.assertIsInstance(msgdata['recipients'], set)
+
+    def test_stored_recipients(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, dict(recipients=self._recipients))
+        self.assertEqual(sorted(os.listdir(self._tempdir)),
+                         [filebase + '.pck', filebase + '.rcp'])
+        # The addresses aren't in the queue entry itself.
+        with open(self._switchboard.path(filebase), 'rb') as fp:
+            self.assertNotIn(b'person0000@example.com', fp.read())
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        recipients = msgdata['recipients']
+        self.assertIsInstance(recipients, RecipientSet)
+        self.assertEqual(recipients, self._recipients)
+        self.assertEqual(list(recipients), sorted(self._recipients))
+        # The recipients file is closed when the entry is finished.
+        self._switchboard.finish(filebase)
+        self.assertEqual(os.listdir(self._tempdir), [])
+        self.assertRaises(ValueError, list, recipients)
+
+    def test_stored_once(self):
+        # Enqueuing the same metadata again links to the same file.
+        msgdata = dict(recipients=self._recipients)
+        first = self._switchboard.enqueue(self._msg, msgdata)
+        # The caller's recipients are left alone.
+        self.assertIs(msgdata['recipients'], self._recipients)
+        second = self._switchboard.enqueue(self._msg, msgdata)
+        self.assertEqual(self._links(first), 2)
+        self.assertTrue(os.path.samefile(
+            self._switchboard.path(first, '.rcp'),
+            self._switchboard.path(second, '.rcp')))
+        # So does enqueuing a dequeued entry.
+        msg, msgdata = self._switchboard.dequeue(first)
+        third = self._switchboard.enqueue(msg, msgdata)
+        self._switchboard.finish(first)
+        self.assertEqual(self._links(third), 2)
+        msg, msgdata = self._switchboard.dequeue(third)
+        self.assertEqual(msgdata['recipients'], self._recipients)
+
+    def test_changed_recipients(self):
+        # Recipients which were changed since they were enqueued are stored
+        # again.
+        msgdata = dict(recipients=self._recipients)
+        first = self._switchboard.enqueue(self._msg, msgdata)
+        self._recipients.add('anne@example.com')
+        second = self._switchboard.enqueue(self._msg, msgdata)
+        self.assertEqual(self._links(first), 1)
+        self.assertEqual(self._links(second), 1)
+        msg, msgdata = self._switchboard.dequeue(second)
+        self.assertIn('anne@example.com', msgdata['recipients'])
+
+    def test_staged(self):
+        msgdata = dict(recipients=self._recipients)
+        with staged_enqueues():
+            first = self._switchboard.enqueue(self._msg, msgdata)
+            second = self._switchboard.enqueue(self._msg, msgdata)
+            self.assertEqual(os.listdir(self._tempdir), [])
+        self.assertEqual(self._links(first), 2)
+        self.assertEqual(self._links(second), 2)
+
+    def test_subset(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        failures = ['person0003@example.com', 'person0004@example.com',
+                    'person0099@example.com', 'nobody@example.com']
+        subset = msgdata['recipients'].subset(failures)
+        self.assertEqual(subset.runs, [3, 2, 94, 1])
+        retry = self._switchboard.enqueue(msg, recipients=subset)
+        self._switchboard.finish(filebase)
+        self.assertEqual(self._links(retry), 1)
+        msg, msgdata = self._switchboard.dequeue(retry)
+        self.assertEqual(list(msgdata['recipients']), failures[:3])
+
+    def test_preserve(self):
+        bad = config.switchboards['bad']
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase, preserve=True)
+        self.addCleanup(bad.finish, filebase)
+        self.assertEqual(os.listdir(self._tempdir), [])
+        self.assertTrue(os.path.exists(bad.path(filebase, '.rcp')))
+
+    def test_recover(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.recover_backup_files()
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['recipients'], self._recipients)
+
+    def test_sharded(self):
+        switchboard = ShardedSwitchboard('test', self._tempdir)
+        filebase = switchboard.enqueue(self._msg, recipients=self._recipients)
+        self.assertTrue(os.path.exists(switchboard.path(filebase, '.rcp')))
+        msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['recipients'], self._recipients)
+        switchboard.finish(filebase)
+        self.assertEqual(os.listdir(os.path.dirname(
+            switchboard.path(filebase))), [])
+
+    def test_shard_flat_recipients(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        switchboard = ShardedSwitchboard('test', self._tempdir, recover=True)
+        msg, msgdata = switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['recipients'], self._recipients)
+
+
+class TestSharedMessages(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = Switchboard(
+            'test', os.path.join(self._tempdir, 'test'))
+        self._other = Switchboard(
+            'other', os.path.join(self._tempdir, 'other'))
+        self._msg = mfs(MESSAGE + 'x' * MIN_SHARED_MESSAGE + '\n')
+
+    def _message_file(self, switchboard, filebase):
+        return switchboard.path(filebase, '.msg')
+
+    def test_small_message_inline(self):
+        filebase = self._switchboard.enqueue(mfs(MESSAGE))
+        self.assertFalse(os.path.exists(
+            self._message_file(self._switchboard, filebase)))
+
+    def test_shared(self):
+        # A message enqueued several times is only stored once.
+        first = self._switchboard.enqueue(self._msg, listid='a.example.com')
+        second = self._other.enqueue(self._msg, listid='b.example.com')
+        path = self._message_file(self._switchboard, first)
+        self.assertEqual(os.stat(path).st_nlink, 2)
+        self.assertTrue(os.path.samefile(
+            path, self._message_file(self._other, second)))
+        self.assertLess(os.stat(self._switchboard.path(first)).st_size, 1000)
+        # Each entry still has its own metadata.
+        msg, msgdata = self._switchboard.dequeue(first)
+        self.assertEqual(msgdata['listid'], 'a.example.com')
+        self.assertEqual(msg.as_bytes(), self._msg.as_bytes())
+        # The message file goes away along with the last entry.
+        self._switchboard.finish(first)
+        self.assertEqual(os.stat(
+            self._message_file(self._other, second)).st_nlink, 1)
+        msg, msgdata = self._other.dequeue(second)
+        self.assertEqual(msgdata['listid'], 'b.example.com')
+        self.assertEqual(msg['message-id'], '<ant>')
+        self._other.finish(second)
+        self.assertEqual(os.listdir(self._other.queue_directory), [])
+
+    def test_changed_message(self):
+        first = self._switchboard.enqueue(self._msg)
+        self._msg['X-Foo'] = 'bar'
+        second = self._switchboard.enqueue(self._msg)
+        self.assertEqual(os.stat(
+            self._message_file(self._switchboard, first)).st_nlink, 1)
+        msg, msgdata = self._switchboard.dequeue(second)
+        self.assertEqual(msg['x-foo'], 'bar')
+
+    def test_requeue(self):
+        # Dequeued messages which weren't changed are linked to as well.
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        requeued = self._other.enqueue(msg, msgdata)
+        self.assertEqual(os.stat(
+            self._message_file(self._other, requeued)).st_nlink, 2)
+
+    def test_message_file_gone(self):
+        first = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(first)
+        self._switchboard.finish(first)
+        second = self._switchboard.enqueue(self._msg)
+        msg, msgdata = self._switchboard.dequeue(second)
+        self.assertEqual(msg['message-id'], '<ant>')
+
+    def test_staged(self):
+        with staged_enqueues():
+            first = self._switchboard.enqueue(self._msg)
+            second = self._other.enqueue(self._msg)
+        self.assertTrue(os.path.samefile(
+            self._message_file(self._switchboard, first),
+            self._message_file(self._other, second)))
+
+    def test_load_entry(self):
+        # The message file is found next to the entry.
+        filebase = self._switchboard.enqueue(self._msg)
+        with open(self._switchboard.path(filebase), 'rb') as fp:
+            msg, msgdata = load_entry(fp)
+        self.assertEqual(msg.as_bytes(), self._msg.as_bytes())
+
+    def test_recover(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.recover_backup_files()
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['_bak_count'], 1)
+        self.assertEqual(msg.as_bytes(), self._msg.as_bytes())
+
+    def test_preserve(self):
+        bad = config.switchboards['bad']
+        filebase = self._switchboard.enqueue(self._msg)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase, preserve=True)
+        self.addCleanup(bad.finish, filebase)
+        self.assertEqual(os.listdir(self._switchboard.queue_directory), [])
+        with open(bad.path(filebase, '.psv'), 'rb') as fp:
+            msg, msgdata = load_entry(fp)
+        self.assertEqual(msg['message-id'], '<ant>')
+
+    def test_sharded(self):
+        switchboard = ShardedSwitchboard(
+            'sharded', os.path.join(self._tempdir, 'sharded'))
+        first = self._switchboard.enqueue(self._msg)
+        second = switchboard.enqueue(self._msg)
+        self.assertTrue(os.path.samefile(
+            self._message_file(self._switchboard, first),
+            self._message_file(switchboard, second)))
+        msg, msgdata = switchboard.dequeue(second)
+        self.assertEqual(msg['message-id'], '<ant>')
+
+
+class TestFairQueuing(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        # The outgoing queue takes turns by mailing list.
+        self._switchboard = Switchboard('out', self._tempdir)
+        self._msg = mfs(MESSAGE)
+
+    def _enqueue(self, *listids, **kws):
+        return [self._switchboard.enqueue(self._msg, listid=listid, **kws)
+                for listid in listids]
+
+    def test_list_key(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, listid='ant.example.com')
+        self.assertEqual(filebase_list_key(filebase),
+                         list_key('ant.example.com'))
+        self.assertNotEqual(list_key('ant.example.com'),
+                            list_key('bee.example.com'))
+        # Entries without a list id share a key.
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(filebase_list_key(filebase), list_key(None))
+        # Entries queued before the list key was added to the file base
+        # don't have one.
+        self.assertIsNone(filebase_list_key('1458000000.0+' + 'a' * 40))
+
+    def test_take_turns(self):
+        ant = self._enqueue(*['ant.example.com'] * 3)
+        bee = self._enqueue('bee.example.com', 'bee.example.com')
+        cat = self._enqueue('cat.example.com')
+        self.assertEqual(self._switchboard.files, [
+            ant[0], bee[0], cat[0],
+            ant[1], bee[1],
+            ant[2],
+            ])
+
+    def test_priorities_first(self):
+        ant = self._enqueue('ant.example.com', 'ant.example.com', priority=7)
+        bee = self._enqueue('bee.example.com', 'bee.example.com')
+        self.assertEqual(self._switchboard.files, ant + bee)
+
+    def test_fifo_without_fair_queuing(self):
+        config.push('no fair queuing', """
+        [runner.out]
+        fair_queuing: no
+        """)
+        self.addCleanup(config.pop, 'no fair queuing')
+        filebases = self._enqueue(
+            'ant.example.com', 'ant.example.com', 'bee.example.com')
+        self.assertEqual(self._switchboard.files, filebases)
+
+
+class TestShardedSwitchboard(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._switchboard = ShardedSwitchboard('test', self._tempdir)
+        self._msg = mfs(MESSAGE)
+
+    def test_layout(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        when, digest, priority, list_key = filebase.split('+')
+        self.assertEqual(os.listdir(self._tempdir), [digest[:2]])
+        self.assertEqual(
+            os.listdir(os.path.join(self._tempdir, digest[:2])),
+            [filebase + '.pck'])
+
+    def test_dequeue_finish(self):
+        filebase = self._switchboard.enqueue(self._msg, foo=1)
+        msg, msgdata = self._switchboard.dequeue(filebase)
+        self.assertEqual(msgdata['foo'], 1)
+        self.assertEqual(self._switchboard.get_files('.bak'), [filebase])
+        self._switchboard.restore(filebase)
+        self.assertEqual(self._switchboard.files, [filebase])
+        self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase)
+        self.assertEqual(self._switchboard.files, [])
+        self.assertEqual(self._switchboard.get_files('.bak'), [])
+
+    def test_fifo_order(self):
+        # The files of all subdirectories are merged oldest first.
+        filebases = [self._switchboard.enqueue(self._msg, foo=i)
+                     for i in range(20)]
+        self.assertEqual(self._switchboard.files, filebases)
+
+    def test_slices(self):
+        filebases = set(self._switchboard.enqueue(self._msg, foo=i)
+                        for i in range(50))
+        found = []
+        for slice in range(4):
+            switchboard = ShardedSwitchboard('test', self._tempdir, slice, 4)
+            found.extend(switchboard.files)
+        # Every entry is in exactly one slice.
+        self.assertEqual(len(found), 50)
+        self.assertEqual(set(found), filebases)
+        self.assertEqual(self._switchboard.count(), 50)
+        self.assertEqual(switchboard.count(), len(switchboard.files))
+
+    def test_slice_shards(self):
+        # Each slice only looks at its own subdirectories, and none of them
+        # need their files checked.
+        switchboard = ShardedSwitchboard('test', self._tempdir, 1, 4)
+        shards = list(switchboard._shards())
+        self.assertEqual(len(shards), 64)
+        self.assertEqual(shards[0], ('40', False))
+        self.assertEqual(shards[-1], ('7f', False))
+
+    def test_recover_flat_files(self):
+        # Files queued before the queue was sharded are moved into their
+        # subdirectories.
+        flat = Switchboard('test', self._tempdir)
+        queued = flat.enqueue(self._msg, foo=1)
+        backup = flat.enqueue(self._msg, foo=2)
+        flat.dequeue(backup)
+        switchboard = ShardedSwitchboard('test', self._tempdir, recover=True)
+        self.assertEqual(flat.files, [])
+        self.assertEqual(flat.get_files('.bak'), [])
+        self.assertEqual(switchboard.files, [queued, backup])
+        msg, msgdata = switchboard.dequeue(backup)
+        self.assertEqual(msgdata['_bak_count'], 1)
+
+
+class TestWakeup(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self._msg = mfs(MESSAGE)
+
+    def _wait(self, switchboard, timeout):
+        t0 = time.time()
+        switchboard.wait(timeout)
+        return time.time() - t0
+
+    def test_enqueue_without_waiter(self):
+        # Nobody is waiting, so enqueuing just works.
+        switchboard = Switchboard('test', self._tempdir)
+        switchboard.enqueue(self._msg)
+        self.assertEqual(len(switchboard.files), 1)
+
+    def test_wait_times_out(self):
+        switchboard = Switchboard('test', self._tempdir)
+        self.assertGreaterEqual(self._wait(switchboard, 0.2), 0.2)
+
+    def test_enqueue_wakes_waiter(self):
+        reader = Switchboard('test', self._tempdir)
+        # The first wait sets up the wake up pipe.
+        reader.wait(0)
+        self.assertIn('.wakeup-0', os.listdir(self._tempdir))
+        writer = Switchboard('test', self._tempdir)
+        writer.enqueue(self._msg)
+        writer.enqueue(self._msg)
+        self.assertLess(self._wait(reader, 30), 5)
+        # All the notifications were consumed by the first wake up.
+        self.assertGreaterEqual(self._wait(reader, 0.2), 0.2)
+
+    def test_wake_up_own_slice(self):
+        # Only the runner responsible for the new entry's slice is woken up.
+        readers = [Switchboard('test', self._tempdir, slice, 2)
+                   for slice in range(2)]
+        for reader in readers:
+            reader.wait(0)
+        writer = Switchboard('test', self._tempdir, numslices=2)
+        writer._notify('1+' + 'f' * 40)
+        self.assertGreaterEqual(self._wait(readers[0], 0.2), 0.2)
+        self.assertLess(self._wait(readers[1], 30), 5)
+
+    def test_wake_up_own_slice_of_three(self):
+        readers = [Switchboard('test', self._tempdir, slice, 3)
+                   for slice in range(3)]
+        for reader in readers:
+            reader.wait(0)
+        writer = Switchboard('test', self._tempdir, numslices=3)
+        # This is the last bucket of the middle slice.
+        writer._notify('1+aaaa' + '0' * 36)
+        self.assertGreaterEqual(self._wait(readers[2], 0.1), 0.1)
+        self.assertGreaterEqual(self._wait(readers[0], 0.1), 0.1)
+        self.assertLess(self._wait(readers[1], 30), 5)
+
+    def test_wait_ignored_by_queue_files(self):
+        # The wake up pipe is not a queue entry.
+        switchboard = Switchboard('test', self._tempdir)
+        switchboard.wait(0)
+        self.assertEqual(switchboard.files, [])
@@ -0,0 +1,29 @@
+"""Add the queue priority of mailing list postings.
+
+Revision ID: a5e0a3b1c2d4
+Revises: 7b254d88f122
+Create Date: 2016-03-14 10:12:31.518344
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# Revision identifiers, used by Alembic.
+revision = 'a5e0a3b1c2d4'
+down_revision = '7b254d88f122'
+
+
+def upgrade():
+    # Existing mailing lists keep the default priority, which is used for
+    # NULL values.
+    with op.batch_alter_table('mailinglist') as batch_op:
+        batch_op.add_column(
+            sa.Column('queue_priority', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('mailinglist') as batch_op:
+        batch_op.drop_column('queue_priority')
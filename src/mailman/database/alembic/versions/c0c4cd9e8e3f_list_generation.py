@@ -0,0 +1,31 @@
+"""Add the generation of the set of mailing lists.
+
+Revision ID: c0c4cd9e8e3f
+Revises: a5e0a3b1c2d4
+Create Date: 2016-03-21 14:02:47.271902
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+from mailman.database.types import UUID
+
+
+# Revision identifiers, used by Alembic.
+revision = 'c0c4cd9e8e3f'
+down_revision = 'a5e0a3b1c2d4'
+
+
+def upgrade():
+    # The table starts out empty, which is a generation of its own.
+    op.create_table(
+        'listgeneration',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('generation', UUID(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('listgeneration')
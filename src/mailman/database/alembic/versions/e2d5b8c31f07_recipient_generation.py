@@ -0,0 +1,38 @@
+"""Add the membership generations of the mailing lists.
+
+Revision ID: e2d5b8c31f07
+Revises: c0c4cd9e8e3f
+Create Date: 2016-03-29 10:17:05.552613
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+from mailman.database.types import UUID
+
+
+# Revision identifiers, used by Alembic.
+revision = 'e2d5b8c31f07'
+down_revision = 'c0c4cd9e8e3f'
+
+
+def upgrade():
+    # The generations are created as they are needed.
+    op.create_table(
+        'recipientgeneration',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('list_id', sa.Unicode(), nullable=True),
+        sa.Column('generation', UUID(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(
+        op.f('ix_recipientgeneration_list_id'),
+        'recipientgeneration', ['list_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        op.f('ix_recipientgeneration_list_id'),
+        table_name='recipientgeneration')
+    op.drop_table('recipientgeneration')
@@ -18,7 +18,9 @@
 """Common database support."""
 
 import logging
+import threading
 
+from contextlib import contextmanager
 from mailman.config import config
 from mailman.interfaces.database import IDatabase
 from mailman.utilities.string import expand
@@ -39,7 +41,26 @@ class SABaseDatabase:
     """
     def __init__(self):
         self.url = None
-        self.store = None
+        self._store = None
+        self._session = None
+        # The sessions of threads which don't use the main session.
+        self._local = threading.local()
+
+    @property
+    def store(self):
+        """See `IDatabase`."""
+        return getattr(self._local, 'store', self._store)
+
+    @contextmanager
+    def thread_session(self):
+        """See `IDatabase`."""
+        store = self._session()
+        self._local.store = store
+        try:
+            yield store
+        finally:
+            del self._local.store
+            store.close()
 
     def begin(self):
         """See `IDatabase`."""
@@ -103,6 +124,6 @@ class SABaseDatabase:
         # half dozen and all...
         self.url = url
         self.engine = create_engine(url)
-        session = sessionmaker(bind=self.engine)
-        self.store = session()
-        self.store.commit()
+        self._session = sessionmaker(bind=self.engine)
+        self._store = self._session()
+        self._store.commit()
@@ -0,0 +1,51 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the common database support."""
+
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from mailman.config import config
+from mailman.testing.layers import ConfigLayer
+
+
+class TestThreadSession(unittest.TestCase):
+    layer = ConfigLayer
+
+    def test_main_session(self):
+        # Without a session of their own, all threads share the main one.
+        store = config.db.store
+        with ThreadPoolExecutor(1) as executor:
+            self.assertIs(executor.submit(lambda: config.db.store).result(),
+                          store)
+
+    def test_thread_session(self):
+        store = config.db.store
+
+        def use_session():
+            with config.db.thread_session() as session:
+                return session, config.db.store
+        with ThreadPoolExecutor(1) as executor:
+            session, thread_store = executor.submit(use_session).result()
+        self.assertIs(thread_store, session)
+        self.assertIsNot(session, store)
+        # The other threads keep using the main session.
+        self.assertIs(config.db.store, store)
+        with ThreadPoolExecutor(1) as executor:
+            self.assertIs(executor.submit(lambda: config.db.store).result(),
+                          store)
@@ -208,6 +208,9 @@ class TestMigrations(unittest.TestCase):
         with transaction():
             ant = create_list('ant@example.com')
             bee = create_list('bee@example.com')
+            # The mailing lists can't be loaded from the downgraded database.
+            ant_data_path = ant.data_path
+            bee_data_path = bee.data_path
         # Downgrade and verify that the old data paths exist.
         alembic.command.downgrade(alembic_cfg, '47294d3a604')
         self.assertTrue(os.path.exists(
@@ -221,8 +224,8 @@ class TestMigrations(unittest.TestCase):
             os.path.join(config.LIST_DATA_DIR, 'ant@example.com')))
         self.assertFalse(os.path.exists(
             os.path.join(config.LIST_DATA_DIR, 'ant@example.com')))
-        self.assertTrue(os.path.exists(ant.data_path))
-        self.assertTrue(os.path.exists(bee.data_path))
+        self.assertTrue(os.path.exists(ant_data_path))
+        self.assertTrue(os.path.exists(bee_data_path))
 
     def test_7b254d88f122_moderation_action(self):
         mailinglist_table = sa.sql.table(           # noqa
@@ -242,10 +245,13 @@ class TestMigrations(unittest.TestCase):
             )
         user_manager = getUtility(IUserManager)
         with transaction():
-            # Start at the previous revision.
-            alembic.command.downgrade(alembic_cfg, 'd4fbb4fd34ca')
-            # Create a mailing list through the standard API.
+            # Create a mailing list through the standard API.  Later
+            # revisions add columns to the mailinglist table, so this has to
+            # happen before the downgrade.
             ant = create_list('ant@example.com')
+            list_id = ant.list_id
+            default_member_action = ant.default_member_action
+            default_nonmember_action = ant.default_nonmember_action
             # Create some members.
             anne = user_manager.create_address('anne@example.com')
             bart = user_manager.create_address('bart@example.com')
@@ -253,25 +259,26 @@ class TestMigrations(unittest.TestCase):
             dana = user_manager.create_address('dana@example.com')
             # Flush the database to get the last auto-increment id.
             config.db.store.flush()
+            address_ids = [anne.id, bart.id, cris.id, dana.id]
+        anne_id, bart_id, cris_id, dana_id = address_ids
+        with transaction():
+            # Start at the previous revision.
+            alembic.command.downgrade(alembic_cfg, 'd4fbb4fd34ca')
             # Assign some moderation actions to the members created above.
             config.db.store.execute(member_table.insert().values([
-                {'address_id': anne.id, 'role': MemberRole.owner,
-                 'list_id': ant.list_id, 'moderation_action': Action.accept},
-                {'address_id': bart.id, 'role': MemberRole.moderator,
-                 'list_id': ant.list_id, 'moderation_action': Action.accept},
-                {'address_id': cris.id, 'role': MemberRole.member,
-                 'list_id': ant.list_id, 'moderation_action': Action.defer},
-                {'address_id': dana.id, 'role': MemberRole.nonmember,
-                 'list_id': ant.list_id, 'moderation_action': Action.hold},
+                {'address_id': anne_id, 'role': MemberRole.owner,
+                 'list_id': list_id, 'moderation_action': Action.accept},
+                {'address_id': bart_id, 'role': MemberRole.moderator,
+                 'list_id': list_id, 'moderation_action': Action.accept},
+                {'address_id': cris_id, 'role': MemberRole.member,
+                 'list_id': list_id, 'moderation_action': Action.defer},
+                {'address_id': dana_id, 'role': MemberRole.nonmember,
+                 'list_id': list_id, 'moderation_action': Action.hold},
                 ]))
         # Cris and Dana have actions which match the list default action for
         # members and nonmembers respectively.
-        self.assertEqual(
-            ant.members.get_member('cris@example.com').moderation_action,
-            ant.default_member_action)
-        self.assertEqual(
-            ant.nonmembers.get_member('dana@example.com').moderation_action,
-            ant.default_nonmember_action)
+        self.assertEqual(Action.defer, default_member_action)
+        self.assertEqual(Action.hold, default_nonmember_action)
         # Upgrade and check the moderation_actions.   Cris's and Dana's
         # actions have been set to None to fall back to the list defaults.
         alembic.command.upgrade(alembic_cfg, '7b254d88f122')
@@ -279,10 +286,10 @@ class TestMigrations(unittest.TestCase):
             member_table.c.address_id, member_table.c.moderation_action,
             ])).fetchall()
         self.assertEqual(members, [
-            (anne.id, Action.accept),
-            (bart.id, Action.accept),
-            (cris.id, None),
-            (dana.id, None),
+            (anne_id, Action.accept),
+            (bart_id, Action.accept),
+            (cris_id, None),
+            (dana_id, None),
             ])
         # Downgrade and check that Cris's and Dana's actions have been set
         # explicitly.
@@ -291,8 +298,8 @@ class TestMigrations(unittest.TestCase):
             member_table.c.address_id, member_table.c.moderation_action,
             ])).fetchall()
         self.assertEqual(members, [
-            (anne.id, Action.accept),
-            (bart.id, Action.accept),
-            (cris.id, Action.defer),
-            (dana.id, Action.hold),
+            (anne_id, Action.accept),
+            (bart_id, Action.accept),
+            (cris_id, Action.defer),
+            (dana_id, Action.hold),
             ])
@@ -23,7 +23,9 @@ safe pickle deserialization, even if the email package adds additional Message
 attributes.
 """
 
+import re
 import email
+import email.parser
 import email.message
 import email.utils
 
@@ -33,6 +35,8 @@ from mailman.config import config
 
 
 COMMASPACE = ', '
+# The empty line which separates the headers of a message from its body.
+HEADERS_END = re.compile(rb'(?:\A|\n)\r?\n')
 
 
 @public
@@ -105,6 +109,89 @@ class Message(email.message.Message):
         return clean_senders
 
 
+# The attributes of an email.message.Message which are only known after the
+# body of the message has been parsed.
+BODY_ATTRIBUTES = ('_payload', 'preamble', 'epilogue')
+
+
+@public
+class LazyMessage(Message):
+    """A message which is parsed from its bytes only when it is used.
+
+    The headers are parsed the first time any of them is accessed, and the
+    body is only parsed when it is touched.  Messages dequeued by the
+    switchboard are of this type, so runners which only look at the metadata
+    never pay for parsing the message.  Until the body is parsed, the bytes
+    of the body can be used as they are; see `lazy_body()`.
+    """
+
+    def __init__(self, data):
+        # Don't call the base class constructor, since that would set all
+        # the attributes we want to fill in lazily.
+        self.__dict__['_lazy_data'] = data
+
+    def __getattr__(self, name):
+        # This is only called when the attribute does not exist yet.
+        data = self.__dict__.get('_lazy_data')
+        if data is None or (name.startswith('__') and name.endswith('__')):
+            raise AttributeError(name)
+        headersonly = (name not in BODY_ATTRIBUTES)
+        if headersonly and '_headers' in self.__dict__:
+            raise AttributeError(name)
+        if headersonly:
+            # Only decode and parse the bytes up to the first empty line.
+            match = HEADERS_END.search(data)
+            end = (len(data) if match is None else match.end())
+            parsed = email.parser.BytesParser(Message).parsebytes(
+                data[:end], headersonly=True)
+            # Unless a line which is not a header ended the headers, the
+            # body is everything after them.
+            if not parsed._payload:
+                self.__dict__['_lazy_body'] = end
+        else:
+            parsed = email.parser.BytesParser(Message).parsebytes(data)
+        for key, value in parsed.__dict__.items():
+            if headersonly and key in BODY_ATTRIBUTES:
+                continue
+            # Keep any changes which were made after the headers were parsed.
+            if key not in self.__dict__:
+                self.__dict__[key] = value
+        if not headersonly:
+            self.defects = parsed.defects
+            del self.__dict__['_lazy_data']
+            self.__dict__.pop('_lazy_body', None)
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        if name in BODY_ATTRIBUTES and '_lazy_data' in self.__dict__:
+            # Parse the whole message first, so that neither the original
+            # body nor its bytes can take the place of the new value later.
+            getattr(self, name)
+        super().__setattr__(name, value)
+
+    def lazy_body(self):
+        """The bytes of the body, if it hasn't been parsed.
+
+        :return: The bytes following the empty line after the headers, or
+            None if the body was parsed, or if its start is not known.
+        :rtype: bytes
+        """
+        # Make sure the headers are parsed, to find the end of them.
+        self.get_unixfrom()
+        end = self.__dict__.get('_lazy_body')
+        if end is None:
+            return None
+        return self.__dict__['_lazy_data'][end:]
+
+    def __reduce__(self):
+        # Copies and pickles of the message are fully parsed Message objects.
+        self.is_multipart()
+        return (Message, (), self.__dict__.copy())
+
+
 @public
 class MultipartDigestMessage(MIMEMultipart, Message):
     """Mix-in class for MIME digest messages."""
@@ -24,6 +24,7 @@ warning header, or pass it through, depending on the user's preferences.
 """
 
 from email.utils import getaddresses, formataddr
+from mailman.app.senders import resolve_senders
 from mailman.core.i18n import _
 from mailman.interfaces.handler import IHandler
 from zope.interface import implementer
@@ -73,6 +74,9 @@ class AvoidDuplicates:
             # No one was explicitly addressed, so we can't do any dup
             # collapsing
             return
+        # Explicit recipients are often the senders too, whose membership
+        # was already looked up.
+        senders = resolve_senders(mlist, msg, msgdata)
         newrecips = set()
         for r in recips:
             # If this recipient is explicitly addressed...
@@ -81,7 +85,7 @@ class AvoidDuplicates:
                 # If the member wants to receive duplicates, or if the
                 # recipient is not a member at all, they will get a copy.
                 # header.
-                member = mlist.members.get_member(r)
+                member = senders.get_member(r)
                 if member and not member.receive_list_copy:
                     send_duplicate = False
                 # We'll send a duplicate unless the user doesn't wish it.  If
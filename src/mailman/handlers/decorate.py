@@ -45,14 +45,7 @@ def process(mlist, msg, msgdata):
     member = msgdata.get('member')
     if member is not None:
         # Calculate the extra personalization dictionary.
-        recipient = msgdata.get('recipient', member.address.original_email)
-        d['user_address'] = recipient
-        d['user_delivered_to'] = member.address.original_email
-        d['user_language'] = member.preferred_language.description
-        d['user_name'] = (member.user.display_name
-                          if member.user.display_name
-                          else member.address.original_email)
-        d['user_optionsurl'] = member.options_url
+        d.update(member_substitutions(member, msgdata.get('recipient')))
     # Calculate the archiver permalink substitution variables.  This provides
     # the $<archive-name>_url placeholder for every enabled archiver.
     for archiver in IListArchiverSet(mlist).archivers:
@@ -208,6 +201,30 @@ def process(mlist, msg, msgdata):
     msg['Content-Type'] = 'multipart/mixed'
 
 
+@public
+def member_substitutions(member, recipient=None):
+    """The substitutions personalizing the decorations for a member.
+
+    :param member: The member receiving the message.
+    :type member: `IMember`
+    :param recipient: The address the message is delivered to, if not the
+        member's own address.
+    :type recipient: string
+    :return: The $user_* substitutions.
+    :rtype: dictionary
+    """
+    email = member.address.original_email
+    return dict(
+        user_address=(email if recipient is None else recipient),
+        user_delivered_to=email,
+        user_language=member.preferred_language.description,
+        user_name=(member.user.display_name
+                   if member.user.display_name
+                   else email),
+        user_optionsurl=member.options_url,
+        )
+
+
 @public
 def decorate(mlist, uri, extradict=None):
     """Expand the decoration template from its URI."""
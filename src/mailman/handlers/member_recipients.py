@@ -23,10 +23,12 @@ on the `recipients' attribute of the message.  This attribute is used by the
 SendmailDeliver and BulkDeliver modules.
 """
 
+from mailman.app.senders import resolve_senders
 from mailman.config import config
 from mailman.core.i18n import _
+from mailman.core.recipients import RecipientSet
 from mailman.interfaces.handler import IHandler
-from mailman.interfaces.member import DeliveryStatus
+from mailman.interfaces.mailinglist import IListRecipients
 from mailman.interfaces.pipeline import RejectMessage
 from mailman.utilities.string import wrap
 from zope.interface import implementer
@@ -48,7 +50,8 @@ class MemberRecipients:
             return
         # Should the original sender should be included in the recipients list?
         include_sender = True
-        member = mlist.members.get_member(msg.sender)
+        senders = resolve_senders(mlist, msg, msgdata)
+        member = senders.get_member(senders.sender)
         if member and not member.receive_own_postings:
             include_sender = False
         # Support for urgent messages, which bypasses digests and disabled
@@ -78,13 +81,18 @@ Your urgent message to the $mlist.display_name mailing list was not authorized
 for delivery.  The original message as received by Mailman is attached.
 """)
                 raise RejectMessage(wrap(text))
-        # Calculate the regular recipients of the message
-        recipients = set(member.address.email
-                         for member in mlist.regular_members.members
-                         if member.delivery_status == DeliveryStatus.enabled)
+        # Calculate the regular recipients of the message.  They are cached
+        # for big mailing lists.
+        recipients = IListRecipients(mlist).regular_recipients
         # Remove the sender if they don't want to receive their own posts
-        if not include_sender and member.address.email in recipients:
-            recipients.remove(member.address.email)
+        if not include_sender:
+            sender = member.address.email
+            if isinstance(recipients, RecipientSet):
+                # Keep sharing the cached recipients file, and only read it
+                # once.
+                recipients = recipients.excluding([sender])
+            else:
+                recipients.discard(sender)
         # Handle topic classifications
         # XXX: Disabled for now until we fix it properly
         #
@@ -21,11 +21,13 @@ import unittest
 
 from mailman.app.lifecycle import create_list
 from mailman.config import config
+from mailman.core.recipients import RecipientSet
 from mailman.interfaces.member import DeliveryMode, DeliveryStatus, MemberRole
 from mailman.interfaces.usermanager import IUserManager
 from mailman.testing.helpers import (
     configuration, specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 from zope.component import getUtility
 
 
@@ -79,6 +81,26 @@ To: test@example.com
                                                      'bart@example.com',
                                                      'dave@example.com')))
 
+    def test_cached_recipients(self):
+        # The recipients of big mailing lists are cached in a recipients file,
+        # which is still shared when the sender is left out.
+        self._anne.preferences.receive_own_postings = False
+        self._msg.replace_header('From', 'anne@example.com')
+        read = RecipientSet._stored_addresses
+        with patch('mailman.model.recipientcache.MIN_STORED_RECIPIENTS', 4), \
+                patch.object(RecipientSet, '_stored_addresses',
+                             autospec=True, side_effect=read) as reads:
+            msgdata = {}
+            self._process(self._mlist, self._msg, msgdata)
+        # The recipients file is only read once.
+        self.assertEqual(reads.call_count, 1)
+        recipients = msgdata['recipients']
+        self.assertIsInstance(recipients, RecipientSet)
+        self.assertEqual(recipients.runs, [1, 3])
+        self.assertEqual(list(recipients), ['bart@example.com',
+                                            'cris@example.com',
+                                            'dave@example.com'])
+
 
 class TestOwnerRecipients(unittest.TestCase):
     """Test owner recipient calculation."""
@@ -48,6 +48,16 @@ class IDatabase(Interface):
     def abort():
         """Abort the current transaction."""
 
+    def thread_session():
+        """Use a separate database session in the current thread.
+
+        This is a context manager.  Within the block, `store` is a new
+        session of the current thread only, e.g. one of the worker threads of
+        the LMTP server; every other thread keeps using the main session.
+        The new session is closed when the block exits, so objects loaded
+        through it must not be used afterward.
+        """
+
     store = Attribute(
         """The underlying database object on which you can do queries.""")
 
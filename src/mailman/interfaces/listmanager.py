@@ -131,13 +131,16 @@ class IListManager(Interface):
         """
 
     names = Attribute(
-        """An iterator over the fully qualified list names of all mailing
-        lists managed by this list manager.""")
+        """The set of the fully qualified list names of all mailing lists
+        managed by this list manager.
+
+        The set is cached, and only reloaded when a mailing list was created
+        or deleted since, by this or any other process.""")
 
     list_ids = Attribute(
-        """An iterator over the list ids of all mailing lists managed by this
-        list manager.""")
+        """The set of the list ids of all mailing lists managed by this list
+        manager.  It is cached like `names`.""")
 
     name_components = Attribute(
-        """An iterator over the 2-tuple of (list_name, mail_host) for all
-        mailing lists managed by this list manager.""")
+        """The set of 2-tuples of (list_name, mail_host) for all mailing
+        lists managed by this list manager.  It is cached like `names`.""")
@@ -232,12 +232,13 @@ class IMailingList(Interface):
     regular_members = Attribute(
         """An roster of all the IMembers who are to receive regular postings
         (i.e. non-digests) from the mailing list, regardless of whether they
-        have their delivery disabled or not.""")
+        have their delivery disabled or not.  This is an `IDeliveryRoster`.""")
 
     digest_members = Attribute(
         """A roster of all the IMembers who are to receive digests of postings
         to this mailing list, regardless of whether they have their deliver
-        disabled or not, or of the type of digest they are to receive.""")
+        disabled or not, or of the type of digest they are to receive.  This
+        is an `IDeliveryRoster`.""")
 
     subscription_policy = Attribute(
         """The policy for subscribing new members to the list.""")
@@ -441,6 +442,13 @@ class IMailingList(Interface):
         This attribute names a pipeline for postings, which must exist.
         """)
 
+    queue_priority = Attribute(
+        """The queue priority of the postings to this mailing list.
+
+        This is an integer from 0 to 9.  Runners process the queue entries
+        with a higher priority first.  None means the default priority.
+        """)
+
     owner_chain = Attribute(
         """This mailing list's owner moderation chain.
 
@@ -845,6 +853,31 @@ class IListArchiverSet(Interface):
         """
 
 
+@public
+class IListRecipients(Interface):
+    """The recipients of a mailing list's postings and digests.
+
+    The recipients of big mailing lists are cached, and only calculated again
+    when the membership of the mailing list, or the preferences, addresses or
+    users of its members change.
+    """
+
+    regular_recipients = Attribute(
+        """The lower cased email addresses of the regular members whose
+        delivery is enabled.
+
+        This is a set of strings, which is a `RecipientSet` stored in a
+        recipients file for big mailing lists.""")
+
+    digest_recipients = Attribute(
+        """The case preserved email addresses of the digest members whose
+        delivery is enabled.
+
+        This is a 2-tuple of the sets of the members receiving MIME digests
+        (including summary digests) and those receiving plain text
+        digests.""")
+
+
 @public
 class IHeaderMatch(Interface):
     """A mailing list-specific message header matching rule."""
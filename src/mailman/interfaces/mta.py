@@ -29,6 +29,21 @@ class SomeRecipientsFailed(MailmanError):
         self.temporary_failures = temporary_failures
         self.permanent_failures = permanent_failures
 
+    def temporary_subset(self, recipients):
+        """The temporary failures as a subset of the original recipients.
+
+        :param recipients: The recipients delivery was attempted to.
+        :type recipients: sequence of email address strings, or a
+            `RecipientSet`
+        :return: The recipients to retry.  A subset of a stored
+            `RecipientSet` shares its recipients file, and only records which
+            of the recipients in it failed.
+        """
+        subset = getattr(recipients, 'subset', None)
+        if subset is None:
+            return self.temporary_failures
+        return subset(self.temporary_failures)
+
 
 @public
 class IMailTransportAgentAliases(Interface):
@@ -63,6 +63,20 @@ class IRoster(Interface):
         :rtype: `IMember` or None
         """
 
+    def get_members(emails):
+        """Get the members for many addresses at once.
+
+        This is the same as calling ``get_member()`` for every address, but
+        with a few database queries for all of them.  The addresses, users
+        and preferences of the members are loaded along with them.
+
+        :param emails: The email addresses to search for.
+        :type emails: iterable of strings
+        :return: The members found, by email address.  Addresses which are
+            not subscribed are missing.
+        :rtype: dictionary of `IMember`
+        """
+
     def get_memberships(email):
         """Get the memberships for the given address.
 
@@ -71,3 +85,23 @@ class IRoster(Interface):
         :return: All the memberships associated with this email address.
         :rtype: sequence of length 0, 1, or 2 of ``IMember``
         """
+
+
+@public
+class IDeliveryRoster(IRoster):
+    """A roster of the members with a particular kind of delivery."""
+
+    enabled_members = Attribute(
+        """An iterator over the IMembers of this roster whose delivery is
+        enabled.
+
+        The addresses, users and preferences of the members are loaded along
+        with them.""")
+
+    enabled_emails = Attribute(
+        """An iterator over the email addresses of the members of this roster
+        whose delivery is enabled.
+
+        This is like `enabled_members` without creating any IMembers.  The
+        items are 3-tuples of the lower cased email address, the case
+        preserved email address, and the delivery mode of the member.""")
@@ -41,6 +41,9 @@ class ISwitchboard(Interface):
         keyword arguments are added to the metadata dictonary, with precedence
         given to the keyword arguments.
 
+        When the metadata has a `deliver_after` datetime in the future, the
+        entry is deferred until then.
+
         The base name of the message file is returned.
         """
 
@@ -55,6 +58,14 @@ class ISwitchboard(Interface):
         Returned is a 2-tuple of the form (message, metadata).
         """
 
+    def restore(filebase):
+        """Move a dequeued entry back into the queue.
+
+        This undoes .dequeue() for the entry, so that it can be dequeued
+        again.  Unlike .recover_backup_files(), this does not count as a
+        recovery of the entry.
+        """
+
     def finish(filebase, preserve=False):
         """Remove the backup file for filebase.
 
@@ -74,6 +85,56 @@ class ISwitchboard(Interface):
         Only the files in the queue directory that have a matching extension
         are returned.  Like 'files', the base names of the matching files are
         returned.
+
+        The files are returned in the order they should be processed in:
+        higher priority entries first, and entries of the same priority in
+        FIFO order.  Entries which have waited for longer than the configured
+        maximum come first regardless of their priority.  Deferred entries
+        are left out until they are due.
+        """
+
+    def get_deferred(extension='.pck'):
+        """The base names of the deferred entries which are not due yet.
+
+        :param extension: The extension of the files to list.
+        :type extension: str
+        :return: The base names of the matching files, the ones due soonest
+            first.
+        :rtype: list of str
+        """
+
+    def get_depths(extension='.pck'):
+        """Count the queued entries of each priority.
+
+        :param extension: The extension of the files to count.
+        :type extension: str
+        :return: The number of entries, keyed by their priority.  Priorities
+            without any entries are left out.
+        :rtype: dict
+        """
+
+    def count(extension='.pck'):
+        """Count the entries in the queue.
+
+        This is much cheaper than listing them, and includes deferred entries
+        which are not due yet.
+
+        :param extension: The extension of the files to count.
+        :type extension: str
+        :return: The number of entries.
+        :rtype: int
+        """
+
+    def wait(timeout):
+        """Wait for a new entry to be enqueued to this switchboard's slice.
+
+        This returns as soon as some process enqueues an entry to the slice
+        of the queue this switchboard is responsible for, or when `timeout`
+        has elapsed, whichever comes first.  Callers must not assume that
+        there is a new entry when this returns.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
         """
 
     def recover_backup_files():
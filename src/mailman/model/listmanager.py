@@ -17,7 +17,11 @@
 
 """A mailing list manager."""
 
+import uuid
+
+from mailman.database.model import Model
 from mailman.database.transaction import dbconnection
+from mailman.database.types import UUID
 from mailman.interfaces.address import InvalidEmailAddressError
 from mailman.interfaces.listmanager import (
     IListManager, ListAlreadyExistsError, ListCreatedEvent, ListCreatingEvent,
@@ -28,15 +32,68 @@ from mailman.model.mailinglist import (
     IAcceptableAliasSet, ListArchiver, MailingList)
 from mailman.model.mime import ContentFilter
 from mailman.utilities.datetime import now
+from sqlalchemy import Column, Integer
+from zope.component import getUtility
 from zope.event import notify
 from zope.interface import implementer
 
 
+@public
+class ListGeneration(Model):
+    """The generation of the set of mailing lists.
+
+    Every process caches the names and list ids of all the mailing lists,
+    and only has to compare this single value to find out whether another
+    process created or deleted a list since.  A new random generation is
+    picked for every change, so that no generation ever comes back, not even
+    when the table is emptied.
+
+    There is no interface for this class, because it's purely an internal
+    implementation detail.
+    """
+
+    __tablename__ = 'listgeneration'
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(UUID)
+
+
 @public
 @implementer(IListManager)
 class ListManager:
     """An implementation of the `IListManager` interface."""
 
+    def __init__(self):
+        # The generation, and the list names, list ids and name components
+        # of all the mailing lists, or None when they have to be loaded.
+        self._registry = None
+
+    def _invalidate(self):
+        """Forget the cached mailing lists."""
+        self._registry = None
+
+    @dbconnection
+    def _lists(self, store):
+        """The cached generation, names, list ids and name components."""
+        row = store.query(ListGeneration.generation).first()
+        generation = (None if row is None else row[0])
+        registry = self._registry
+        if registry is None or registry[0] != generation:
+            components = frozenset(store.query(MailingList).values(
+                MailingList.list_name, MailingList.mail_host))
+            registry = (
+                generation,
+                frozenset('{}@{}'.format(list_name, mail_host)
+                          for list_name, mail_host in components),
+                frozenset('{}.{}'.format(list_name, mail_host)
+                          for list_name, mail_host in components),
+                components,
+                )
+            # The registry is replaced in one go, so that threads always see
+            # a consistent one.
+            self._registry = registry
+        return registry
+
     @dbconnection
     def create(self, store, fqdn_listname):
         """See `IListManager`."""
@@ -95,28 +152,41 @@ class ListManager:
             MailingList._list_id).all()
 
     @property
-    @dbconnection
-    def names(self, store):
+    def names(self):
         """See `IListManager`."""
-        result_set = store.query(MailingList)
-        for mail_host, list_name in result_set.values(MailingList.mail_host,
-                                                      MailingList.list_name):
-            yield '{}@{}'.format(list_name, mail_host)
+        return self._lists()[1]
 
     @property
-    @dbconnection
-    def list_ids(self, store):
+    def list_ids(self):
         """See `IListManager`."""
-        result_set = store.query(MailingList)
-        for list_id in result_set.values(MailingList._list_id):
-            assert isinstance(list_id, tuple) and len(list_id) == 1
-            yield list_id[0]
+        return self._lists()[2]
 
     @property
-    @dbconnection
-    def name_components(self, store):
+    def name_components(self):
         """See `IListManager`."""
-        result_set = store.query(MailingList)
-        for mail_host, list_name in result_set.values(MailingList.mail_host,
-                                                      MailingList.list_name):
-            yield list_name, mail_host
+        return self._lists()[3]
+
+
+@dbconnection
+def _list_changed(store):
+    """Start a new generation of the set of mailing lists."""
+    generation = uuid.uuid4()
+    updated = store.query(ListGeneration).update(
+        {ListGeneration.generation: generation})
+    if updated == 0:
+        store.add(ListGeneration(generation=generation))
+    getUtility(IListManager)._invalidate()
+
+
+@public
+def handle_ListCreatedEvent(event):
+    if not isinstance(event, ListCreatedEvent):
+        return
+    _list_changed()
+
+
+@public
+def handle_ListDeletedEvent(event):
+    if not isinstance(event, ListDeletedEvent):
+        return
+    _list_changed()
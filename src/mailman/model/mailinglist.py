@@ -168,6 +168,7 @@ class MailingList(Model):
     post_id = Column(Integer)
     posting_chain = Column(Unicode)
     posting_pipeline = Column(Unicode)
+    queue_priority = Column(Integer)
     _preferred_language = Column('preferred_language', Unicode)
     display_name = Column(Unicode)
     reject_these_nonmembers = Column(PickleType)
@@ -58,6 +58,11 @@ class Member(Model):
     preferences = relationship('Preferences')
     user_id = Column(Integer, ForeignKey('user.id'), index=True)
     _user = relationship('User')
+    # This lets the mailing list be loaded along with many members at once.
+    _mailing_list = relationship(
+        'MailingList',
+        primaryjoin='foreign(Member.list_id) == MailingList._list_id',
+        viewonly=True)
 
     def __init__(self, role, list_id, subscriber):
         self._member_id = uid_factory.new()
@@ -87,6 +92,9 @@ class Member(Model):
     @property
     def mailing_list(self):
         """See `IMember`."""
+        # Use the mailing list if it was loaded along with the member.
+        if '_mailing_list' in self.__dict__:
+            return self._mailing_list
         list_manager = getUtility(IListManager)
         return list_manager.get_by_list_id(self.list_id)
 
@@ -124,7 +132,7 @@ class Member(Model):
         """See `IMember`."""
         return (self._user
                 if self._address is None
-                else getUtility(IUserManager).get_user(self._address.email))
+                else self._address.user)
 
     @property
     def subscriber(self):
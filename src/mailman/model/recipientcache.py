@@ -0,0 +1,283 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cached recipients of the mailing lists.
+
+Calculating the recipients of a posting to a big mailing list selects every
+one of its members along with their preferences.  Instead, the regular and
+digest recipients of big mailing lists are kept in recipients files in the
+list's data directory, which all the runner processes share, and are only
+calculated again when the membership changes.
+
+Every mailing list has a membership generation, which is replaced with a new
+random one whenever a member subscribes or unsubscribes, or changes their
+subscribed address.  Changes to the preferences, addresses and users of the
+members, which can affect the recipients of any mailing list, replace a
+global generation instead.  The recipients files are named after both
+generations, so finding the current ones only takes a single query.  Since
+the generations are replaced in the same transaction as the membership
+changes, a process which sees a new membership also sees the new
+generation.
+"""
+
+import os
+import uuid
+
+from contextlib import suppress
+from mailman.core.recipients import RecipientSet
+from mailman.core.switchboard import MIN_STORED_RECIPIENTS
+from mailman.database.model import Model
+from mailman.database.transaction import dbconnection
+from mailman.database.types import UUID
+from mailman.interfaces.listmanager import ListDeletedEvent
+from mailman.interfaces.mailinglist import IListRecipients
+from mailman.interfaces.member import (
+    DeliveryMode, MemberRole, MembershipChangeEvent)
+from mailman.model.address import Address
+from mailman.model.member import Member
+from mailman.model.preferences import Preferences
+from mailman.model.user import User
+from sqlalchemy import Column, Integer, Unicode, or_
+from sqlalchemy.event import listen
+from sqlalchemy.orm import Session, attributes
+from zope.interface import implementer
+
+
+# The prefix of the names of the recipients files in the list data directory.
+PREFIX = 'recipients-'
+# The attributes of the members, their preferences, addresses and users which
+# affect the recipients of a mailing list.
+WATCHED = {
+    Member: frozenset(('_address', '_user')),
+    Preferences: frozenset(('delivery_mode', 'delivery_status')),
+    Address: frozenset(('user', '_original')),
+    User: frozenset(('_preferred_address',)),
+    }
+
+
+@public
+class RecipientGeneration(Model):
+    """The generation of the membership of a mailing list.
+
+    The row without a list id holds the global generation.  Like the
+    generation of the set of mailing lists, a new random generation is picked
+    for every change, so that no generation ever comes back.
+
+    There is no interface for this class, because it's purely an internal
+    implementation detail.
+    """
+
+    __tablename__ = 'recipientgeneration'
+
+    id = Column(Integer, primary_key=True)
+    list_id = Column(Unicode, index=True)
+    generation = Column(UUID)
+
+    @classmethod
+    def __declare_last__(cls):
+        # Watch every flush for changes which may affect the recipients.
+        listen(Session, 'before_flush', _before_flush)
+
+
+def _new_generation(store, list_id):
+    """Start a new generation of a mailing list's membership.
+
+    :param list_id: The list id of the mailing list, or None for the global
+        generation.
+    :return: The new generation.
+    :rtype: `UUID`
+    """
+    generation = uuid.uuid4()
+    # Use the table directly, so that the change is made at once, even while
+    # the session is being flushed.
+    table = RecipientGeneration.__table__
+    result = store.execute(table.update().where(
+        table.c.list_id == list_id).values(generation=generation))
+    if result.rowcount == 0:
+        store.execute(table.insert().values(
+            list_id=list_id, generation=generation))
+    return generation
+
+
+def _changed(instance):
+    """Whether any watched attribute of an instance changed."""
+    for key in WATCHED.get(type(instance), ()):
+        history = attributes.get_history(
+            instance, key, passive=attributes.PASSIVE_NO_INITIALIZE)
+        if history.has_changes():
+            return True
+    return False
+
+
+def _before_flush(session, flush_context, instances):
+    # New members come with a subscription event, and so do the members
+    # of deleted addresses and users.  Only changes to existing objects have
+    # to be looked for.
+    list_ids = set()
+    for instance in session.dirty:
+        if not _changed(instance):
+            continue
+        if isinstance(instance, Member):
+            # Members can change the address they are subscribed with.
+            list_ids.add(instance.list_id)
+        else:
+            list_ids.add(None)
+    for list_id in list_ids:
+        _new_generation(session, list_id)
+
+
+@dbconnection
+def _generations(list_id, store):
+    """The membership generation of a mailing list and the global one."""
+    generations = dict(store.query(
+        RecipientGeneration.list_id, RecipientGeneration.generation).filter(
+            or_(RecipientGeneration.list_id == list_id,
+                RecipientGeneration.list_id == None)))      # noqa: E711
+    for key in (list_id, None):
+        if generations.get(key) is None:
+            # There were no changes yet.
+            generations[key] = _new_generation(store, key)
+    return generations[list_id], generations[None]
+
+
+def _regular(mlist):
+    # The regular recipients are the members' lower cased email addresses.
+    return dict(regular=[
+        email for email, original, delivery_mode
+        in mlist.regular_members.enabled_emails])
+
+
+def _digests(mlist):
+    # Digests are sent to the case preserved addresses of the members.  We
+    # currently treat summary_digests the same as mime_digests.
+    recipients = dict(mime=[], plaintext=[])
+    for email, original, delivery_mode in mlist.digest_members.enabled_emails:
+        if delivery_mode is DeliveryMode.plaintext_digests:
+            recipients['plaintext'].append(original)
+        else:
+            recipients['mime'].append(original)
+    return recipients
+
+
+def _store(path, addresses):
+    """Durably write a recipients file, and read it back."""
+    # Other processes may be writing the same file at the same time, so
+    # don't share the temporary file with them.
+    tmpfile = '{}.{}'.format(path, uuid.uuid4().hex)
+    RecipientSet(addresses).store(tmpfile)
+    os.rename(tmpfile, path)
+    recipients = RecipientSet.stored(0)
+    recipients.bind(path)
+    return recipients
+
+
+def _cached(mlist, calculate, kinds):
+    """Get the cached recipients, or calculate and cache them.
+
+    :param calculate: Calculates the recipients of a mailing list.
+    :type calculate: callable returning a dictionary of lists of addresses
+    :param kinds: The kinds of recipients `calculate` returns.
+    :type kinds: sequence of strings
+    :return: The recipients, by kind.
+    :rtype: dictionary of sets
+    """
+    generation = '{0[0].hex}-{0[1].hex}'.format(_generations(mlist.list_id))
+    paths = {
+        kind: os.path.join(
+            mlist.data_path, '{}{}-{}'.format(PREFIX, kind, generation))
+        for kind in kinds
+        }
+    cached = {}
+    try:
+        for kind in kinds:
+            recipients = RecipientSet.stored(0)
+            recipients.bind(paths[kind])
+            cached[kind] = recipients
+        return cached
+    except FileNotFoundError:
+        # Don't keep the files of the other kinds open.
+        for recipients in cached.values():
+            recipients.close()
+    calculated = calculate(mlist)
+    if all(len(addresses) < MIN_STORED_RECIPIENTS
+           for addresses in calculated.values()):
+        # The recipients of small mailing lists are quickly calculated, and
+        # not worth the files.
+        return {kind: set(addresses) for kind, addresses in calculated.items()}
+    os.makedirs(mlist.data_path, exist_ok=True)
+    cached = {kind: _store(paths[kind], calculated[kind]) for kind in kinds}
+    # Remove the files of earlier generations, but not the temporary files
+    # of other processes.  The queue entries still using the files have links
+    # of their own.
+    current = set(os.path.basename(path) for path in paths.values())
+    for name in os.listdir(mlist.data_path):
+        if (name.startswith(PREFIX) and '.' not in name and
+                name not in current and
+                name[len(PREFIX):].partition('-')[0] in kinds):
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(mlist.data_path, name))
+    return cached
+
+
+@public
+@implementer(IListRecipients)
+class ListRecipients:
+    """See `IListRecipients`."""
+
+    def __init__(self, mailing_list):
+        self._mailing_list = mailing_list
+
+    @property
+    def regular_recipients(self):
+        """See `IListRecipients`."""
+        return _cached(self._mailing_list, _regular, ('regular',))['regular']
+
+    @property
+    def digest_recipients(self):
+        """See `IListRecipients`."""
+        recipients = _cached(
+            self._mailing_list, _digests, ('mime', 'plaintext'))
+        return recipients['mime'], recipients['plaintext']
+
+
+@dbconnection
+def _membership_changed(list_id, store):
+    _new_generation(store, list_id)
+
+
+@dbconnection
+def _list_deleted(list_id, store):
+    table = RecipientGeneration.__table__
+    store.execute(table.delete().where(table.c.list_id == list_id))
+
+
+@public
+def handle_MembershipChangeEvent(event):
+    if not isinstance(event, MembershipChangeEvent):
+        return
+    if event.member.role is MemberRole.member:
+        _membership_changed(event.mlist.list_id)
+
+
+@public
+def handle_ListDeletedEvent(event):
+    if not isinstance(event, ListDeletedEvent):
+        return
+    # The members are unsubscribed while the list is being deleted, so only
+    # forget its generation afterward.
+    listname, at, hostname = event.fqdn_listname.partition('@')
+    _list_deleted('{}.{}'.format(listname, hostname))
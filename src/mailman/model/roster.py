@@ -22,15 +22,90 @@ the ones that fit a particular role.  These are used as the member, owner,
 moderator, and administrator roster filters.
 """
 
+from mailman.core.constants import system_preferences
 from mailman.database.transaction import dbconnection
-from mailman.interfaces.member import DeliveryMode, MemberRole
-from mailman.interfaces.roster import IRoster
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus, MemberRole
+from mailman.interfaces.roster import IDeliveryRoster, IRoster
 from mailman.model.address import Address
 from mailman.model.member import Member
-from sqlalchemy import or_
+from sqlalchemy import func, literal, or_
+from sqlalchemy.orm import aliased, joinedload, subqueryload
 from zope.interface import implementer
 
 
+# The number of addresses looked up by a single query of get_members().  Some
+# databases limit the number of parameters of a query, e.g. SQLite to 999.
+BATCH_SIZE = 500
+# The number of rows fetched at a time when only the email addresses of many
+# members are needed.
+STREAM_SIZE = 1000
+
+
+def _batches(emails):
+    emails = sorted(set(emails))
+    for i in range(0, len(emails), BATCH_SIZE):
+        yield emails[i:i + BATCH_SIZE]
+
+
+def _with_details(query):
+    # Avoid circular imports.
+    from mailman.model.user import User
+    # Load everything delivery needs to know about the members along with
+    # them: their addresses, users and the preferences of all of these, and
+    # the mailing list for the default language.
+    return query.options(
+        joinedload(Member.preferences),
+        joinedload(Member._address).joinedload(Address.preferences),
+        joinedload(Member._address).joinedload(
+            Address.user).joinedload(User.preferences),
+        joinedload(Member._user).joinedload(User.preferences),
+        joinedload(Member._user).joinedload(
+            User._preferred_address).joinedload(Address.preferences),
+        subqueryload(Member._mailing_list),
+        )
+
+
+def _with_preferences(query, *names):
+    # Avoid circular imports.
+    from mailman.model.preferences import Preferences
+    from mailman.model.user import User
+    # Join the preferences which Member._lookup() looks through to a query of
+    # members.  Return the query along with the joined address of the
+    # members, and expressions for the values of the named preferences: the
+    # first one set of the member's, their address's and its user's
+    # preferences, or the system default.
+    member_preferences = aliased(Preferences)
+    address_preferences = aliased(Preferences)
+    user_preferences = aliased(Preferences)
+    subscriber = aliased(User)
+    address = aliased(Address)
+    owner = aliased(User)
+    query = query.outerjoin(
+        member_preferences, Member.preferences_id == member_preferences.id
+        ).outerjoin(
+            subscriber, Member.user_id == subscriber.id
+        ).outerjoin(
+            # Members subscribed by user get their preferred address.
+            address, address.id == func.coalesce(
+                Member.address_id, subscriber._preferred_address_id)
+        ).outerjoin(
+            address_preferences,
+            address.preferences_id == address_preferences.id
+        ).outerjoin(
+            owner, address.user_id == owner.id
+        ).outerjoin(
+            user_preferences, owner.preferences_id == user_preferences.id)
+    values = []
+    for name in names:
+        column = getattr(Preferences, name)
+        values.append(func.coalesce(
+            getattr(member_preferences, name),
+            getattr(address_preferences, name),
+            getattr(user_preferences, name),
+            literal(getattr(system_preferences, name), type_=column.type)))
+    return query, address, values
+
+
 @public
 @implementer(IRoster)
 class AbstractRoster:
@@ -118,6 +193,32 @@ class AbstractRoster:
                 if memberships[0]._address is not None
                 else memberships[1])
 
+    @dbconnection
+    def get_members(self, store, emails):
+        """See ``IRoster``."""
+        # Avoid circular imports.
+        from mailman.model.user import User
+        explicit = {}
+        preferred = {}
+        for batch in _batches(emails):
+            # As in _get_all_memberships(), but for many addresses at once.
+            members_a = store.query(Address.email, Member).filter(
+                Member.list_id == self._mlist.list_id,
+                Member.role == self.role,
+                Address.email.in_(batch),
+                Member.address_id == Address.id)
+            members_u = store.query(Address.email, Member).filter(
+                Member.list_id == self._mlist.list_id,
+                Member.role == self.role,
+                Address.email.in_(batch),
+                Member.user_id == User.id,
+                User._preferred_address_id == Address.id)
+            explicit.update(_with_details(members_a))
+            preferred.update(_with_details(members_u))
+        # By definition, the explicit address membership takes precedence.
+        preferred.update(explicit)
+        return preferred
+
     def get_memberships(self, email):
         """See ``IRoster``."""
         memberships = self._get_all_memberships(email)
@@ -182,36 +283,74 @@ class AdministratorRoster(AbstractRoster):
             Address.email == email,
             Member.address_id == Address.id).one_or_none()
 
+    @dbconnection
+    def get_members(self, store, emails):
+        """See `IRoster`."""
+        members = {}
+        for batch in _batches(emails):
+            query = store.query(Address.email, Member).filter(
+                Member.list_id == self._mlist.list_id,
+                or_(Member.role == MemberRole.moderator,
+                    Member.role == MemberRole.owner),
+                Address.email.in_(batch),
+                Member.address_id == Address.id)
+            members.update(_with_details(query))
+        return members
+
 
 @public
+@implementer(IDeliveryRoster)
 class DeliveryMemberRoster(AbstractRoster):
     """Return all the members having a particular kind of delivery."""
 
     role = MemberRole.member
-
-    @property
-    def member_count(self):
-        """See `IRoster`."""
-        # XXX 2012-03-15 BAW: It would be nice to make this more efficient.
-        # The problem is that you'd have to change the loop in _get_members()
-        # checking the delivery mode to a query parameter.
-        return len(tuple(self.members))
+    # The delivery modes of the members of this roster.
+    delivery_modes = ()
 
     @dbconnection
-    def _get_members(self, store, *delivery_modes):
-        """The set of members for a mailing list, filter by delivery mode.
-
-        :param delivery_modes: The modes to filter on.
-        :type delivery_modes: sequence of `DeliveryMode`.
-        :return: A generator of members.
-        :rtype: generator
+    def _filter(self, store, delivery_status=None):
+        """The members of the mailing list, filtered by delivery mode.
+
+        The preferences are filtered by the database, so this is a single
+        query however many members the mailing list has.
+
+        :param delivery_status: If given, only the members with this
+            delivery status are returned.
+        :type delivery_status: `DeliveryStatus`
+        :return: A query of members, the joined address of the members, and
+            an expression for their delivery mode.
+        :rtype: 3-tuple
         """
-        results = store.query(Member).filter_by(
-            list_id=self._mlist.list_id,
-            role=MemberRole.member)
-        for member in results:
-            if member.delivery_mode in delivery_modes:
-                yield member
+        query = store.query(Member).filter(
+            Member.list_id == self._mlist.list_id,
+            Member.role == MemberRole.member)
+        query, address, (delivery_mode, status) = _with_preferences(
+            query, 'delivery_mode', 'delivery_status')
+        query = query.filter(delivery_mode.in_(self.delivery_modes))
+        if delivery_status is not None:
+            query = query.filter(status == delivery_status)
+        return query, address, delivery_mode
+
+    def _query(self, delivery_status=None):
+        query, address, delivery_mode = self._filter(delivery_status)
+        return query
+
+    @property
+    def enabled_members(self):
+        """See `IDeliveryRoster`."""
+        yield from _with_details(self._query(DeliveryStatus.enabled))
+
+    @property
+    def enabled_emails(self):
+        """See `IDeliveryRoster`."""
+        query, address, delivery_mode = self._filter(DeliveryStatus.enabled)
+        # Only select the columns, so that no members are created, and fetch
+        # the rows in batches, streaming them where the database supports it.
+        query = query.with_entities(
+            address.email,
+            func.coalesce(address._original, address.email),
+            delivery_mode)
+        yield from query.yield_per(STREAM_SIZE)
 
 
 @public
@@ -219,11 +358,7 @@ class RegularMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'regular_members'
-
-    @property
-    def members(self):
-        """See `IRoster`."""
-        yield from self._get_members(DeliveryMode.regular)
+    delivery_modes = (DeliveryMode.regular,)
 
 
 @public
@@ -231,14 +366,11 @@ class DigestMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'digest_members'
-
-    @property
-    def members(self):
-        """See `IRoster`."""
-        yield from self._get_members(
-            DeliveryMode.plaintext_digests,
-            DeliveryMode.mime_digests,
-            DeliveryMode.summary_digests)
+    delivery_modes = (
+        DeliveryMode.plaintext_digests,
+        DeliveryMode.mime_digests,
+        DeliveryMode.summary_digests,
+        )
 
 
 @public
@@ -297,6 +429,11 @@ class Memberships:
         """See `IRoster`."""
         raise NotImplementedError
 
+    @dbconnection
+    def get_members(self, store, emails):
+        """See `IRoster`."""
+        raise NotImplementedError
+
     @dbconnection
     def get_memberships(self, store, address):
         """See `IRoster`."""
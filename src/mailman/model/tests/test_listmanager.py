@@ -32,6 +32,8 @@ from mailman.interfaces.messages import IMessageStore
 from mailman.interfaces.requests import IListRequests
 from mailman.interfaces.subscriptions import ISubscriptionService
 from mailman.interfaces.usermanager import IUserManager
+from mailman.model.listmanager import ListGeneration, ListManager
+from mailman.model.mailinglist import MailingList
 from mailman.model.mime import ContentFilter
 from mailman.testing.helpers import (
     event_subscribers, specialized_message_from_string)
@@ -104,6 +106,57 @@ class TestListManager(unittest.TestCase):
         self.assertIsNone(list_manager.get('ant@example.com'))
 
 
+class TestListRegistry(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._list_manager = getUtility(IListManager)
+        create_list('ant@example.com')
+
+    def test_create_and_delete(self):
+        # Creating and deleting lists updates the cached names at once.
+        self.assertEqual(self._list_manager.names, {'ant@example.com'})
+        mlist = create_list('bee@example.com')
+        self.assertEqual(self._list_manager.names,
+                         {'ant@example.com', 'bee@example.com'})
+        self.assertEqual(self._list_manager.list_ids,
+                         {'ant.example.com', 'bee.example.com'})
+        self._list_manager.delete(mlist)
+        self.assertEqual(self._list_manager.names, {'ant@example.com'})
+        self.assertEqual(self._list_manager.name_components,
+                         {('ant', 'example.com')})
+
+    def test_cached(self):
+        # Lists added behind the list manager's back are not seen until the
+        # generation changes.
+        names = self._list_manager.names
+        config.db.store.add(MailingList('bee@example.com'))
+        self.assertIs(self._list_manager.names, names)
+        self.assertNotIn('bee@example.com', self._list_manager.names)
+
+    def test_other_process(self):
+        # Another process, with its own list manager, sees the lists created
+        # by this one through the changed generation.
+        other = ListManager()
+        self.assertEqual(other.names, {'ant@example.com'})
+        create_list('bee@example.com')
+        self.assertEqual(other.names, {'ant@example.com', 'bee@example.com'})
+        # The same is true when the generation changes without any list
+        # manager being told.
+        config.db.store.add(MailingList('cat@example.com'))
+        config.db.store.query(ListGeneration).update(
+            {ListGeneration.generation: None})
+        self.assertIn('cat.example.com', other.list_ids)
+
+    def test_abort(self):
+        # A list created in an aborted transaction does not linger in the
+        # cache.
+        create_list('bee@example.com')
+        self.assertIn('bee@example.com', self._list_manager.names)
+        config.db.abort()
+        self.assertNotIn('bee@example.com', self._list_manager.names)
+
+
 class TestListLifecycleEvents(unittest.TestCase):
     layer = ConfigLayer
 
@@ -0,0 +1,174 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cached recipients of the mailing lists."""
+
+import os
+import unittest
+
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.core.recipients import RecipientSet
+from mailman.interfaces.listmanager import IListManager
+from mailman.interfaces.mailinglist import IListRecipients
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus
+from mailman.interfaces.usermanager import IUserManager
+from mailman.model.recipientcache import RecipientGeneration
+from mailman.testing.helpers import counted_statements, set_preferred
+from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import now
+from unittest.mock import patch
+from zope.component import getUtility
+
+
+class TestRecipientCache(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        self._user_manager = getUtility(IUserManager)
+        # Cache the recipients of smaller lists, to keep the tests quick.
+        patcher = patch(
+            'mailman.model.recipientcache.MIN_STORED_RECIPIENTS', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self._emails = ['person{:02}@example.com'.format(i)
+                        for i in range(10)]
+        for email in self._emails:
+            self._mlist.subscribe(self._user_manager.create_address(email))
+
+    def _regular(self):
+        return IListRecipients(self._mlist).regular_recipients
+
+    def _files(self):
+        return sorted(name for name in os.listdir(self._mlist.data_path)
+                      if name.startswith('recipients-'))
+
+    def test_small_list(self):
+        # The recipients of small lists are not cached.
+        mlist = create_list('bee@example.com')
+        mlist.subscribe(self._user_manager.get_address(self._emails[0]))
+        recipients = IListRecipients(mlist).regular_recipients
+        self.assertEqual(recipients, {self._emails[0]})
+        self.assertNotIsInstance(recipients, RecipientSet)
+        self.assertEqual(os.listdir(mlist.data_path), [])
+
+    def test_cached(self):
+        recipients = self._regular()
+        self.assertIsInstance(recipients, RecipientSet)
+        self.assertEqual(list(recipients), self._emails)
+        self.assertEqual(len(self._files()), 1)
+        # The cached recipients are only looked up by their generation.
+        config.db.store.expire_all()
+        self.assertEqual(self._mlist.list_id, 'ant.example.com')
+        with counted_statements() as statements:
+            recipients = self._regular()
+            self.assertEqual(list(recipients), self._emails)
+        self.assertEqual(len(statements), 1)
+
+    def test_subscribe(self):
+        self._regular()
+        files = self._files()
+        address = self._user_manager.create_address('anne@example.com')
+        self._mlist.subscribe(address)
+        self.assertIn('anne@example.com', self._regular())
+        # The file of the earlier generation is gone.
+        self.assertEqual(len(self._files()), 1)
+        self.assertNotEqual(self._files(), files)
+
+    def test_unsubscribe(self):
+        self.assertEqual(len(self._regular()), 10)
+        self._mlist.members.get_member(self._emails[0]).unsubscribe()
+        self.assertEqual(sorted(self._regular()), self._emails[1:])
+
+    def test_preferences(self):
+        # Changing the preferences of a member's address changes the
+        # recipients.
+        self.assertEqual(len(self._regular()), 10)
+        address = self._user_manager.get_address(self._emails[0])
+        address.preferences.delivery_status = DeliveryStatus.by_user
+        self.assertEqual(sorted(self._regular()), self._emails[1:])
+        member = self._mlist.members.get_member(self._emails[1])
+        member.preferences.delivery_mode = DeliveryMode.mime_digests
+        self.assertEqual(sorted(self._regular()), self._emails[2:])
+
+    def test_preferred_address(self):
+        # Members subscribed by user get their preferred address.
+        anne = self._user_manager.create_user('anne@example.com')
+        set_preferred(anne)
+        self._mlist.subscribe(anne)
+        self.assertIn('anne@example.com', self._regular())
+        address = self._user_manager.create_address('anne@example.org')
+        address.verified_on = now()
+        anne.link(address)
+        anne.preferred_address = address
+        recipients = self._regular()
+        self.assertNotIn('anne@example.com', recipients)
+        self.assertIn('anne@example.org', recipients)
+
+    def test_digests(self):
+        for email, mode in ((self._emails[0], DeliveryMode.mime_digests),
+                            (self._emails[1], DeliveryMode.plaintext_digests),
+                            (self._emails[2], DeliveryMode.summary_digests)):
+            member = self._mlist.members.get_member(email)
+            member.preferences.delivery_mode = mode
+        address = self._user_manager.create_address('Anne@example.com')
+        member = self._mlist.subscribe(address)
+        member.preferences.delivery_mode = DeliveryMode.mime_digests
+        mime, plaintext = IListRecipients(self._mlist).digest_recipients
+        self.assertEqual(
+            sorted(mime), ['Anne@example.com', self._emails[0],
+                           self._emails[2]])
+        self.assertEqual(list(plaintext), [self._emails[1]])
+        self.assertNotIn(self._emails[0], self._regular())
+
+    def test_missing_file(self):
+        # When one of the recipients files is missing, the others which were
+        # already opened are closed before the recipients are calculated.
+        for email in self._emails:
+            member = self._mlist.members.get_member(email)
+            member.preferences.delivery_mode = DeliveryMode.mime_digests
+        mime, plaintext = IListRecipients(self._mlist).digest_recipients
+        mime.close()
+        plaintext.close()
+        path = os.path.join(self._mlist.data_path, self._files()[1])
+        self.assertIn('plaintext', path)
+        os.remove(path)
+        with patch.object(RecipientSet, 'close', autospec=True,
+                          side_effect=RecipientSet.close) as close:
+            mime, plaintext = IListRecipients(self._mlist).digest_recipients
+        self.assertEqual(close.call_count, 1)
+        self.assertEqual(list(plaintext), [])
+        self.assertEqual(list(mime), self._emails)
+
+    def test_other_process(self):
+        # A change made without telling this process is seen through the
+        # changed generation.
+        recipients = self._regular()
+        config.db.store.query(RecipientGeneration).delete()
+        config.db.store.execute(
+            'DELETE FROM member WHERE address_id = {}'.format(
+                self._user_manager.get_address(self._emails[0]).id))
+        self.assertEqual(len(recipients), 10)
+        self.assertEqual(len(self._regular()), 9)
+
+    def test_list_deleted(self):
+        self.assertEqual(len(self._regular()), 10)
+        getUtility(IListManager).delete(self._mlist)
+        self.assertEqual(
+            config.db.store.query(RecipientGeneration).filter_by(
+                list_id='ant.example.com').count(), 0)
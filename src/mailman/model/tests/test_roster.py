@@ -21,11 +21,13 @@ import unittest
 
 from mailman.app.lifecycle import create_list
 from mailman.interfaces.address import IAddress
-from mailman.interfaces.member import DeliveryMode, MemberRole
+from mailman.interfaces.member import (
+    DeliveryMode, DeliveryStatus, MemberRole)
 from mailman.interfaces.user import IUser
 from mailman.interfaces.usermanager import IUserManager
 from mailman.testing.helpers import set_preferred
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import now
 from zope.component import getUtility
 
 
@@ -120,6 +122,23 @@ class TestMailingListRoster(unittest.TestCase):
         self.assertEqual(self._mlist.digest_members.member_count, 1)
         self.assertEqual(self._mlist.subscribers.member_count, 4)
 
+    def test_get_members(self):
+        # Many members can be looked up at once.
+        self._mlist.subscribe(self._anne, role=MemberRole.owner)
+        self._mlist.subscribe(self._bart, role=MemberRole.moderator)
+        self._mlist.subscribe(self._anne, role=MemberRole.member)
+        emails = ['anne@example.com', 'bart@example.com', 'cris@example.com']
+        members = self._mlist.members.get_members(emails)
+        self.assertEqual(list(members), ['anne@example.com'])
+        self.assertEqual(members['anne@example.com'].role, MemberRole.member)
+        members = self._mlist.administrators.get_members(emails)
+        self.assertEqual(sorted(members),
+                         ['anne@example.com', 'bart@example.com'])
+        self.assertEqual(members['anne@example.com'].role, MemberRole.owner)
+        self.assertEqual(members['bart@example.com'].role,
+                         MemberRole.moderator)
+        self.assertEqual(self._mlist.members.get_members([]), {})
+
 
 class TestMembershipsRoster(unittest.TestCase):
     """Test the memberships roster."""
@@ -191,6 +210,18 @@ class TestMembershipsRoster(unittest.TestCase):
             [record.address.email for record in memberships],
             ['anne@example.com', 'anne@example.com'])
 
+    def test_get_members_as_user_and_address(self):
+        # Like get_member(), get_members() returns the explicit address.
+        self._ant.subscribe(self._anne)
+        members = self._ant.members.get_members(['anne@example.com'])
+        self.assertTrue(IUser.providedBy(
+            members['anne@example.com'].subscriber))
+        self._ant.subscribe(self._anne.preferred_address)
+        members = self._ant.members.get_members(['anne@example.com'])
+        self.assertEqual(members['anne@example.com'].subscriber,
+                         self._anne.preferred_address)
+        self.assertEqual(members['anne@example.com'].user, self._anne)
+
     def test_memberships_users(self):
         self._ant.subscribe(self._anne)
         users = list(self._anne.memberships.users)
@@ -225,3 +256,87 @@ class TestUserRoster(unittest.TestCase):
         self._mlist.subscribe(self._dave)
         member = self._mlist.members.get_member('bart@example.com')
         self.assertEqual(member.user, self._bart)
+
+    def test_get_members(self):
+        # Every member is found by its own address.
+        self._mlist.subscribe(self._anne)
+        self._mlist.subscribe(self._bart)
+        self._mlist.subscribe(self._cris.preferred_address)
+        emails = ['anne@example.com', 'bart@example.com',
+                  'cris@example.com', 'dave@example.com']
+        members = self._mlist.members.get_members(emails)
+        self.assertEqual(sorted(members), emails[:3])
+        for email, member in members.items():
+            self.assertEqual(member.address.email, email)
+            self.assertEqual(member,
+                             self._mlist.members.get_member(email))
+
+    def test_inherited_delivery_mode(self):
+        # The delivery mode of a member is inherited from their address and
+        # their user, whether they are subscribed by address or by user.
+        anne = self._mlist.subscribe(self._anne)
+        bart = self._mlist.subscribe(self._bart.preferred_address)
+        cris = self._mlist.subscribe(self._cris)
+        self._mlist.subscribe(self._dave)
+        self._anne.preferences.delivery_mode = DeliveryMode.mime_digests
+        self._bart.preferences.delivery_mode = DeliveryMode.plaintext_digests
+        self._cris.preferred_address.preferences.delivery_mode = (
+            DeliveryMode.summary_digests)
+        # A member's own preference overrides the inherited ones.
+        self._dave.preferences.delivery_mode = DeliveryMode.mime_digests
+        dave = self._mlist.members.get_member('dave@example.com')
+        dave.preferences.delivery_mode = DeliveryMode.regular
+        self.assertEqual(list(self._mlist.regular_members.members), [dave])
+        self.assertEqual(self._mlist.regular_members.member_count, 1)
+        self.assertEqual(
+            sorted(member.address.email
+                   for member in self._mlist.digest_members.members),
+            ['anne@example.com', 'bart@example.com', 'cris@example.com'])
+        self.assertEqual(self._mlist.digest_members.member_count, 3)
+        for member in (anne, bart, cris):
+            self.assertNotEqual(member.delivery_mode, DeliveryMode.regular)
+
+    def test_enabled_members(self):
+        # Only the members whose delivery is enabled are returned, however
+        # their delivery status is set.
+        self._mlist.subscribe(self._anne)
+        self._mlist.subscribe(self._bart.preferred_address)
+        self._mlist.subscribe(self._cris)
+        self._mlist.subscribe(self._dave)
+        self._anne.preferences.delivery_status = DeliveryStatus.by_user
+        self._bart.preferred_address.preferences.delivery_status = (
+            DeliveryStatus.by_bounces)
+        cris = self._mlist.members.get_member('cris@example.com')
+        cris.preferences.delivery_status = DeliveryStatus.by_moderator
+        # The member's own preference overrides Dave's.
+        self._dave.preferences.delivery_status = DeliveryStatus.by_user
+        dave = self._mlist.members.get_member('dave@example.com')
+        dave.preferences.delivery_status = DeliveryStatus.enabled
+        self.assertEqual(list(self._mlist.regular_members.enabled_members),
+                         [dave])
+        self.assertEqual(list(self._mlist.digest_members.enabled_members), [])
+        self.assertEqual(self._mlist.regular_members.member_count, 4)
+
+    def test_enabled_emails(self):
+        # The email addresses of the enabled members are returned without
+        # the members, along with their delivery mode.
+        self._mlist.subscribe(self._anne)
+        self._mlist.subscribe(self._bart)
+        self._mlist.subscribe(self._cris.preferred_address)
+        self._mlist.subscribe(self._dave)
+        self._bart.preferences.delivery_status = DeliveryStatus.by_user
+        self._cris.preferences.delivery_mode = DeliveryMode.mime_digests
+        address = getUtility(IUserManager).create_address('Elle@example.com')
+        address.verified_on = now()
+        self._dave.link(address)
+        self._dave.preferred_address = address
+        self.assertEqual(
+            sorted(self._mlist.regular_members.enabled_emails), [
+                ('anne@example.com', 'anne@example.com', DeliveryMode.regular),
+                ('elle@example.com', 'Elle@example.com', DeliveryMode.regular),
+                ])
+        self.assertEqual(
+            list(self._mlist.digest_members.enabled_emails), [
+                ('cris@example.com', 'cris@example.com',
+                 DeliveryMode.mime_digests),
+                ])
@@ -24,7 +24,7 @@ import smtplib
 
 from mailman.config import config
 from mailman.interfaces.mta import IMailTransportAgentDelivery
-from mailman.mta.connection import Connection
+from mailman.mta.connection import RenderedMessage, smtp_connection
 from zope.interface import implementer
 
 
@@ -38,12 +38,11 @@ class BaseDelivery:
 
     def __init__(self):
         """Create a basic deliverer."""
-        username = (config.mta.smtp_user if config.mta.smtp_user else None)
-        password = (config.mta.smtp_pass if config.mta.smtp_pass else None)
-        self._connection = Connection(
-            config.mta.smtp_host, int(config.mta.smtp_port),
-            int(config.mta.max_sessions_per_connection),
-            username, password)
+        # This is the outgoing runner's connection pool while it delivers.
+        self._connection = smtp_connection()
+        # The size in bytes of the message as sent to the SMTP server, when
+        # the agent renders it only once.
+        self.message_size = None
 
     def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
         """Low-level delivery to a set of recipients.
@@ -61,10 +60,28 @@ class BaseDelivery:
         """
         # Do the actual sending.
         sender = self._get_sender(mlist, msg, msgdata)
-        message_id = msg['message-id']
+        return self._send(sender, recipients, RenderedMessage(msg),
+                          msg['message-id'])
+
+    def _send(self, sender, recipients, msgtext, message_id):
+        """Send the text of a message to a set of recipients.
+
+        This doesn't touch the message object or the database, so it can be
+        called from several threads at once.
+
+        :param sender: The envelope sender.
+        :type sender: string
+        :param recipients: The recipients of this message.
+        :type recipients: sequence
+        :param msgtext: The message, rendered for sending.
+        :type msgtext: `RenderedMessage`
+        :param message_id: The Message-ID of the message, for logging.
+        :type message_id: string
+        :return: delivery failures as defined by `smtplib.SMTP.sendmail`
+        :rtype: dictionary
+        """
         try:
-            refused = self._connection.sendmail(
-                sender, recipients, msg.as_string())
+            refused = self._connection.sendmail(sender, recipients, msgtext)
         except smtplib.SMTPRecipientsRefused as error:
             log.error('%s recipients refused: %s', message_id, error)
             refused = error.recipients
@@ -140,25 +157,44 @@ class IndividualDelivery(BaseDelivery):
         """
         refused = {}
         recipients = msgdata.get('recipients', set())
+        # See which recipients are members of the mailing list, and squirrel
+        # this information away for use by other modules, such as the
+        # header/footer decorator.  All the members are looked up at once,
+        # along with their users, preferences and languages.
+        members = mlist.members.get_members(recipients)
         for recipient in recipients:
-            log.debug('IndividualDelivery to: %s', recipient)
-            # Make a copy of the original messages and operator on it, since
-            # we're going to munge it repeatedly for each recipient.
-            message_copy = copy.deepcopy(msg)
-            msgdata_copy = msgdata.copy()
-            # Squirrel the current recipient away in the message metadata.
-            # That way the subclass's _get_sender() override can encode the
-            # recipient address in the sender, e.g. for VERP.
-            msgdata_copy['recipient'] = recipient
-            # See if the recipient is a member of the mailing list, and if so,
-            # squirrel this information away for use by other modules, such as
-            # the header/footer decorator.  XXX 2012-03-05 this is probably
-            # highly inefficient on the database.
-            member = mlist.members.get_member(recipient)
-            msgdata_copy['member'] = member
-            for callback in self.callbacks:
-                callback(mlist, message_copy, msgdata_copy)
-            status = self._deliver_to_recipients(
-                mlist, message_copy, msgdata_copy, [recipient])
-            refused.update(status)
+            refused.update(self._deliver_individually(
+                mlist, msg, msgdata, recipient, members.get(recipient)))
         return refused
+
+    def _deliver_individually(self, mlist, msg, msgdata, recipient, member):
+        """Craft a unique message for a recipient and deliver it.
+
+        :param mlist: The mailing list being delivered to.
+        :type mlist: `IMailingList`
+        :param msg: The original message being delivered.
+        :type msg: `Message`
+        :param msgdata: Additional message metadata for this delivery.
+        :type msgdata: dictionary
+        :param recipient: The recipient of this message.
+        :type recipient: string
+        :param member: The recipient's membership of the mailing list, if
+            any.
+        :type member: `IMember`
+        :return: delivery failures as defined by `smtplib.SMTP.sendmail`
+        :rtype: dictionary
+        """
+        log.debug('IndividualDelivery to: %s', recipient)
+        # Make a copy of the original messages and operator on it, since
+        # we're going to munge it repeatedly for each recipient.
+        message_copy = copy.deepcopy(msg)
+        msgdata_copy = msgdata.copy()
+        # Squirrel the current recipient away in the message metadata.  That
+        # way the subclass's _get_sender() override can encode the recipient
+        # address in the sender, e.g. for VERP.
+        msgdata_copy['recipient'] = recipient
+        msgdata_copy['member'] = member
+        for callback in self.callbacks:
+            callback(mlist, message_copy, msgdata_copy)
+        return self._deliver_to_recipients(
+            mlist, message_copy, msgdata_copy, [recipient])
@@ -17,20 +17,25 @@
 
 """Bulk message delivery."""
 
+import time
+import logging
+
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from lazr.config import as_timedelta
+from mailman.config import config
 from mailman.mta.base import BaseDelivery
+from mailman.mta.connection import ConnectionPool, RenderedMessage
+from mailman.utilities.modules import find_name
+
 
+# The resolved destination groups of recipient domains, mapping the domain to
+# the group and the time the entry expires.
+_groups = {}
+# Forget all the groups when there are more domains than this.
+MAX_CACHED_GROUPS = 10000
 
-# A mapping of top-level domains to bucket numbers.  The zeroth bucket is
-# reserved for everything else.  At one time, these were the most common
-# domains.
-CHUNKMAP = dict(
-    com=1,
-    net=2,
-    org=2,
-    edu=3,
-    us=3,
-    ca=3,
-    )
+log = logging.getLogger('mailman.smtp')
 
 
 @public
@@ -54,49 +59,155 @@ class BulkDelivery(BaseDelivery):
         """Split a set of recipients into chunks.
 
         The `max_recipients` argument given to the constructor specifies the
-        maximum number of recipients in each chunk.
+        maximum number of recipients in each chunk.  Recipients are grouped
+        by their destination, i.e. their domain or the group it resolves to
+        (see `[mta]chunk_resolver`), so that the MTA can relay each chunk in
+        as few transactions as possible.  Destinations with more recipients
+        than fit in a chunk get chunks of their own, and the rest are packed
+        together.
 
         :param recipients: The set of recipient email addresses
         :type recipients: sequence of email address strings
         :return: A list of chunks, where each chunk is a set containing no
-            more than `max_recipients` number of addresses.  The chunk can
-            contain fewer, and no packing is guaranteed.
+            more than `max_recipients` number of addresses.  The chunks are
+            always in the same order for the same recipients.
         :rtype: list of sets of strings
         """
         if self._max_recipients <= 0:
             yield set(recipients)
             return
-        # This algorithm was originally suggested by Chuq Von Rospach.  Start
-        # by splitting the recipient addresses into top-level domain buckets,
-        # using the "most common" domains.  Everything else ends up in the
-        # zeroth bucket.
-        by_bucket = {}
+        by_domain = {}
         for address in recipients:
-            localpart, at, domain = address.partition('@')
-            domain_parts = domain.split('.')
-            bucket_number = CHUNKMAP.get(domain_parts[-1], 0)
-            by_bucket.setdefault(bucket_number, set()).add(address)
-        # Fill chunks by sorting the tld values by length.
-        chunk = set()
-        for tld_chunk in sorted(by_bucket.values(), key=len, reverse=True):
-            while tld_chunk:
-                chunk.add(tld_chunk.pop())
-                if len(chunk) == self._max_recipients:
-                    yield chunk
-                    chunk = set()
-            # Every tld bucket starts a new chunk, but only if non-empty
-            if len(chunk) > 0:
-                yield chunk
-                chunk = set()
-        # Be sure to include the last chunk, but only if it's non-empty.
-        if len(chunk) > 0:
-            yield chunk
+            domain = address.rpartition('@')[2].lower()
+            by_domain.setdefault(domain, []).append(address)
+        groups = _resolve(by_domain)
+        by_group = {}
+        for domain, addresses in by_domain.items():
+            by_group.setdefault(groups[domain], []).extend(addresses)
+        # Every full chunk of a group is sent on its own.  What is left of
+        # each group is packed into the fewest chunks, biggest first, using
+        # the first chunk with enough room (i.e. first fit decreasing).
+        # Groups are never split across the packed chunks.
+        rest = []
+        for group in sorted(by_group):
+            addresses = sorted(by_group[group])
+            full = len(addresses) - len(addresses) % self._max_recipients
+            for i in range(0, full, self._max_recipients):
+                yield set(addresses[i:i + self._max_recipients])
+            if full < len(addresses):
+                rest.append(addresses[full:])
+        packed = []
+        for addresses in sorted(rest, key=len, reverse=True):
+            for chunk in packed:
+                if len(chunk) + len(addresses) <= self._max_recipients:
+                    chunk.update(addresses)
+                    break
+            else:
+                packed.append(set(addresses))
+        yield from packed
 
     def deliver(self, mlist, msg, msgdata):
         """See `IMailTransportAgentDelivery`."""
         refused = {}
-        for recipients in self.chunkify(msgdata.get('recipients', set())):
-            chunk_refused = self._deliver_to_recipients(
-                mlist, msg, msgdata, recipients)
-            refused.update(chunk_refused)
+        chunks = list(self.chunkify(msgdata.get('recipients', set())))
+        if len(chunks) == 0:
+            return refused
+        # Every chunk gets the same message from the same sender, so work
+        # them out only once.
+        sender = self._get_sender(mlist, msg, msgdata)
+        msgtext = RenderedMessage(msg)
+        self.message_size = len(msgtext)
+        message_id = msg['message-id']
+        threads = int(config.mta.max_delivery_threads)
+        # Chunks can only be sent at the same time over separate connections,
+        # which only the outgoing runner's connection pool provides.
+        if (threads <= 1 or len(chunks) == 1 or
+                not isinstance(self._connection, ConnectionPool)):
+            for recipients in chunks:
+                refused.update(self._send(
+                    sender, recipients, msgtext, message_id))
+            return refused
+        per_domain = int(config.mta.max_delivery_threads_per_domain)
+        # The chunks which wait for their turn, with the destination group of
+        # their recipients if they all share one.
+        waiting = [(_chunk_group(recipients), recipients)
+                   for recipients in chunks]
+        running = {}
+        busy = Counter()
+        with ThreadPoolExecutor(min(threads, len(chunks))) as executor:
+            while waiting or running:
+                held = []
+                for domain, recipients in waiting:
+                    if len(running) >= threads or (
+                            domain is not None and per_domain > 0 and
+                            busy[domain] >= per_domain):
+                        held.append((domain, recipients))
+                        continue
+                    future = executor.submit(
+                        self._send, sender, recipients, msgtext, message_id)
+                    running[future] = domain
+                    busy[domain] += 1
+                waiting = held
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    busy[running.pop(future)] -= 1
+                    refused.update(future.result())
         return refused
+
+
+def _resolve(domains):
+    """The destination groups of recipient domains.
+
+    Without a `[mta]chunk_resolver`, the group of a domain is just the
+    domain.  Otherwise it is what the resolver returns for the domain, e.g.
+    the names of its MX hosts, so that domains hosted by the same mail
+    servers are chunked together.  The answers are cached for
+    `[mta]chunk_resolver_cache`.  So are failed lookups, which leave a domain
+    in a group of its own, so that a broken resolver doesn't hold up the
+    deliveries.
+
+    :param domains: The lower cased domains.
+    :type domains: iterable of str
+    :return: The group of each domain.
+    :rtype: dict
+    """
+    name = config.mta.chunk_resolver
+    if not name:
+        return {domain: domain for domain in domains}
+    resolver = None
+    current = time.time()
+    groups = {}
+    failed = []
+    for domain in domains:
+        group, expires = _groups.get(domain, (None, 0))
+        if expires <= current:
+            if resolver is None:
+                resolver = find_name(name)
+                lifetime = as_timedelta(
+                    config.mta.chunk_resolver_cache).total_seconds()
+            try:
+                group = resolver(domain)
+            except Exception:
+                if not failed:
+                    log.exception('Cannot resolve the destination of %s',
+                                  domain)
+                failed.append(domain)
+                group = None
+            if not group:
+                group = domain
+            if len(_groups) >= MAX_CACHED_GROUPS:
+                _groups.clear()
+            _groups[domain] = (group, current + lifetime)
+        groups[domain] = group
+    if len(failed) > 1:
+        log.error('Cannot resolve the destinations of %s more domains',
+                  len(failed) - 1)
+    return groups
+
+
+def _chunk_group(recipients):
+    """The destination group all the recipients of a chunk share, if any."""
+    domains = set(address.rpartition('@')[2].lower()
+                  for address in recipients)
+    groups = set(_resolve(domains).values())
+    return (groups.pop() if len(groups) == 1 else None)
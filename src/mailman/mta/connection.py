@@ -17,16 +17,107 @@
 
 """MTA connections."""
 
+import re
+import time
 import logging
 import smtplib
+import threading
 
-from contextlib import suppress
-from lazr.config import as_boolean
+from contextlib import contextmanager, suppress
+from email.generator import BytesGenerator
+from io import BytesIO
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 
 
 log = logging.getLogger('mailman.smtp')
 
+EIGHTBIT = re.compile(rb'[\x80-\xff]')
+
+# The connection pool which new delivery agents use, if any.
+_pool = None
+
+
+def _render(msg, policy):
+    fp = BytesIO()
+    BytesGenerator(fp, mangle_from_=False, maxheaderlen=0,
+                   policy=policy).flatten(msg)
+    return fp.getvalue()
+
+
+def _is_ascii(text):
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+@public
+class RenderedMessage:
+    """A message rendered once for all the SMTP sessions which send it.
+
+    The message is rendered to bytes with CRLF line endings, just as they go
+    over the wire.  When the message needs an extension which the SMTP server
+    doesn't offer, i.e. 8BITMIME for 8-bit content or SMTPUTF8 for UTF-8
+    headers, it is rendered once more with 7-bit transfer encodings.
+    """
+
+    def __init__(self, msg, data=None):
+        """Render the message.
+
+        :param msg: The message.  It can be None when it was already rendered
+            to 7-bit data.
+        :type msg: `Message`
+        :param data: The message as already rendered, if it was.
+        :type data: bytes
+        """
+        self._msg = msg
+        self._lock = threading.Lock()
+        self._sevenbit = None
+        if data is None:
+            data = _render(msg, msg.policy.clone(linesep='\r\n'))
+        end = data.find(b'\r\n\r\n')
+        self._utf8_headers = EIGHTBIT.search(
+            data, 0, len(data) if end < 0 else end) is not None
+        self._eightbit = (self._utf8_headers or
+                          EIGHTBIT.search(data, max(end, 0)) is not None)
+        self.data = memoryview(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def _seven_bit(self):
+        # Several chunks may be sent at the same time.
+        with self._lock:
+            if self._sevenbit is None:
+                self._sevenbit = memoryview(_render(
+                    self._msg, self._msg.policy.clone(
+                        linesep='\r\n', cte_type='7bit')))
+        return self._sevenbit
+
+    def negotiate(self, smtp, envsender, recipients):
+        """The data and MAIL options to send over an SMTP connection.
+
+        :param smtp: The connection to the SMTP server.
+        :type smtp: `smtplib.SMTP`
+        :param envsender: The envelope sender.
+        :param recipients: The envelope recipients.
+        :return: The data of the message, and the options for its MAIL
+            command.
+        :rtype: 2-tuple of memoryview and list of strings
+        """
+        smtp.ehlo_or_helo_if_needed()
+        utf8 = (self._utf8_headers or not _is_ascii(envsender) or
+                not all(_is_ascii(recipient) for recipient in recipients))
+        if utf8 and smtp.has_extn('smtputf8'):
+            return self.data, ['SMTPUTF8', 'BODY=8BITMIME']
+        if not self._eightbit:
+            return self.data, []
+        if not self._utf8_headers and smtp.has_extn('8bitmime'):
+            return self.data, ['BODY=8BITMIME']
+        return self._seven_bit(), []
+
 
 @public
 class Connection:
@@ -58,6 +149,8 @@ class Connection:
         self._password = smtp_pass
         self._session_count = None
         self._connection = None
+        # When the last session on this connection ended.
+        self.last_used = None
 
     def _connect(self):
         """Open a new connection."""
@@ -70,7 +163,11 @@ class Connection:
         self._session_count = self._sessions_per_connection
 
     def sendmail(self, envsender, recipients, msgtext):
-        """Mimic `smtplib.SMTP.sendmail`."""
+        """Mimic `smtplib.SMTP.sendmail`.
+
+        The message can also be a `RenderedMessage`, which is sent with the
+        extensions the SMTP server offers.
+        """
         if as_boolean(config.devmode.enabled):
             # Force the recipients to the specified address, but still deliver
             # to the same number of recipients.
@@ -78,15 +175,21 @@ class Connection:
         if self._connection is None:
             self._connect()
         try:
+            mail_options = []
+            if isinstance(msgtext, RenderedMessage):
+                msgtext, mail_options = msgtext.negotiate(
+                    self._connection, envsender, recipients)
             log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
                       envsender, recipients, len(msgtext))
-            results = self._connection.sendmail(envsender, recipients, msgtext)
+            results = self._connection.sendmail(
+                envsender, recipients, msgtext, mail_options)
         except smtplib.SMTPException:
             # For safety, close this connection.  The next send attempt will
             # automatically re-open it.  Pass the exception on up.
             self.quit()
             raise
         # This session has been successfully completed.
+        self.last_used = time.time()
         self._session_count -= 1
         # By testing exactly for equality to 0, we automatically handle the
         # case for SMTP_MAX_SESSIONS_PER_CONNECTION <= 0 meaning never close
@@ -102,3 +205,145 @@ class Connection:
         with suppress(smtplib.SMTPException):
             self._connection.quit()
         self._connection = None
+
+    def check(self):
+        """Check that the open connection still works.
+
+        The connection is closed if the SMTP server doesn't answer a NOOP
+        command, e.g. because the server closed it after it was idle for too
+        long.  The next message sent opens a new one.
+        """
+        if self._connection is None:
+            return
+        try:
+            code, response = self._connection.noop()
+        except smtplib.SMTPException:
+            code = None
+        if code != 250:
+            log.debug('Discarding connection to %s:%s',
+                      self._host, self._port)
+            self.quit()
+
+
+@public
+class ConnectionPool:
+    """Share connections to the SMTP server between deliveries.
+
+    A delivery takes a `Connection` from the pool for every message it sends
+    and puts it back afterwards, so that consecutive messages are sent over
+    the same connection.  Every connection still honors the maximum number
+    of sessions per connection.  Deliveries in separate threads get separate
+    connections.
+    """
+    def __init__(self, size, check_interval, host, port,
+                 sessions_per_connection, smtp_user=None, smtp_pass=None):
+        """Create a connection pool.
+
+        :param size: The maximum number of idle connections kept open.
+        :type size: int
+        :param check_interval: Idle connections which were last used longer
+            ago than this many seconds are checked before they are used.
+        :type check_interval: float
+        :param host: The host name of the SMTP server to connect to.
+        :param port: The port number of the SMTP server to connect to.
+        :param sessions_per_connection: See `Connection`.
+        :param smtp_user: Optional SMTP authentication user name.
+        :param smtp_pass: Optional SMTP authentication password.
+        """
+        self._size = size
+        self._check_interval = check_interval
+        self._args = (host, port, sessions_per_connection,
+                      smtp_user, smtp_pass)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Take a connection from the pool for the duration of the block.
+
+        If the block raises an exception, the connection may be left in any
+        state, so it is closed instead of being put back into the pool.
+
+        :return: A context manager providing a `Connection`.
+        """
+        with self._lock:
+            connection = (self._idle.pop() if self._idle else None)
+        if connection is None:
+            connection = Connection(*self._args)
+        elif (connection.last_used is not None and
+                time.time() - connection.last_used > self._check_interval):
+            connection.check()
+        try:
+            yield connection
+        except:
+            connection.quit()
+            raise
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(connection)
+                connection = None
+        if connection is not None:
+            connection.quit()
+
+    def sendmail(self, envsender, recipients, msgtext):
+        """Mimic `smtplib.SMTP.sendmail`."""
+        with self.connection() as connection:
+            return connection.sendmail(envsender, recipients, msgtext)
+
+    def quit(self):
+        """Close all the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.quit()
+
+
+def _connection_args():
+    username = (config.mta.smtp_user if config.mta.smtp_user else None)
+    password = (config.mta.smtp_pass if config.mta.smtp_pass else None)
+    return (config.mta.smtp_host, int(config.mta.smtp_port),
+            int(config.mta.max_sessions_per_connection),
+            username, password)
+
+
+@public
+def make_pool():
+    """Create a connection pool as configured in the [mta] section.
+
+    :return: The connection pool, or None if pooling is disabled.
+    :rtype: `ConnectionPool`
+    """
+    size = int(config.mta.smtp_pool_size)
+    if size <= 0:
+        return None
+    check_interval = as_timedelta(
+        config.mta.smtp_pool_check_interval).total_seconds()
+    return ConnectionPool(size, check_interval, *_connection_args())
+
+
+@public
+@contextmanager
+def pooled_connections(pool):
+    """Make new delivery agents use the connection pool within the block.
+
+    :param pool: The connection pool, or None to use a new connection for
+        every delivery agent.
+    :type pool: `ConnectionPool`
+    """
+    global _pool
+    previous, _pool = _pool, pool
+    try:
+        yield
+    finally:
+        _pool = previous
+
+
+@public
+def smtp_connection():
+    """The connection a new delivery agent sends its messages over.
+
+    :return: The current connection pool, or a new `Connection`.
+    """
+    if _pool is not None:
+        return _pool
+    return Connection(*_connection_args())
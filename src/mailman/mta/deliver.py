@@ -17,16 +17,21 @@
 
 """Generic delivery."""
 
+import copy
 import time
 import logging
 
+from collections import ChainMap
 from mailman.config import config
+from mailman.handlers.decorate import member_substitutions
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.mta import SomeRecipientsFailed
 from mailman.mta.base import IndividualDelivery
 from mailman.mta.bulk import BulkDelivery
+from mailman.mta.connection import RenderedMessage
 from mailman.mta.decorating import DecoratingMixin
 from mailman.mta.personalized import PersonalizedMixin
+from mailman.mta.splicing import MessageTemplate, placeholders
 from mailman.mta.verp import VERPMixin
 from mailman.utilities.string import expand
 
@@ -34,6 +39,12 @@ from mailman.utilities.string import expand
 COMMA = ','
 log = logging.getLogger('mailman.smtp')
 
+# The recipient specific values spliced into the messages of a
+# `TemplateDelivery`, besides the To header and the X-Mailman-Copy header.
+MEMBER_KEYS = ('user_address', 'user_delivered_to', 'user_language',
+               'user_name', 'user_optionsurl')
+DUPLICATE_HEADER = b'X-Mailman-Copy: yes\r\n'
+
 
 @public
 class Deliver(VERPMixin, DecoratingMixin, PersonalizedMixin,
@@ -57,6 +68,107 @@ class Deliver(VERPMixin, DecoratingMixin, PersonalizedMixin,
             ])
 
 
+@public
+class TemplateDelivery(Deliver):
+    """Deliver one message to one recipient, without crafting each message.
+
+    The messages are the same as those of `Deliver`.  Instead of copying,
+    decorating and rendering the message for every recipient, the message is
+    rendered twice with placeholders for the recipient specific values, which
+    turns it into a `MessageTemplate`.  The values of each recipient are then
+    spliced into the template.  When that isn't possible, e.g. because the
+    decorations are base64 encoded, or a recipient's values would change the
+    encoding of the message, the messages are crafted one by one.
+    """
+
+    def deliver(self, mlist, msg, msgdata):
+        """See `IMailTransportAgentDelivery`."""
+        recipients = msgdata.get('recipients', set())
+        # Making the template costs about as much as two messages, and other
+        # callbacks may change the messages in ways which can't be spliced.
+        template = None
+        if len(recipients) > 2 and self.callbacks == [
+                self.avoid_duplicates, self.decorate, self.personalize_to]:
+            template = self._make_template(mlist, msg, msgdata)
+        if template is None:
+            return super().deliver(mlist, msg, msgdata)
+        refused = {}
+        members = mlist.members.get_members(recipients)
+        for recipient in recipients:
+            member = members.get(recipient)
+            values = self._splice_values(mlist, msgdata, recipient, member)
+            if values is None:
+                refused.update(self._deliver_individually(
+                    mlist, msg, msgdata, recipient, member))
+                continue
+            log.debug('TemplateDelivery to: %s', recipient)
+            sender = self._get_sender(mlist, msg, ChainMap(
+                dict(recipient=recipient, member=member), msgdata))
+            refused.update(self._send(
+                sender, [recipient],
+                RenderedMessage(None, template.render(values)),
+                msg['message-id']))
+        return refused
+
+    def _make_template(self, mlist, msg, msgdata):
+        keys = ('to', 'x-mailman-copy') + MEMBER_KEYS
+        renderings = []
+        all_values = []
+        for values in placeholders(keys):
+            message_copy = copy.deepcopy(msg)
+            msgdata_copy = msgdata.copy()
+            # Mark the placeholder recipient as a duplicate, so that its
+            # header can be replaced by a placeholder too.
+            msgdata_copy['recipient'] = values['to']
+            msgdata_copy['member'] = None
+            msgdata_copy['add-dup-header'] = {values['to']}
+            # The decoration data given in the metadata takes precedence
+            # over the member's, just as in the decorate handler.
+            decoration_data = {key: values[key] for key in MEMBER_KEYS}
+            decoration_data.update(msgdata.get('decoration-data', {}))
+            msgdata_copy['decoration-data'] = decoration_data
+            for callback in self.callbacks:
+                callback(mlist, message_copy, msgdata_copy)
+            message_copy.replace_header(
+                'X-Mailman-Copy', values['x-mailman-copy'])
+            renderings.append(bytes(RenderedMessage(message_copy).data))
+            values = {key: value.encode('ascii')
+                      for key, value in values.items()}
+            # The whole header goes away for recipients who aren't
+            # duplicates.
+            values['x-mailman-copy'] = DUPLICATE_HEADER.replace(
+                b'yes', values['x-mailman-copy'])
+            all_values.append(values)
+        return MessageTemplate.splice(*(renderings + all_values))
+
+    def _splice_values(self, mlist, msgdata, recipient, member):
+        values = {}
+        if not (msgdata.get('isdigest') or msgdata.get('nodecorate')):
+            # Non-members' messages aren't decorated with their values.
+            if member is None:
+                return None
+            values.update(member_substitutions(member, recipient))
+        if mlist.personalize == Personalization.full:
+            values['to'] = self.personalized_to(recipient, member)
+        for key, value in values.items():
+            # Only plain ASCII values on a single line fit into the template
+            # unchanged.  The decorations also lose trailing whitespace, and
+            # could be empty without the values.
+            if not value or '\n' in value or '\r' in value:
+                return None
+            if key != 'to' and value.endswith(' '):
+                return None
+            try:
+                values[key] = value.encode('ascii')
+            except UnicodeError:
+                return None
+        values['x-mailman-copy'] = (
+            DUPLICATE_HEADER
+            if recipient in msgdata.get('add-dup-header', {})
+            else b'')
+        return values
+
+
 @public
 def deliver(mlist, msg, msgdata):
     """Deliver a message to the outgoing mail server."""
@@ -69,9 +181,9 @@ def deliver(mlist, msg, msgdata):
     # use individual delivery.  If not specified, use bulk delivery.  See the
     # to-outgoing handler for when the 'verp' key is set in the metadata.
     if msgdata.get('verp', False):
-        agent = Deliver()
+        agent = TemplateDelivery()
     elif mlist.personalize != Personalization.none:
-        agent = Deliver()
+        agent = TemplateDelivery()
     else:
         agent = BulkDelivery(int(config.mta.max_recipients))
     log.debug('Using agent: %s', agent)
@@ -86,6 +198,8 @@ def deliver(mlist, msg, msgdata):
     t1 = time.time()
     # Log this posting.
     size = getattr(msg, 'original_size', msgdata.get('original_size'))
+    if size is None:
+        size = agent.message_size
     if size is None:
         size = len(msg.as_string())
     substitutions = dict(
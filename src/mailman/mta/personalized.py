@@ -44,17 +44,33 @@ class PersonalizedMixin:
         # Personalize the To header if the list requests it.
         if mlist.personalize != Personalization.full:
             return
-        recipient = msgdata['recipient']
-        user_manager = getUtility(IUserManager)
-        user = user_manager.get_user(recipient)
-        if user is None:
-            msg.replace_header('To', recipient)
+        msg.replace_header('To', self.personalized_to(
+            msgdata['recipient'], msgdata.get('member')))
+
+    def personalized_to(self, recipient, member=None):
+        """The contents of the To header personalized for the recipient.
+
+        :param recipient: The recipient's address.
+        :type recipient: string
+        :param member: The recipient's membership of the mailing list, if
+            any.  Its user is the one registered with the address, so it
+            doesn't have to be looked up again.
+        :type member: `IMember`
+        :return: The recipient's address, with their real name if they are a
+            user registered with Mailman.
+        :rtype: string
+        """
+        if member is None:
+            user = getUtility(IUserManager).get_user(recipient)
         else:
-            # Convert the unicode name to an email-safe representation.
-            # Create a Header instance for the name so that it's properly
-            # encoded for email transport.
-            name = Header(user.display_name).encode()
-            msg.replace_header('To', formataddr((name, recipient)))
+            user = member.user
+        if user is None:
+            return recipient
+        # Convert the unicode name to an email-safe representation.  Create
+        # a Header instance for the name so that it's properly encoded for
+        # email transport.
+        name = Header(user.display_name).encode()
+        return formataddr((name, recipient))
 
 
 @public
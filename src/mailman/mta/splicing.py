@@ -0,0 +1,122 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Splicing recipient specific values into a rendered message."""
+
+import re
+import uuid
+
+from mailman.mta.connection import EIGHTBIT
+
+
+# Placeholders in the second rendering are longer than any line which could
+# be wrapped by a quoted-printable transfer encoding.
+LONG_PLACEHOLDER = 100
+
+
+@public
+def placeholders(keys):
+    """Make two sets of placeholders for values in a rendered message.
+
+    The placeholders only contain letters and digits, so that they are
+    rendered as they are wherever they occur.  The two sets have different
+    lengths.
+
+    :param keys: The names of the values.
+    :type keys: sequence of strings
+    :return: Two dictionaries mapping the names to placeholder strings.
+    :rtype: 2-tuple of dictionaries
+    """
+    prefix = 'mm' + uuid.uuid4().hex
+    short, long = {}, {}
+    for i, key in enumerate(keys):
+        short[key] = '{}x{}x'.format(prefix, i)
+        long[key] = '{}y{}y'.format(prefix, i).rjust(LONG_PLACEHOLDER, 'z')
+    return short, long
+
+
+@public
+class MessageTemplate:
+    """A rendered message with holes for recipient specific values.
+
+    The template is made from two renderings of the same message, with
+    placeholders of different lengths for the values.  It is only made when
+    the values go into the rendered message unchanged, and don't change
+    anything else.  E.g. placeholders in a base64 encoded body are lost, and
+    placeholders in a quoted-printable encoded body change where its lines
+    are wrapped, so the two renderings can't be spliced into each other.
+    """
+
+    def __init__(self, segments, keys):
+        """Create a template.
+
+        :param segments: The fixed parts of the rendered message.
+        :type segments: list of bytes
+        :param keys: The names of the values between the fixed parts.
+        :type keys: list of strings, one shorter than `segments`
+        """
+        self._segments = segments
+        self._keys = keys
+
+    @classmethod
+    def splice(cls, first, second, first_values, second_values):
+        """Make a template from two renderings of a message.
+
+        :param first: The message rendered with the first values.
+        :type first: bytes
+        :param second: The message rendered with the second values.
+        :type second: bytes
+        :param first_values: The first values, by name.
+        :type first_values: dictionary of bytes
+        :param second_values: The second values, by name.
+        :type second_values: dictionary of bytes
+        :return: The template, or None if the renderings are not the same
+            apart from the values, or if they are not 7-bit.
+        :rtype: `MessageTemplate`
+        """
+        if EIGHTBIT.search(first) is not None:
+            return None
+        names = {value: key for key, value in first_values.items()}
+        pattern = re.compile(b'|'.join(
+            re.escape(value) for value in
+            sorted(first_values.values(), key=len, reverse=True)))
+        segments = []
+        keys = []
+        start = 0
+        for match in pattern.finditer(first):
+            segments.append(first[start:match.start()])
+            keys.append(names[match.group()])
+            start = match.end()
+        segments.append(first[start:])
+        template = cls(segments, keys)
+        if template.render(second_values) != second:
+            return None
+        return template
+
+    def render(self, values):
+        """Render the message with recipient specific values.
+
+        :param values: The values, by name.
+        :type values: dictionary of bytes
+        :return: The rendered message.
+        :rtype: bytes
+        """
+        parts = [self._segments[0]]
+        for key, segment in zip(self._keys, self._segments[1:]):
+            parts.append(values[key])
+            parts.append(segment)
+        return b''.join(parts)
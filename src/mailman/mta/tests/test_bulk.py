@@ -0,0 +1,266 @@
+# Copyright (C) 2016 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test bulk delivery."""
+
+import time
+import unittest
+import threading
+
+from collections import Counter
+from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.mta import bulk
+from mailman.mta.bulk import BulkDelivery
+from mailman.mta.connection import ConnectionPool, pooled_connections
+from mailman.testing.helpers import (
+    LogFileMark, specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+
+
+def tld_chunkify(recipients, max_recipients):
+    # The chunking by top-level domain which bulk delivery used to do.
+    chunkmap = dict(com=1, net=2, org=2, edu=3, us=3, ca=3)
+    by_bucket = {}
+    for address in recipients:
+        bucket = chunkmap.get(address.rpartition('.')[2], 0)
+        by_bucket.setdefault(bucket, set()).add(address)
+    chunk = set()
+    for tld_chunk in sorted(by_bucket.values(), key=len, reverse=True):
+        while tld_chunk:
+            chunk.add(tld_chunk.pop())
+            if len(chunk) == max_recipients:
+                yield chunk
+                chunk = set()
+        if len(chunk) > 0:
+            yield chunk
+            chunk = set()
+
+
+def relayed(chunks):
+    # The number of transactions the MTA needs to relay the chunks, i.e. one
+    # for every domain in every chunk.
+    return sum(len(set(address.rpartition('@')[2] for address in chunk))
+               for chunk in chunks)
+
+
+class TestChunking(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        # A few big domains, and a long tail of small ones.
+        self._recipients = set()
+        for i, domain in enumerate([
+                'example.com', 'example.net', 'example.org', 'example.edu',
+                'example.de', 'example.fr', 'example.jp']):
+            self._recipients.update(
+                'person{}@{}'.format(j, domain) for j in range(450 // (i + 1)))
+        for i in range(300):
+            self._recipients.update(
+                'person{}@example{}.com'.format(j, i) for j in range(i % 4))
+        self.addCleanup(bulk._groups.clear)
+
+    def test_fewer_transactions(self):
+        # Chunking by domain needs no more chunks (i.e. transactions with the
+        # smarthost) than chunking by top-level domain did, and far fewer
+        # transactions to relay them.
+        agent = BulkDelivery(100)
+        chunks = list(agent.chunkify(self._recipients))
+        old_chunks = list(tld_chunkify(set(self._recipients), 100))
+        self.assertLessEqual(len(chunks), len(old_chunks))
+        self.assertLess(relayed(chunks), relayed(old_chunks) * 0.6)
+        self.assertEqual(set().union(*chunks), self._recipients)
+        self.assertTrue(all(0 < len(chunk) <= 100 for chunk in chunks))
+
+    def test_deterministic(self):
+        agent = BulkDelivery(100)
+        chunks = list(agent.chunkify(sorted(self._recipients)))
+        self.assertEqual(
+            list(agent.chunkify(sorted(self._recipients, reverse=True))),
+            chunks)
+
+    def test_resolver(self):
+        # The resolver is asked about every domain only once.
+        resolved = []
+
+        def resolver(domain):
+            resolved.append(domain)
+            if domain.startswith('example1'):
+                return 'mx.example1.com'
+        bulk.resolver = resolver
+        self.addCleanup(delattr, bulk, 'resolver')
+        config.push('resolver', """
+        [mta]
+        chunk_resolver: mailman.mta.bulk.resolver
+        """)
+        self.addCleanup(config.pop, 'resolver')
+        agent = BulkDelivery(100)
+        chunks = list(agent.chunkify(self._recipients))
+        self.assertEqual(set().union(*chunks), self._recipients)
+        self.assertEqual(sorted(resolved), sorted(set(resolved)))
+        self.assertEqual(len(resolved), 232)
+        list(agent.chunkify(self._recipients))
+        self.assertEqual(len(resolved), 232)
+        # The recipients at example1*.com are chunked together, filling one
+        # chunk and spilling into another.
+        example1 = [chunk for chunk in chunks
+                    if any('@example1' in address for address in chunk)]
+        self.assertEqual(len(example1), 2)
+        self.assertTrue(all('@example1' in address
+                            for address in example1[0]))
+
+    def test_resolver_failure(self):
+        # Domains which can't be resolved are grouped on their own.  The
+        # failures are cached and logged once.
+        expected = list(BulkDelivery(100).chunkify(self._recipients))
+        resolved = []
+
+        def resolver(domain):
+            resolved.append(domain)
+            raise OSError
+        bulk.resolver = resolver
+        self.addCleanup(delattr, bulk, 'resolver')
+        config.push('resolver', """
+        [mta]
+        chunk_resolver: mailman.mta.bulk.resolver
+        """)
+        self.addCleanup(config.pop, 'resolver')
+        agent = BulkDelivery(100)
+        mark = LogFileMark('mailman.smtp')
+        self.assertEqual(list(agent.chunkify(self._recipients)), expected)
+        self.assertEqual(len(resolved), 232)
+        self.assertEqual(list(agent.chunkify(self._recipients)), expected)
+        self.assertEqual(len(resolved), 232)
+        log = mark.read()
+        self.assertEqual(log.count('Cannot resolve the destination of'), 1)
+        self.assertIn('Cannot resolve the destinations of 231 more domains',
+                      log)
+
+
+class CountingDelivery(BulkDelivery):
+    """Record how many chunks are sent at the same time."""
+
+    def __init__(self, max_recipients):
+        super().__init__(max_recipients)
+        self._lock = threading.Lock()
+        self.running = Counter()
+        self.most = Counter()
+        self.sent = []
+
+    def _send(self, sender, recipients, msgtext, message_id):
+        domain = list(recipients)[0].partition('@')[2]
+        with self._lock:
+            for key in (domain, None):
+                self.running[key] += 1
+                self.most[key] = max(self.most[key], self.running[key])
+        time.sleep(0.05)
+        with self._lock:
+            for key in (domain, None):
+                self.running[key] -= 1
+            self.sent.extend(recipients)
+        return {}
+
+
+class TestConcurrentChunks(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        config.push('threads', """
+        [mta]
+        max_delivery_threads: 4
+        max_delivery_threads_per_domain: 1
+        """)
+        self.addCleanup(config.pop, 'threads')
+        self._recipients = ['a@example.com', 'b@example.com',
+                            'c@example.com', 'd@example.org']
+
+    def test_domain_limit(self):
+        # At most one chunk for the same domain is sent at a time.
+        with pooled_connections(ConnectionPool(1, 30, 'localhost', 25, 0)):
+            agent = CountingDelivery(1)
+        agent.deliver(self._mlist, self._msg,
+                      dict(recipients=self._recipients))
+        self.assertEqual(sorted(agent.sent), self._recipients)
+        self.assertEqual(agent.most['example.com'], 1)
+        self.assertEqual(agent.most['example.org'], 1)
+        self.assertEqual(agent.most[None], 2)
+
+    def test_without_pool(self):
+        # Without a connection pool, the chunks are sent one at a time.
+        agent = CountingDelivery(1)
+        agent.deliver(self._mlist, self._msg,
+                      dict(recipients=self._recipients))
+        self.assertEqual(sorted(agent.sent), self._recipients)
+        self.assertEqual(agent.most[None], 1)
+
+
+class TestConcurrentDelivery(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        config.push('threads', """
+        [mta]
+        max_delivery_threads: 3
+        """)
+        self.addCleanup(config.pop, 'threads')
+        self._pool = ConnectionPool(
+            3, 30, config.mta.smtp_host, int(config.mta.smtp_port), 0)
+        self.addCleanup(self._pool.quit)
+        self._recipients = set('person{}@example.com'.format(i)
+                               for i in range(10))
+
+    def test_all_chunks_sent(self):
+        with pooled_connections(self._pool):
+            agent = BulkDelivery(2)
+        refused = agent.deliver(self._mlist, self._msg,
+                                dict(recipients=self._recipients))
+        self.assertEqual(refused, {})
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 5)
+        delivered = set()
+        for message in messages:
+            delivered.update(message['x-rcptto'].split(', '))
+        self.assertEqual(delivered, self._recipients)
+        self.assertLessEqual(SMTPLayer.smtpd.get_connection_count(), 3)
+
+    def test_refusals_aggregated(self):
+        # The recipients refused in any of the chunks are returned together.
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 500))
+        SMTPLayer.smtpd.err_queue.put(('rcpt', 500))
+        with pooled_connections(self._pool):
+            agent = BulkDelivery(2)
+        refused = agent.deliver(self._mlist, self._msg,
+                                dict(recipients=self._recipients))
+        self.assertEqual(len(refused), 2)
+        self.assertLessEqual(set(refused), self._recipients)
+        for code, message in refused.values():
+            self.assertEqual(code, 500)
+        SMTPLayer.smtpd.clear()
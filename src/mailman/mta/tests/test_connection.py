@@ -17,10 +17,15 @@
 
 """Test MTA connections."""
 
+import socket
 import unittest
 
+from email import message_from_bytes
 from mailman.config import config
-from mailman.mta.connection import Connection
+from mailman.email.message import Message
+from mailman.mta.connection import (
+    Connection, ConnectionPool, RenderedMessage)
+from mailman.testing.helpers import specialized_message_from_string as mfs
 from mailman.testing.layers import SMTPLayer
 from smtplib import SMTPAuthenticationError
 
@@ -57,3 +62,142 @@ Subject: aardvarks
 """)
         self.assertEqual(self.layer.smtpd.get_authentication_credentials(),
                          'AHRlc3R1c2VyAHRlc3RwYXNz')
+
+
+class TestConnectionPool(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._pool = ConnectionPool(
+            1, 30, config.mta.smtp_host, int(config.mta.smtp_port), 2)
+        self.addCleanup(self._pool.quit)
+
+    def _send(self):
+        self._pool.sendmail('anne@example.com', ['bart@example.com'], """\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+""")
+
+    def test_sessions_per_connection(self):
+        # Pooled connections still honor the maximum number of sessions.
+        for i in range(3):
+            self._send()
+        self.assertEqual(self.layer.smtpd.get_connection_count(), 2)
+
+    def test_health_check(self):
+        # Connections which were idle for a while are checked before they
+        # are used, and replaced if they don't work anymore.
+        self._send()
+        with self._pool.connection() as connection:
+            connection.last_used -= 60
+            # Pretend the server dropped the connection.
+            connection._connection.sock.shutdown(socket.SHUT_RDWR)
+        self._send()
+        self.assertEqual(self.layer.smtpd.get_connection_count(), 2)
+        self.assertEqual(len(list(self.layer.smtpd.messages)), 2)
+
+    def test_recent_connections_unchecked(self):
+        # A connection which was used recently is not checked.
+        self._send()
+        with self._pool.connection() as connection:
+            connection._connection.noop = None
+        self._send()
+        self.assertEqual(self.layer.smtpd.get_connection_count(), 1)
+
+    def test_failed_block(self):
+        # A connection is closed and not put back into the pool when the
+        # block using it fails.
+        self._send()
+        with self.assertRaises(RuntimeError):
+            with self._pool.connection() as connection:
+                raise RuntimeError
+        self.assertIsNone(connection._connection)
+        self.assertEqual(self._pool._idle, [])
+        self._send()
+        self.assertEqual(self.layer.smtpd.get_connection_count(), 2)
+
+    def test_failed_sendmail(self):
+        # Likewise when sending the message fails.
+        self._send()
+        with self._pool.connection() as connection:
+            pass
+        with self.assertRaises(UnicodeError):
+            self._pool.sendmail('anne@example.com', ['bart@example.com'],
+                                'Subject: \u00e4\n\n')
+        self.assertIsNone(connection._connection)
+        self.assertEqual(self._pool._idle, [])
+
+
+class TestRenderedMessage(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._connection = Connection(
+            config.mta.smtp_host, int(config.mta.smtp_port), 0)
+        self.addCleanup(self._connection.quit)
+
+    def _message(self, subject='aardvarks'):
+        return message_from_bytes("""\
+From: anne@example.com
+To: bart@example.com
+Subject: {}
+MIME-Version: 1.0
+Content-Type: text/plain; charset="utf-8"
+Content-Transfer-Encoding: 8bit
+
+Zoë's aardvarks
+""".format(subject).encode('utf-8'), Message)
+
+    def _send(self, msg):
+        self._connection.sendmail(
+            'anne@example.com', ['bart@example.com'], RenderedMessage(msg))
+        messages = list(self.layer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        return messages[0]
+
+    def test_render(self):
+        # The message is rendered with CRLF line endings.
+        msg = mfs("""\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+Aardvarks
+""")
+        rendered = RenderedMessage(msg)
+        self.assertEqual(rendered.data, msg.as_string().replace(
+            '\n', '\r\n').encode('ascii'))
+        self.assertEqual(len(rendered), len(msg.as_string()) + 5)
+        received = self._send(msg)
+        self.assertEqual(received.get_payload(), 'Aardvarks')
+
+    def test_8bitmime(self):
+        # 8-bit content is sent as is when the server supports 8BITMIME.
+        self.layer.smtpd.server.extensions = ['8BITMIME']
+        received = self._send(self._message())
+        # The test server decodes the raw bytes it receives as UTF-8.
+        self.assertEqual(received['content-transfer-encoding'], '8bit')
+        self.assertEqual(received.get_payload(), "Zoë's aardvarks")
+
+    def test_no_8bitmime(self):
+        # Otherwise the content is encoded.
+        received = self._send(self._message())
+        self.assertEqual(received['content-transfer-encoding'], 'base64')
+        self.assertEqual(received.get_payload(decode=True).decode('utf-8'),
+                         "Zoë's aardvarks\n")
+
+    def test_smtputf8(self):
+        # UTF-8 headers are sent as is when the server supports SMTPUTF8.
+        self.layer.smtpd.server.extensions = ['8BITMIME', 'SMTPUTF8']
+        received = self._send(self._message('Zoë'))
+        self.assertEqual(received['subject'], 'Zoë')
+        self.assertEqual(received['content-transfer-encoding'], '8bit')
+
+    def test_no_smtputf8(self):
+        # Otherwise the headers are encoded too.
+        self.layer.smtpd.server.extensions = ['8BITMIME']
+        received = self._send(self._message('Zoë'))
+        self.assertEqual(received['subject'], '=?unknown-8bit?q?Zo=C3=AB?=')
+        self.assertEqual(received['content-transfer-encoding'], 'base64')
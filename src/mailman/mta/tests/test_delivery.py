@@ -25,9 +25,9 @@ import unittest
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.interfaces.mailinglist import Personalization
-from mailman.mta.deliver import Deliver
+from mailman.mta.deliver import Deliver, TemplateDelivery
 from mailman.testing.helpers import (
-    specialized_message_from_string as mfs, subscribe)
+    counted_statements, specialized_message_from_string as mfs, subscribe)
 from mailman.testing.layers import ConfigLayer
 
 
@@ -126,3 +126,177 @@ name     : Anne Person
 options  : http://example.com/anne@example.org
 
 """)
+
+
+class CapturingMixin:
+    """Capture the messages instead of sending them."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = {}
+        self.crafted = set()
+
+    def _deliver_individually(self, mlist, msg, msgdata, recipient, member):
+        self.crafted.add(recipient)
+        return super()._deliver_individually(
+            mlist, msg, msgdata, recipient, member)
+
+    def _send(self, sender, recipients, msgtext, message_id):
+        self.sent[recipients[0]] = (sender, bytes(msgtext.data))
+        return {}
+
+
+class CapturingDeliver(CapturingMixin, Deliver):
+    pass
+
+
+class CapturingTemplateDelivery(CapturingMixin, TemplateDelivery):
+    pass
+
+
+class TestTemplateDelivery(unittest.TestCase):
+    """Test personalized delivery by splicing values into a template."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._mlist.personalize = Personalization.full
+        subscribe(self._mlist, 'Anne', email='anne@example.org')
+        subscribe(self._mlist, 'Bart', email='bart@example.org')
+        cris = subscribe(self._mlist, 'Cris', email='cris@example.org')
+        cris.user.display_name = 'Cris Zoë'
+        self._recipients = ['anne@example.org', 'bart@example.org',
+                            'cris@example.org', 'dave@example.org']
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+
+A message.
+""")
+        self._template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._template_dir)
+        path = os.path.join(self._template_dir,
+                            'site', 'en', 'member-footer.txt')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            print("""\
+address  : $user_address
+delivered: $user_delivered_to
+language : $user_language
+name     : $user_name
+options  : $user_optionsurl
+""", file=fp)
+        config.push('templates', """
+        [paths.testing]
+        template_dir: {0}
+        """.format(self._template_dir))
+        self.addCleanup(config.pop, 'templates')
+        self._mlist.footer_uri = 'mailman:///member-footer.txt'
+        self.maxDiff = None
+
+    def _deliver(self, msgdata):
+        crafting = CapturingDeliver()
+        crafting.deliver(self._mlist, self._msg, msgdata.copy())
+        splicing = CapturingTemplateDelivery()
+        splicing.deliver(self._mlist, self._msg, msgdata.copy())
+        self.assertEqual(sorted(splicing.sent), self._recipients)
+        for recipient in self._recipients:
+            self.assertEqual(splicing.sent[recipient],
+                             crafting.sent[recipient])
+        return splicing
+
+    def test_same_messages(self):
+        # The spliced messages are exactly the same as the crafted ones.
+        agent = self._deliver(dict(
+            recipients=self._recipients, verp=True,
+            **{'add-dup-header': {'bart@example.org'}}))
+        # The messages to Cris, whose name is not ASCII, and to the
+        # non-member Dave are crafted.
+        self.assertEqual(agent.crafted,
+                         {'cris@example.org', 'dave@example.org'})
+        sender, data = agent.sent['bart@example.org']
+        self.assertEqual(sender, 'test-bounces+bart=example.org@example.com')
+        self.assertIn(b'\r\nTo: Bart Person <bart@example.org>\r\n', data)
+        self.assertIn(b'\r\nX-Mailman-Copy: yes\r\n', data)
+        self.assertIn(b'\r\nname     : Bart Person\r\n', data)
+        sender, data = agent.sent['anne@example.org']
+        self.assertNotIn(b'X-Mailman-Copy', data)
+
+    def test_not_fully_personalized(self):
+        self._mlist.personalize = Personalization.individual
+        agent = self._deliver(dict(recipients=self._recipients))
+        self.assertEqual(agent.crafted,
+                         {'cris@example.org', 'dave@example.org'})
+        sender, data = agent.sent['anne@example.org']
+        self.assertIn(b'\r\nTo: test@example.com\r\n', data)
+
+    def test_not_decorated(self):
+        # Without decorations, the messages to non-members are spliced too.
+        agent = self._deliver(dict(recipients=self._recipients,
+                                   nodecorate=True))
+        self.assertEqual(agent.crafted, set())
+
+    def test_query_count(self):
+        # The number of database queries doesn't grow with the number of
+        # recipients.
+        self._recipients.remove('cris@example.org')
+        # The first delivery creates the list's archivers.
+        CapturingTemplateDelivery().deliver(
+            self._mlist, self._msg, dict(recipients=self._recipients))
+        config.db.commit()
+        with counted_statements() as few:
+            agent = CapturingTemplateDelivery()
+            agent.deliver(self._mlist, self._msg,
+                          dict(recipients=self._recipients))
+        for name in ('Elle', 'Fred', 'Gwen', 'Herb'):
+            email = '{}@example.org'.format(name.lower())
+            subscribe(self._mlist, name, email=email)
+            self._recipients.append(email)
+        config.db.commit()
+        with counted_statements() as statements:
+            agent = CapturingTemplateDelivery()
+            agent.deliver(self._mlist, self._msg,
+                          dict(recipients=self._recipients))
+        self.assertEqual(len(agent.sent), 7)
+        self.assertEqual(len(statements), len(few))
+
+    def test_multipart(self):
+        # The footer is added as a separate MIME part.  Footers which are not
+        # ASCII can't be added to the parts of a list in English.
+        self._recipients.remove('cris@example.org')
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+A message.
+--BOUNDARY--
+""")
+        agent = self._deliver(dict(recipients=self._recipients))
+        self.assertEqual(agent.crafted, {'dave@example.org'})
+
+    def test_encoded_footer(self):
+        # When the footer is base64 encoded with the rest of the message,
+        # all the messages are crafted.
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+MIME-Version: 1.0
+Content-Type: text/plain; charset="utf-8"
+Content-Transfer-Encoding: base64
+
+QSBtZXNzYWdlIGZyb20gWm/Dqy4K
+""")
+        agent = self._deliver(dict(recipients=self._recipients))
+        self.assertEqual(agent.crafted, set(self._recipients))
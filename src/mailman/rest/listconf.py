@@ -29,7 +29,7 @@ from mailman.rest.helpers import (
     GetterSetter, bad_request, etag, no_content, not_found, okay)
 from mailman.rest.validator import (
     PatchValidator, ReadOnlyPATCHRequestError, UnknownPATCHRequestError,
-    Validator, enum_validator, list_of_strings_validator)
+    Validator, enum_validator, list_of_strings_validator, priority_validator)
 
 
 class AcceptableAliases(GetterSetter):
@@ -125,6 +125,7 @@ ATTRIBUTES = dict(
     post_id=GetterSetter(None),
     posting_address=GetterSetter(None),
     posting_pipeline=GetterSetter(pipeline_validator),
+    queue_priority=GetterSetter(priority_validator),
     display_name=GetterSetter(str),
     reply_goes_to_list=GetterSetter(enum_validator(ReplyToMunging)),
     reply_to_address=GetterSetter(str),
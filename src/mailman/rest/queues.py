@@ -22,7 +22,7 @@ from mailman.config import config
 from mailman.interfaces.listmanager import IListManager
 from mailman.rest.helpers import (
     CollectionMixin, bad_request, created, etag, no_content, not_found, okay)
-from mailman.rest.validator import Validator
+from mailman.rest.validator import Validator, priority_validator
 from zope.component import getUtility
 
 
@@ -37,6 +37,9 @@ class _QueuesBase(CollectionMixin):
             name=switchboard.name,
             directory=switchboard.queue_directory,
             count=len(files),
+            # JSON object keys are always strings.
+            depths={str(priority): count for priority, count
+                    in switchboard.get_depths().items()},
             files=files,
             self_link=self.api.path_to('queues/{}'.format(name)),
             )
@@ -64,7 +67,9 @@ class AQueue(_QueuesBase):
         """Inject a message into the queue."""
         try:
             validator = Validator(list_id=str,
-                                  text=str)
+                                  text=str,
+                                  priority=priority_validator,
+                                  _optional=('priority',))
             values = validator(request)
         except ValueError as error:
             bad_request(response, str(error))
@@ -74,9 +79,12 @@ class AQueue(_QueuesBase):
         if mlist is None:
             bad_request(response, 'No such list: {}'.format(list_id))
             return
+        # Unless the request gives a priority, the message gets the priority
+        # of the mailing list's postings.
+        values.pop('list_id')
         try:
             filebase = inject_text(
-                mlist, values['text'], switchboard=self._name)
+                mlist, values.pop('text'), switchboard=self._name, **values)
         except Exception as error:
             bad_request(response, str(error))
             return
@@ -66,6 +66,7 @@ RESOURCE = dict(
     goodbye_message_uri='mailman:///goodbye.txt',
     include_rfc2369_headers=False,
     posting_pipeline='virgin',
+    queue_priority=7,
     reply_goes_to_list='point_to_list',
     reply_to_address='bee@example.com',
     send_welcome_message=False,
@@ -253,6 +254,17 @@ class TestConfiguration(unittest.TestCase):
         self.assertEqual(cm.exception.reason,
                          b'Cannot convert parameters: posting_pipeline')
 
+    def test_bad_queue_priority(self):
+        with self.assertRaises(HTTPError) as cm:
+            call_api(
+                'http://localhost:9001/3.0/lists/ant.example.com/config'
+                '/queue_priority',
+                dict(queue_priority=10),
+                'PATCH')
+        self.assertEqual(cm.exception.code, 400)
+        self.assertEqual(cm.exception.reason,
+                         b'Cannot convert parameters: queue_priority')
+
     def test_get_digest_send_periodic(self):
         with transaction():
             self._mlist.digest_send_periodic = False
@@ -89,6 +89,33 @@ class TestQueues(unittest.TestCase):
         del msg['x-message-id-hash']
         self.assertMultiLineEqual(msg.as_string(), TEXT)
 
+    def test_inject_priority(self):
+        # Injected messages get the priority of the list's postings, unless
+        # the request gives one.
+        with transaction():
+            self._mlist.queue_priority = 7
+        call_api('http://localhost:9001/3.0/queues/bad', {
+            'list_id': 'test.example.com',
+            'text': TEXT})
+        call_api('http://localhost:9001/3.0/queues/bad', {
+            'list_id': 'test.example.com',
+            'text': TEXT,
+            'priority': 2})
+        content, response = call_api('http://localhost:9001/3.0/queues/bad')
+        self.assertEqual(content['depths'], {'2': 1, '7': 1})
+        # The higher priority message comes first.
+        items = get_queue_messages('bad')
+        self.assertEqual([item.msgdata['priority'] for item in items], [7, 2])
+
+    def test_inject_bad_priority(self):
+        # The priority must be in range.
+        with self.assertRaises(HTTPError) as cm:
+            call_api('http://localhost:9001/3.0/queues/bad', {
+                'list_id': 'test.example.com',
+                'text': TEXT,
+                'priority': 10})
+        self.assertEqual(cm.exception.code, 400)
+
     def test_delete_file(self):
         # Inject a file, then delete it.
         content, response = call_api('http://localhost:9001/3.0/queues/bad', {
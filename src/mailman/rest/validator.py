@@ -17,6 +17,7 @@
 
 """REST web form validation."""
 
+from mailman.core.switchboard import MAX_PRIORITY, MIN_PRIORITY
 from mailman.interfaces.address import IEmailValidator
 from mailman.interfaces.errors import MailmanError
 from mailman.interfaces.languages import ILanguageManager
@@ -95,6 +96,15 @@ def list_of_strings_validator(values):
     return values
 
 
+@public
+def priority_validator(value):
+    """Convert a queue priority to an integer, but only if it's in range."""
+    priority = int(value)
+    if not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+        raise ValueError('Invalid queue priority: {}'.format(value))
+    return priority
+
+
 @public
 class Validator:
     """A validator of parameter input."""
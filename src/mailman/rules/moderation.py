@@ -19,9 +19,9 @@
 
 import re
 
+from mailman.app.senders import resolve_senders
 from mailman.core.i18n import _
 from mailman.interfaces.action import Action
-from mailman.interfaces.bans import IBanManager
 from mailman.interfaces.member import MemberRole
 from mailman.interfaces.rules import IRule
 from mailman.interfaces.usermanager import IUserManager
@@ -29,29 +29,6 @@ from zope.component import getUtility
 from zope.interface import implementer
 
 
-def _find_sender_member(mlist, msg):
-    # For every sender email in the message, try to find a member associated
-    # with that email.
-    #
-    # First, check the sender email directly.  If it's a member, we're done.
-    #
-    # Next, check to see if the sender email is linked to an existing user,
-    # and if so, check to see if any of the addresses linked to that user is a
-    # member.
-    user_manager = getUtility(IUserManager)
-    for sender in msg.senders:
-        member = mlist.members.get_member(sender)
-        if member is not None:
-            return member
-        user = user_manager.get_user(sender)
-        if user is not None:
-            for address in user.addresses:
-                member = mlist.members.get_member(address.email)
-                if member is not None:
-                    return member
-    return None
-
-
 @public
 @implementer(IRule)
 class MemberModeration:
@@ -63,13 +40,16 @@ class MemberModeration:
 
     def check(self, mlist, msg, msgdata):
         """See `IRule`."""
+        senders = resolve_senders(mlist, msg, msgdata)
         # The MemberModeration rule misses unconditionally if any of the
         # senders are banned.
-        ban_manager = IBanManager(mlist)
-        for sender in msg.senders:
-            if ban_manager.is_banned(sender):
+        for sender in senders.senders:
+            if senders.is_banned(sender):
                 return False
-        member = _find_sender_member(mlist, msg)
+        # For every sender email in the message, try to find a member
+        # associated with that email, either directly or through the
+        # addresses of a linked user.
+        member = senders.sender_member
         if member is None:
             return False
         action = (mlist.default_member_action
@@ -108,32 +88,32 @@ class NonmemberModeration:
 
     def check(self, mlist, msg, msgdata):
         """See `IRule`."""
-        ban_manager = IBanManager(mlist)
+        senders = resolve_senders(mlist, msg, msgdata)
         user_manager = getUtility(IUserManager)
         # The NonmemberModeration rule misses unconditionally if any of the
         # senders are banned.
-        for sender in msg.senders:
-            if ban_manager.is_banned(sender):
+        for sender in senders.senders:
+            if senders.is_banned(sender):
                 return False
         # Every sender email must be a member or nonmember directly.  If it is
         # neither, make the email a nonmembers.
-        for sender in msg.senders:
-            if (mlist.members.get_member(sender) is None
-                    and mlist.nonmembers.get_member(sender) is None):   # noqa
+        for sender in senders.senders:
+            if (senders.get_member(sender) is None
+                    and senders.get_member(
+                        sender, MemberRole.nonmember) is None):   # noqa
                 # The email must already be registered, since this happens in
                 # the incoming runner itself.
                 address = user_manager.get_address(sender)
                 assert address is not None, (
                     'Posting address is not registered: {}'.format(sender))
-                mlist.subscribe(address, MemberRole.nonmember)
+                senders.subscribe(address, MemberRole.nonmember)
         # Check to see if any of the sender emails is already a member.  If
         # so, then this rule misses.
-        member = _find_sender_member(mlist, msg)
-        if member is not None:
+        if senders.sender_member is not None:
             return False
         # Do nonmember moderation check.
-        for sender in msg.senders:
-            nonmember = mlist.nonmembers.get_member(sender)
+        for sender in senders.senders:
+            nonmember = senders.get_member(sender, MemberRole.nonmember)
             assert nonmember is not None, (
                 "sender didn't get subscribed as a nonmember".format(sender))
             # Check the '*_these_nonmembers' properties first.  XXX These are
@@ -31,7 +31,8 @@ from mailman.core.i18n import _
 from mailman.core.runner import Runner
 from mailman.email.message import Message, MultipartDigestMessage
 from mailman.handlers.decorate import decorate
-from mailman.interfaces.member import DeliveryMode, DeliveryStatus
+from mailman.interfaces.mailinglist import IListRecipients
+from mailman.interfaces.member import DeliveryMode
 from mailman.utilities.i18n import make
 from mailman.utilities.mailbox import Mailbox
 from mailman.utilities.string import oneline, wrap
@@ -344,29 +345,15 @@ class DigestRunner(Runner):
             # Finish up the digests.
             mime = mime_digest.finish()
             rfc1153 = rfc1153_digest.finish()
-        # Calculate the recipients lists
-        mime_recipients = set()
-        rfc1153_recipients = set()
+        # Calculate the recipients lists.  Send the digest to the
+        # case-preserved address of the digest members.
+        mime_recipients, rfc1153_recipients = (
+            IListRecipients(mlist).digest_recipients)
+        mime_recipients = set(mime_recipients)
+        rfc1153_recipients = set(rfc1153_recipients)
         # When someone turns off digest delivery, they will get one last
         # digest to ensure that there will be no gaps in the messages they
         # receive.
-        digest_members = set(mlist.digest_members.members)
-        for member in digest_members:
-            if member.delivery_status is not DeliveryStatus.enabled:
-                continue
-            # Send the digest to the case-preserved address of the digest
-            # members.
-            email_address = member.address.original_email
-            if member.delivery_mode == DeliveryMode.plaintext_digests:
-                rfc1153_recipients.add(email_address)
-            # We currently treat summary_digests the same as mime_digests.
-            elif member.delivery_mode in (DeliveryMode.mime_digests,
-                                          DeliveryMode.summary_digests):
-                mime_recipients.add(email_address)
-            else:
-                raise AssertionError(
-                    'Digest member "{}" unexpected delivery mode: {}'.format(
-                        email_address, member.delivery_mode))
         # Add also the folks who are receiving one last digest.
         for address, delivery_mode in mlist.last_digest_recipients:
             if delivery_mode == DeliveryMode.plaintext_digests:
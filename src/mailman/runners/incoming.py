@@ -43,6 +43,10 @@ class IncomingRunner(Runner):
         """See `IRunner`."""
         if msgdata.get('envsender') is None:
             msgdata['envsender'] = mlist.no_reply_address
+        # The LMTP runner doesn't look up the mailing list, so postings get
+        # the queue priority of their mailing list here.
+        if 'priority' not in msgdata and not msgdata.get('to_owner', False):
+            msgdata['priority'] = mlist.queue_priority
         # Ensure that the email addresses of the message's senders are known
         # to Mailman.  This will be used in nonmember posting dispositions.
         user_manager = getUtility(IUserManager)
@@ -34,29 +34,25 @@ so that the peer mail server can provide better diagnostics.
     http://www.faqs.org/rfcs/rfc2033.html
 """
 
-import sys
-import email
+import socket
+import asyncio
 import logging
-import asyncore
+import tempfile
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from email.utils import parseaddr
+from functools import partial
+from lazr.config import as_timedelta
 from mailman.config import config
 from mailman.core.runner import Runner
 from mailman.database.transaction import transactional
-from mailman.email.message import Message
+from mailman.email.message import LazyMessage
 from mailman.interfaces.listmanager import IListManager
 from mailman.utilities.datetime import now
 from mailman.utilities.email import add_message_hash
 from zope.component import getUtility
 
-# Python 3.4's smtpd module can't handle non-UTF-8 byte input.  Unfortunately
-# we do get such emails in the wild.  Python 3.5's version of the module does
-# handle it correctly.  We vendor a version to use in the Python 3.4 case.
-if sys.version_info < (3, 5):
-    from mailman.compat import smtpd
-else:
-    import smtpd
-
 
 elog = logging.getLogger('mailman.error')
 qlog = logging.getLogger('mailman.runner')
@@ -92,13 +88,19 @@ SUBADDRESS_QUEUES = dict(
 DASH = '-'
 CRLF = '\r\n'
 ERR_451 = '451 Requested action aborted: error in processing'
+ERR_452 = '452 Requested action not taken: insufficient system storage'
 ERR_501 = '501 Message has defects'
-ERR_502 = '502 Error: command HELO not implemented'
+ERR_502 = '502 Error: command {} not implemented'
 ERR_550 = '550 Requested action not taken: mailbox unavailable'
 ERR_550_MID = '550 No Message-ID header provided'
+ERR_552 = '552 Error: Too much mail data'
 
-# XXX Blech
-smtpd.__version__ = 'GNU Mailman LMTP runner 1.1'
+VERSION = 'GNU Mailman LMTP runner 2.0'
+# The longest command line we accept, including the RFC 1870 SIZE parameter.
+COMMAND_SIZE_LIMIT = 512 + 26
+# Messages are received into spool files, which are kept in memory as long
+# as they are no bigger than this.
+SPOOL_MEMORY_SIZE = 65536
 
 
 def split_recipient(address):
@@ -128,67 +130,415 @@ def split_recipient(address):
     return listname, subaddress, domain
 
 
-class Channel(smtpd.SMTPChannel):
-    """An LMTP channel."""
+class Backpressure:
+    """Refuse messages while the queues are backlogged.
+
+    The entries of the queues which have a high water mark are counted every
+    now and then.  While any of them has more entries than its high water
+    mark, and until it has shrunk to its low water mark again, the server
+    answers recipients with a temporary failure.  The MTA keeps the messages
+    and tries again later.
+    """
+
+    def __init__(self):
+        # The high and low water marks, keyed by queue name.
+        self.water_marks = {}
+        for conf in config.runner_configs:
+            name = conf.name.split('.')[-1]
+            high = int(conf.high_water_mark)
+            if high > 0 and name in config.switchboards:
+                low = min(int(conf.low_water_mark), high)
+                self.water_marks[name] = (high, low)
+        self.exempt_subaddresses = frozenset(
+            config.mta.lmtp_exempt_subaddresses.split())
+        self.exempt_lists = frozenset(config.mta.lmtp_exempt_lists.split())
+        # The names of the queues which are over their high water mark.
+        self.backlogged = frozenset()
+
+    def update(self):
+        """Count the entries of the queues, and see which are backlogged."""
+        backlogged = set(self.backlogged)
+        for name, (high, low) in sorted(self.water_marks.items()):
+            depth = config.switchboards[name].count()
+            if depth > high and name not in backlogged:
+                qlog.warning('LMTP refusing messages, queue %s has %s entries',
+                             name, depth)
+                backlogged.add(name)
+            elif depth <= low and name in backlogged:
+                qlog.info('LMTP accepting messages, queue %s has %s entries',
+                          name, depth)
+                backlogged.remove(name)
+        # Replace the set in one go, since the server's thread reads it.
+        self.backlogged = frozenset(backlogged)
+
+    def refuses(self, address):
+        """Whether a message to the recipient is refused for the time being.
+
+        :param address: The recipient's address.
+        :type address: str
+        :return: True if the queues are backlogged and the recipient is not
+            exempt from that.
+        :rtype: bool
+        """
+        if not self.backlogged:
+            return False
+        address = parseaddr(address)[1].lower()
+        if '@' not in address:
+            # This is rejected for good later on.
+            return False
+        local, subaddress, domain = split_recipient(address)
+        if SUBADDRESS_NAMES.get(subaddress) in self.exempt_subaddresses:
+            return False
+        return '{}.{}'.format(local, domain) not in self.exempt_lists
+
+
+class Channel(asyncio.Protocol):
+    """An LMTP channel.
+
+    Commands are handled in the order they arrive, so clients can pipeline
+    them.  While a message is being processed, the commands following it
+    wait in the input buffer.  The message itself is written to a spool file
+    as it arrives.
+    """
 
-    def __init__(self, server, conn, addr):
-        super().__init__(server, conn, addr, decode_data=False)
-        # Stash this here since the subclass uses private attributes. :(
+    def __init__(self, server):
         self._server = server
+        self._transport = None
+        self._peer = None
+        self._buffer = bytearray()
+        # True while the server processes a message for us.
+        self._busy = False
+        # True when the start of the next line in the buffer was discarded.
+        self._continued = False
+        self._greeting = None
+        self._data = None
+        self._reset()
+
+    def _reset(self):
+        """Forget the current mail transaction."""
+        self._mailfrom = None
+        self._rcpttos = []
+        # The spool file of the message while we're reading it, or False
+        # while we're throwing away a message which is too big.
+        if self._data:
+            self._data.close()
+        self._data = None
+        self._data_size = 0
+
+    def _push(self, response):
+        if self._transport is not None:
+            self._transport.write(
+                response.encode('utf-8', 'surrogateescape') + b'\r\n')
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._peer = transport.get_extra_info('peername')
+        self._server.counters['connections'] += 1
+        self._server.counters['open_connections'] += 1
+        slog.debug('LMTP accept from %s', self._peer)
+        self._push('220 {} {}'.format(self._server.fqdn, VERSION))
+
+    def connection_lost(self, exc):
+        self._transport = None
+        self._server.counters['open_connections'] -= 1
+        if not self._busy:
+            self._reset()
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        self._process()
+
+    def _process(self):
+        """Handle the complete lines in the input buffer."""
+        buffer = self._buffer
+        position = 0
+        while not self._busy and self._transport is not None:
+            end = buffer.find(b'\n', position)
+            if end < 0:
+                break
+            line = bytes(buffer[position:end])
+            position = end + 1
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            continued = self._continued
+            self._continued = False
+            if self._data is not None:
+                self._data_line(line, continued)
+            elif not continued:
+                self._command(line)
+        del buffer[:position]
+        # Don't let a line without an end take up all our memory.
+        if self._busy or len(buffer) <= COMMAND_SIZE_LIMIT:
+            return
+        if self._data is None:
+            if not self._continued:
+                self._push('500 Error: line too long')
+        else:
+            self._data_line(bytes(buffer), self._continued)
+        buffer.clear()
+        self._continued = True
+
+    def _command(self, line):
+        if len(line) > COMMAND_SIZE_LIMIT:
+            self._push('500 Error: line too long')
+            return
+        line = line.decode('utf-8', 'surrogateescape')
+        command, space, arg = line.strip().partition(' ')
+        method = getattr(self, 'smtp_' + command.upper(), None)
+        if not command or method is None:
+            self._push('500 Error: command "{}" not recognized'.format(
+                command))
+            return
+        method(arg.strip())
+
+    def _data_line(self, line, continued):
+        if continued:
+            # The rest of a line we got part of already.
+            separator = b''
+        else:
+            if line.startswith(b'.'):
+                if line == b'.':
+                    self._end_data()
+                    return
+                line = line[1:]
+            # Count the line ends, which are only written between lines.
+            separator = (b'\n' if self._data_size > 0 else b'')
+            self._data_size += 1
+        if self._data is False:
+            return
+        self._data_size += len(line)
+        limit = self._server.max_message_size
+        if limit > 0 and self._data_size > limit:
+            # Reject the message for every recipient right away, and throw
+            # away the rest of it as it comes in.
+            self._push(CRLF.join(ERR_552 for to in self._rcpttos))
+            self._data.close()
+            self._data = False
+            return
+        self._data.write(separator)
+        self._data.write(line)
+
+    def _end_data(self):
+        if self._data is False:
+            # The replies were sent already.
+            self._reset()
+            return
+        spool = self._data
+        spool.seek(0)
+        self._server.counters['transactions'] += 1
+        # Process the message in the server's worker threads, and pick up
+        # the following commands when it's done.
+        self._busy = True
+        future = self._server.loop.run_in_executor(
+            self._server.executor, self._server.process_message,
+            self._peer, self._mailfrom, self._rcpttos, spool)
+        future.add_done_callback(partial(
+            self._processed, len(self._rcpttos)))
+
+    def _processed(self, count, future):
+        try:
+            status = future.result()
+        except Exception:
+            elog.exception('LMTP message processing')
+            status = CRLF.join(ERR_451 for i in range(count))
+        self._push(status)
+        self._reset()
+        self._busy = False
+        self._process()
 
     def smtp_LHLO(self, arg):
         """The LMTP greeting, used instead of HELO/EHLO."""
-        super().smtp_HELO(arg)
+        if not arg:
+            self._push('501 Syntax: LHLO hostname')
+            return
+        self._greeting = arg
+        self._reset()
+        self._server.counters['sessions'] += 1
+        limit = self._server.max_message_size
+        self._push(CRLF.join((
+            '250-{}'.format(self._server.fqdn),
+            '250-PIPELINING',
+            '250-8BITMIME',
+            '250 SIZE {}'.format(limit) if limit > 0 else '250 SIZE',
+            )))
 
     def smtp_HELO(self, arg):
         """HELO is not a valid LMTP command."""
-        self.push(ERR_502)
-
-    # def push(self, arg):
-    #     import pdb; pdb.set_trace()
-    #     return super().push(arg)
+        self._push(ERR_502.format('HELO'))
+
+    def smtp_EHLO(self, arg):
+        """EHLO is not a valid LMTP command."""
+        self._push(ERR_502.format('EHLO'))
+
+    def _address(self, keyword, arg):
+        """Split a MAIL or RCPT argument into the address and parameters."""
+        if arg[:len(keyword)].upper() != keyword:
+            return None, None
+        arg = arg[len(keyword):].strip()
+        if arg.startswith('<'):
+            address, bracket, params = arg[1:].partition('>')
+            if not bracket:
+                return None, None
+        else:
+            address, space, params = arg.partition(' ')
+        return address, params.split()
+
+    def smtp_MAIL(self, arg):
+        if self._greeting is None:
+            self._push('503 Error: send LHLO first')
+            return
+        if self._mailfrom is not None:
+            self._push('503 Error: nested MAIL command')
+            return
+        address, params = self._address('FROM:', arg)
+        if address is None:
+            self._push('501 Syntax: MAIL FROM:<address>')
+            return
+        limit = self._server.max_message_size
+        for param in params:
+            keyword, equals, value = param.partition('=')
+            if keyword.upper() == 'SIZE':
+                if not value.isdigit():
+                    self._push('501 Syntax: SIZE=<number>')
+                    return
+                if limit > 0 and int(value) > limit:
+                    self._push('552 Error: message size exceeds fixed '
+                               'maximum message size')
+                    return
+        self._mailfrom = address
+        self._push('250 OK')
+
+    def smtp_RCPT(self, arg):
+        if self._mailfrom is None:
+            self._push('503 Error: need MAIL command')
+            return
+        address, params = self._address('TO:', arg)
+        if not address:
+            self._push('501 Syntax: RCPT TO:<address>')
+            return
+        if self._server.backpressure.refuses(address):
+            self._server.counters['refused_recipients'] += 1
+            self._push(ERR_452)
+            return
+        self._rcpttos.append(address)
+        self._push('250 OK')
+
+    def smtp_DATA(self, arg):
+        if not self._rcpttos:
+            self._push('503 Error: need RCPT command')
+            return
+        if arg:
+            self._push('501 Syntax: DATA')
+            return
+        self._data = tempfile.SpooledTemporaryFile(SPOOL_MEMORY_SIZE)
+        self._push('354 End data with <CR><LF>.<CR><LF>')
+
+    def smtp_RSET(self, arg):
+        self._reset()
+        self._push('250 OK')
+
+    def smtp_NOOP(self, arg):
+        self._push('250 OK')
+
+    def smtp_VRFY(self, arg):
+        self._push('252 Cannot VRFY user, but will accept message '
+                   'and attempt delivery')
+
+    def smtp_QUIT(self, arg):
+        self._push('221 Bye')
+        self._transport.close()
+        self._transport = None
 
 
 @public
-class LMTPRunner(Runner, smtpd.SMTPServer):
-    # Only __init__ is called on startup. Asyncore is responsible for later
-    # connections from the MTA.  slice and numslices are ignored and are
-    # necessary only to satisfy the API.
+class LMTPRunner(Runner):
+    # Only __init__ is called on startup.  The event loop is responsible for
+    # later connections from the MTA.  slice and numslices are ignored and
+    # are necessary only to satisfy the API.
 
     is_queue_runner = False
 
     def __init__(self, name, slice=None):
-        localaddr = config.mta.lmtp_host, int(config.mta.lmtp_port)
-        # Do not call Runner's constructor because there's no QDIR to create
-        qlog.debug('LMTP server listening on %s:%s',
-                   localaddr[0], localaddr[1])
-        smtpd.SMTPServer.__init__(self, localaddr, remoteaddr=None)
         super().__init__(name, slice)
-
-    def handle_accept(self):
-        conn, addr = self.accept()
-        Channel(self, conn, addr)
-        slog.debug('LMTP accept from %s', addr)
+        self.fqdn = socket.getfqdn()
+        self.max_message_size = int(config.mta.lmtp_max_message_size)
+        # The messages are parsed, checked against the mailing lists and
+        # enqueued in a bounded number of worker threads, so that one
+        # session's database queries and fsyncs don't hold up the others.
+        self.executor = ThreadPoolExecutor(int(config.mta.lmtp_workers))
+        # The number of connections accepted, currently open, LMTP sessions
+        # started and mail transactions received.
+        self.counters = Counter()
+        self.backpressure = Backpressure()
+        self._check_interval = as_timedelta(
+            config.mta.lmtp_queue_check_interval).total_seconds()
+        self.loop = asyncio.new_event_loop()
+        if self.backpressure.water_marks:
+            self.loop.call_soon(self._check_queues)
+        self._log_interval = as_timedelta(
+            config.mta.lmtp_log_interval).total_seconds()
+        if self._log_interval > 0:
+            self.loop.call_later(self._log_interval, self._log_counters)
+        self._server = self.loop.run_until_complete(self.loop.create_server(
+            partial(Channel, self),
+            config.mta.lmtp_host, int(config.mta.lmtp_port)))
+        qlog.debug('LMTP server listening on %s:%s',
+                   config.mta.lmtp_host, config.mta.lmtp_port)
+
+    def _log_counters(self, reschedule=True):
+        qlog.info('LMTP server counters: %s', ', '.join(
+            '{}={}'.format(key, value)
+            for key, value in sorted(self.counters.items())))
+        if reschedule:
+            self.loop.call_later(self._log_interval, self._log_counters)
+
+    def _check_queues(self):
+        # Count the queue entries in another thread, so that big queue
+        # directories don't hold up the sessions.
+        future = self.loop.run_in_executor(None, self.backpressure.update)
+        future.add_done_callback(self._queues_checked)
+
+    def _queues_checked(self, future):
+        if future.exception() is not None:
+            elog.error('LMTP queue check failed: %s', future.exception())
+        self.loop.call_later(self._check_interval, self._check_queues)
+
+    def process_message(self, peer, mailfrom, rcpttos, spool, **kwargs):
+        """Check a received message, and enqueue it for its recipients.
+
+        This runs in the worker threads, each message with a database session
+        of its own.
+
+        :param spool: The binary file the message was received into.
+        :return: The replies for the recipients.
+        :rtype: str
+        """
+        with config.db.thread_session():
+            return self._process_message(peer, mailfrom, rcpttos, spool)
 
     @transactional
-    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+    def _process_message(self, peer, mailfrom, rcpttos, spool):
         try:
-            # Refresh the list of list names every time we process a message
-            # since the set of mailing lists could have changed.
-            listnames = set(getUtility(IListManager).names)
-            # Parse the message data.  If there are any defects in the
-            # message, reject it right away; it's probably spam.
-            msg = email.message_from_bytes(data, Message)
+            # The list manager only reloads its cached list names when the
+            # set of mailing lists has changed.
+            listnames = getUtility(IListManager).names
+            data = spool.read()
+            # Only the headers of the message are parsed, so that its body
+            # goes into the queue entries as the bytes we got.  If there are
+            # any defects in the headers, reject it right away; it's probably
+            # spam.
+            msg = LazyMessage(data)
+            message_id = msg.get('message-id')
+            defects = msg.defects
         except Exception:
             elog.exception('LMTP message parsing')
             config.db.abort()
             return CRLF.join(ERR_451 for to in rcpttos)
         # Do basic post-processing of the message, checking it for defects or
         # other missing information.
-        message_id = msg.get('message-id')
         if message_id is None:
             return ERR_550_MID
-        if msg.defects:
+        if defects:
             return ERR_501
         msg.original_size = len(data)
         add_message_hash(msg)
@@ -262,10 +612,16 @@ class LMTPRunner(Runner, smtpd.SMTPServer):
 
     def run(self):
         """See `IRunner`."""
-        asyncore.loop(use_poll=True)
+        try:
+            self.loop.run_forever()
+        finally:
+            self._server.close()
+            self.loop.run_until_complete(self._server.wait_closed())
+            self.executor.shutdown()
+            self.loop.close()
+            self._log_counters(reschedule=False)
 
     def stop(self):
         """See `IRunner`."""
-        asyncore.socket_map.clear()
-        asyncore.close_all()
-        self.close()
+        # This is called from a signal handler, so wake up the event loop.
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -29,6 +29,7 @@ from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.mta import SomeRecipientsFailed
 from mailman.interfaces.pending import IPendings
 from mailman.interfaces.subscriptions import ISubscriptionService
+from mailman.mta.connection import make_pool, pooled_connections
 from mailman.utilities.datetime import now
 from mailman.utilities.modules import find_name
 from uuid import UUID
@@ -38,6 +39,10 @@ from zope.component import getUtility
 # This controls how often _do_periodic() will try to deal with deferred
 # permanent failures.  It is a count of calls to _do_periodic()
 DEAL_WITH_PERMFAILURES_EVERY = 10
+# Retries of deliveries with temporary failures back off exponentially.  Stop
+# doubling the delay before it overflows; by then it reaches the end of any
+# sensible retry period anyway.
+MAX_BACKOFF_DOUBLINGS = 20
 
 log = logging.getLogger('mailman.error')
 smtp_log = logging.getLogger('mailman.smtp')
@@ -57,6 +62,9 @@ class OutgoingRunner(Runner):
         # set if there was a socket.error.
         self._logged = False
         self._retryq = config.switchboards['retry']
+        # The connections to the SMTP server are kept open from one message
+        # to the next.
+        self._pool = make_pool()
 
     def _dispose(self, mlist, msg, msgdata):
         # See if we should retry delivery of this message again.
@@ -89,7 +97,8 @@ class OutgoingRunner(Runner):
         try:
             debug_log.debug('[outgoing] {}: {}'.format(
                 self._func, msg.get('message-id', 'n/a')))
-            self._func(mlist, msg, msgdata)
+            with pooled_connections(self._pool):
+                self._func(mlist, msg, msgdata)
             self._logged = False
         except socket.error:
             # There was a problem connecting to the SMTP server.  Log this
@@ -146,19 +155,37 @@ class OutgoingRunner(Runner):
                         # We didn't make any progress.  If we've exceeded the
                         # configured retry period, log this failure and
                         # discard the message.
-                        if current_time > deliver_until:
+                        if current_time >= deliver_until:
                             smtp_log.error('Discarding message with '
                                            'persistent temporary failures: '
                                            '{}'.format(msg['message-id']))
                             return False
+                        retries = msgdata.get('retries', 0) + 1
                     else:
                         # We made some progress, so keep trying to delivery
                         # this message for a while longer.
                         deliver_until = current_time + as_timedelta(
                             config.mta.delivery_retry_period)
+                        retries = 0
+                    # Back off exponentially while we're not making any
+                    # progress, but make one last try at the end of the
+                    # retry period.  The entry stays out of sight in the
+                    # retry queue until then.
+                    interval = as_timedelta(config.mta.delivery_retry_interval)
+                    remaining = deliver_until - current_time
+                    delay = (remaining if retries >= MAX_BACKOFF_DOUBLINGS
+                             else min(interval * 2 ** retries, remaining))
                     msgdata['last_recip_count'] = len(recipients)
                     msgdata['deliver_until'] = deliver_until
-                    msgdata['recipients'] = recipients
+                    msgdata['deliver_after'] = current_time + delay
+                    msgdata['retries'] = retries
+                    msgdata['recipients'] = error.temporary_subset(
+                        msgdata.get('recipients'))
                     self._retryq.enqueue(msg, msgdata)
         # We've successfully completed handling of this message.
         return False
+
+    def _clean_up(self):
+        """See `IRunner`."""
+        if self._pool is not None:
+            self._pool.quit()
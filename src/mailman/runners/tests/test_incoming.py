@@ -77,3 +77,22 @@ To: test@example.com
         self._in.run()
         items = get_queue_messages('out', expected_count=1)
         self.assertEqual(items[0].msgdata.get('marker'), 'owner')
+
+    def test_posting_priority(self):
+        # Postings get the queue priority of their mailing list.
+        self._mlist.queue_priority = 8
+        msgdata = dict(listid='test.example.com')
+        config.switchboards['in'].enqueue(self._msg, msgdata)
+        self._in.run()
+        items = get_queue_messages('out', expected_count=1)
+        self.assertEqual(items[0].msgdata['priority'], 8)
+
+    def test_owner_priority(self):
+        # Messages to the owners keep the default priority.
+        self._mlist.queue_priority = 8
+        msgdata = dict(listid='test.example.com',
+                       to_owner=True)
+        config.switchboards['in'].enqueue(self._msg, msgdata)
+        self._in.run()
+        items = get_queue_messages('out', expected_count=1)
+        self.assertNotIn('priority', items[0].msgdata)
@@ -18,15 +18,22 @@
 """Tests for the LMTP server."""
 
 import os
+import socket
 import smtplib
 import unittest
 
+from collections import Counter
+from concurrent.futures import Future
 from datetime import datetime
 from mailman.app.lifecycle import create_list
 from mailman.config import config
+from mailman.core.switchboard import MIN_SHARED_MESSAGE
 from mailman.database.transaction import transaction
-from mailman.testing.helpers import get_lmtp_client, get_queue_messages
-from mailman.testing.layers import LMTPLayer
+from mailman.runners.lmtp import Backpressure, Channel, LMTPRunner
+from mailman.testing.helpers import (
+    LogFileMark, get_lmtp_client, get_queue_messages,
+    specialized_message_from_string as mfs)
+from mailman.testing.layers import ConfigLayer, LMTPLayer
 
 
 class TestLMTP(unittest.TestCase):
@@ -57,6 +64,33 @@ Subject: This has no Message-ID header
         self.assertEqual(cm.exception.smtp_error,
                          b'No Message-ID header provided')
 
+    def test_header_defects(self):
+        # Messages with broken headers are rejected.
+        with self.assertRaises(smtplib.SMTPDataError) as cm:
+            self._lmtp.sendmail('anne@example.com', ['test@example.com'], """\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+This is not a header
+
+""")
+        self.assertEqual(cm.exception.smtp_code, 501)
+        self.assertEqual(cm.exception.smtp_error, b'Message has defects')
+
+    def test_body_not_parsed(self):
+        # The body is not parsed on the way into the queue.
+        self._lmtp.sendmail('anne@example.com', ['test@example.com'], """\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+This multipart message has no parts.
+""")
+        items = get_queue_messages('in', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<ant>')
+
     def test_message_id_hash_is_added(self):
         self._lmtp.sendmail('anne@example.com', ['test@example.com'], """\
 From: anne@example.com
@@ -97,6 +131,46 @@ Message-ID: <ant>
         self.assertEqual(items[0].msgdata['received_time'],
                          datetime(2005, 8, 1, 7, 49, 23))
 
+    def test_queue_priority(self):
+        # The mailing list isn't looked up for its queue priority.  The
+        # incoming runner sets it.
+        with transaction():
+            self._mlist.queue_priority = 8
+        self._lmtp.sendmail('anne@example.com', ['test@example.com'], """\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        items = get_queue_messages('in', expected_count=1)
+        self.assertNotIn('priority', items[0].msgdata)
+
+    def test_cross_post_stored_once(self):
+        # A big message posted to several mailing lists is only written to
+        # the incoming queue once.
+        with transaction():
+            create_list('other@example.com')
+        self._lmtp.sendmail(
+            'anne@example.com', ['test@example.com', 'other@example.com'],
+            """\
+From: anne@example.com
+To: test@example.com, other@example.com
+Message-ID: <ant>
+
+""" + 'x' * MIN_SHARED_MESSAGE + '\n')
+        queue_directory = config.switchboards['in'].queue_directory
+        message_files = [
+            os.path.join(queue_directory, filename)
+            for filename in os.listdir(queue_directory)
+            if filename.endswith('.msg')]
+        self.assertEqual(len(message_files), 2)
+        self.assertTrue(os.path.samefile(*message_files))
+        items = get_queue_messages('in', expected_count=2)
+        self.assertEqual(
+            sorted(item.msgdata['listid'] for item in items),
+            ['other.example.com', 'test.example.com'])
+        self.assertEqual(os.listdir(queue_directory), [])
+
     def test_queue_directory(self):
         # The LMTP runner is not queue runner, so it should not have a
         # directory in var/queue.
@@ -166,6 +240,112 @@ Subject: This will be recognized as a join command.
         get_queue_messages('command', expected_count=1)
 
 
+class TestProtocol(unittest.TestCase):
+    """Test the LMTP protocol handling."""
+
+    layer = LMTPLayer
+
+    def setUp(self):
+        with transaction():
+            create_list('test@example.com')
+        self._lmtp = get_lmtp_client(quiet=True)
+        self.addCleanup(self._lmtp.close)
+
+    def _converse(self, data):
+        # Send everything at once and read the responses until the server
+        # hangs up.
+        sock = socket.create_connection(
+            (config.mta.lmtp_host, int(config.mta.lmtp_port)))
+        self.addCleanup(sock.close)
+        sock.sendall(data)
+        responses = b''
+        while True:
+            received = sock.recv(4096)
+            if not received:
+                break
+            responses += received
+        return [line[:3] for line in responses.decode().splitlines()]
+
+    def test_lhlo_extensions(self):
+        code, response = self._lmtp.lhlo('remote.example.org')
+        self.assertEqual(code, 250)
+        lines = response.splitlines()
+        self.assertIn(b'PIPELINING', lines)
+        self.assertIn(b'SIZE 33554432', lines)
+
+    def test_helo_and_ehlo(self):
+        self.assertEqual(self._lmtp.helo('remote.example.org'), (
+            502, b'Error: command HELO not implemented'))
+        self.assertEqual(self._lmtp.ehlo('remote.example.org')[0], 502)
+
+    def test_lhlo_first(self):
+        self.assertEqual(self._lmtp.mail('anne@example.com')[0], 503)
+
+    def test_size_too_big(self):
+        # Messages announced to be too big are rejected right away.
+        self._lmtp.lhlo('remote.example.org')
+        code, response = self._lmtp.docmd(
+            'MAIL FROM:<anne@example.com> SIZE=33554433')
+        self.assertEqual(code, 552)
+        code, response = self._lmtp.docmd(
+            'MAIL FROM:<anne@example.com> SIZE=1000')
+        self.assertEqual(code, 250)
+
+    def test_pipelining(self):
+        # Several transactions can be sent without waiting for the replies,
+        # which come back in order.
+        message = b"""\
+From: anne@example.com\r
+To: test@example.com\r
+Message-ID: <{}>\r
+\r
+..A dot-stuffed line.\r
+.\r
+"""
+        responses = self._converse(
+            b'LHLO remote.example.org\r\n' +
+            b'MAIL FROM:<anne@example.com>\r\n' +
+            b'RCPT TO:<test@example.com>\r\n' +
+            b'RCPT TO:<nobody@example.com>\r\n' +
+            b'DATA\r\n' + message.replace(b'{}', b'ant') +
+            b'MAIL FROM:<bart@example.com>\r\n' +
+            b'RCPT TO:<test@example.com>\r\n' +
+            b'DATA\r\n' + message.replace(b'{}', b'bee') +
+            b'QUIT\r\n')
+        self.assertEqual(responses, [
+            '220',
+            '250', '250', '250', '250',
+            '250', '250', '250', '354', '250', '550',
+            '250', '250', '354', '250',
+            '221',
+            ])
+        items = get_queue_messages('in', expected_count=2)
+        self.assertEqual(
+            sorted(item.msg['message-id'] for item in items),
+            ['<ant>', '<bee>'])
+        self.assertEqual(items[0].msg.get_payload(), '.A dot-stuffed line.')
+
+    def test_concurrent_sessions(self):
+        # A session which is in the middle of a transaction doesn't hold up
+        # the others.
+        self._lmtp.lhlo('remote.example.org')
+        self._lmtp.mail('anne@example.com')
+        self._lmtp.rcpt('test@example.com')
+        other = get_lmtp_client(quiet=True)
+        self.addCleanup(other.close)
+        other.lhlo('remote.example.org')
+        other.sendmail('bart@example.com', ['test@example.com'], """\
+From: bart@example.com
+To: test@example.com
+Message-ID: <bee>
+
+""")
+        get_queue_messages('in', expected_count=1)
+
+    def test_unknown_command(self):
+        self.assertEqual(self._lmtp.docmd('FROB')[0], 500)
+
+
 class TestBugs(unittest.TestCase):
     """Test some LMTP related bugs."""
 
@@ -204,3 +384,177 @@ Message-ID: <alpha>
 """)
         items = get_queue_messages('in', expected_count=1)
         self.assertEqual(items[0].msg['message-id'], '<alpha>')
+
+
+class FakeTransport:
+    def __init__(self):
+        self.written = []
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 12345)
+
+    def write(self, data):
+        self.written.extend(data.decode().splitlines())
+
+    def close(self):
+        pass
+
+
+class FakeServer:
+    fqdn = 'lmtp.example.com'
+    max_message_size = 100
+    executor = None
+    _log_interval = 3600
+    _log_counters = LMTPRunner._log_counters
+
+    def __init__(self):
+        self.counters = Counter()
+        self.backpressure = Backpressure()
+        self.loop = self
+        self.messages = []
+        self.scheduled = []
+        self._pending = []
+
+    def call_later(self, delay, function, *args):
+        self.scheduled.append((delay, function))
+
+    def run_in_executor(self, executor, function, *args):
+        future = Future()
+        self._pending.append((future, function, args))
+        return future
+
+    def run_pending(self):
+        while self._pending:
+            future, function, args = self._pending.pop(0)
+            future.set_result(function(*args))
+
+    def process_message(self, peer, mailfrom, rcpttos, spool):
+        self.messages.append(spool.read())
+        return '\r\n'.join('250 Ok' for to in rcpttos)
+
+
+class TestChannel(unittest.TestCase):
+    """Test how the LMTP server receives messages."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._server = FakeServer()
+        self._transport = FakeTransport()
+        self._channel = Channel(self._server)
+        self._channel.connection_made(self._transport)
+        self._channel.data_received(
+            b'LHLO remote.example.org\r\n'
+            b'MAIL FROM:<anne@example.com>\r\n'
+            b'RCPT TO:<test@example.com>\r\n'
+            b'RCPT TO:<test-owner@example.com>\r\n'
+            b'DATA\r\n')
+        del self._transport.written[:]
+
+    def test_spool(self):
+        # The message is written to the spool as it comes in, with dots
+        # unstuffed and lines split across reads put back together.
+        self._channel.data_received(b'Message-ID: <ant>\r\n\r\nA lo')
+        self._channel.data_received(b'ng line\r\n..\r\n')
+        self.assertEqual(self._server.messages, [])
+        self._channel.data_received(b'.\r\n')
+        self._server.run_pending()
+        self.assertEqual(self._server.messages, [
+            b'Message-ID: <ant>\n\nA long line\n.'])
+        self.assertEqual(self._transport.written, ['250 Ok', '250 Ok'])
+
+    def test_too_big(self):
+        # Messages which grow too big are rejected for all recipients
+        # before they end.
+        self._channel.data_received(b'Message-ID: <ant>\r\n\r\n')
+        self._channel.data_received(b'x' * 100 + b'\r\n')
+        self.assertEqual([line[:3] for line in self._transport.written],
+                         ['552', '552'])
+        # The rest of the message is thrown away.
+        self._channel.data_received(b'More\r\n.\r\nNOOP\r\n')
+        self.assertEqual(self._server.messages, [])
+        self.assertEqual([line[:3] for line in self._transport.written],
+                         ['552', '552', '250'])
+
+    def test_backlogged(self):
+        # Recipients are refused while the queues are backlogged.
+        self._server.backpressure.backlogged = frozenset({'in'})
+        self._channel.data_received(
+            b'.\r\n'
+            b'MAIL FROM:<anne@example.com>\r\n'
+            b'RCPT TO:<test@example.com>\r\n'
+            b'RCPT TO:<test-owner@example.com>\r\n')
+        self._server.run_pending()
+        self.assertEqual([line[:3] for line in self._transport.written],
+                         ['250', '250', '250', '452', '250'])
+        self.assertEqual(self._server.counters['refused_recipients'], 1)
+
+
+class TestCounters(unittest.TestCase):
+    """Test the LMTP server's counters."""
+
+    layer = ConfigLayer
+
+    def test_logged_periodically(self):
+        server = FakeServer()
+        server.counters.update(connections=3, transactions=2)
+        mark = LogFileMark('mailman.runner')
+        server._log_counters()
+        self.assertIn('LMTP server counters: connections=3, transactions=2',
+                      mark.read())
+        # The counters are logged again later.
+        self.assertEqual(server.scheduled, [(3600, server._log_counters)])
+        server._log_counters(reschedule=False)
+        self.assertEqual(len(server.scheduled), 1)
+
+
+class TestBackpressure(unittest.TestCase):
+    """Test the LMTP server's reaction to backlogged queues."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        config.push('water marks', """
+        [runner.in]
+        high_water_mark: 2
+        low_water_mark: 1
+        [mta]
+        lmtp_exempt_lists: exempt.example.com
+        """)
+        self.addCleanup(config.pop, 'water marks')
+        self._backpressure = Backpressure()
+        self._switchboard = config.switchboards['in']
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    def test_water_marks(self):
+        self.assertEqual(self._backpressure.water_marks, {'in': (2, 1)})
+        for i in range(3):
+            self._switchboard.enqueue(self._msg)
+        self._backpressure.update()
+        self.assertEqual(self._backpressure.backlogged, {'in'})
+        self.assertTrue(self._backpressure.refuses('test@example.com'))
+        # Messages stay refused until the queue is down to the low water
+        # mark.
+        filebases = self._switchboard.files
+        self._switchboard.dequeue(filebases[0])
+        self._backpressure.update()
+        self.assertTrue(self._backpressure.refuses('test@example.com'))
+        self._switchboard.dequeue(filebases[1])
+        self._backpressure.update()
+        self.assertFalse(self._backpressure.refuses('test@example.com'))
+
+    def test_exemptions(self):
+        self._backpressure.backlogged = frozenset({'in'})
+        self.assertTrue(self._backpressure.refuses('<Test@Example.com>'))
+        self.assertTrue(
+            self._backpressure.refuses('test-request@example.com'))
+        self.assertFalse(self._backpressure.refuses('test-owner@example.com'))
+        self.assertFalse(self._backpressure.refuses('test-admin@example.com'))
+        self.assertFalse(self._backpressure.refuses('exempt@example.com'))
+        self.assertFalse(
+            self._backpressure.refuses('exempt-join@example.com'))
@@ -68,17 +68,32 @@ Message-Id: <first>
         self._msgdata = {}
 
     def test_deliver_after(self):
-        # When the metadata has a deliver_after key in the future, the runner
-        # will re-enqueue the message rather than delivering it.
+        # When the metadata has a deliver_after key in the future, the entry
+        # is deferred, so the runner doesn't get to see it.
         deliver_after = now() + timedelta(days=10)
         self._msgdata['deliver_after'] = deliver_after
         self._outq.enqueue(self._msg, self._msgdata,
                            tolist=True, listid='test.example.com')
         self._runner.run()
+        self.assertEqual(self._outq.files, [])
+        self.assertEqual(len(self._outq.get_deferred()), 1)
         items = get_queue_messages('out', expected_count=1)
         self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
         self.assertEqual(items[0].msg['message-id'], '<first>')
 
+    def test_pooled_connections(self):
+        # Consecutive messages are sent over the same SMTP connection.
+        for i in range(3):
+            self._outq.enqueue(self._msg, self._msgdata,
+                               recipients=['bart@example.com'],
+                               listid='test.example.com')
+        runner = make_testable_runner(OutgoingRunner, 'out')
+        runner.run()
+        self.assertEqual(len(list(SMTPLayer.smtpd.messages)), 3)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+        # The connections are closed when the runner stops.
+        self.assertEqual(runner._pool._idle, [])
+
 
 captured_mlist = None
 captured_msg = None
@@ -394,6 +409,42 @@ Message-Id: <first>
                          as_timedelta(config.mta.delivery_retry_period))
         self.assertEqual(items[0].msgdata['deliver_until'], deliver_until)
         self.assertEqual(items[0].msgdata['recipients'], ['cris@example.com'])
+        # The message waits in the retry queue until its first retry is due.
+        deliver_after = (datetime(2005, 8, 1, 7, 49, 23) +
+                         as_timedelta(config.mta.delivery_retry_interval))
+        self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
+        self.assertEqual(items[0].msgdata['retries'], 0)
+
+    def test_retry_backoff(self):
+        # While the retries make no progress, each one waits twice as long as
+        # the one before.
+        temporary_failures.append('cris@example.com')
+        deliver_until = (datetime(2005, 8, 1, 7, 49, 23) +
+                         as_timedelta(config.mta.delivery_retry_period))
+        msgdata = dict(last_recip_count=1,
+                       deliver_until=deliver_until,
+                       retries=2)
+        self._outq.enqueue(self._msg, msgdata, listid='test.example.com')
+        self._runner.run()
+        items = get_queue_messages('retry', expected_count=1)
+        self.assertEqual(items[0].msgdata['retries'], 3)
+        deliver_after = (datetime(2005, 8, 1, 7, 49, 23) +
+                         8 * as_timedelta(config.mta.delivery_retry_interval))
+        self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
+        # The retry is deferred.
+        self.assertEqual(config.switchboards['retry'].files, [])
+
+    def test_retry_backoff_at_end_of_retry_period(self):
+        # The last retry happens when the retry period is up.
+        temporary_failures.append('cris@example.com')
+        deliver_until = datetime(2005, 8, 1, 8, 0, 0)
+        msgdata = dict(last_recip_count=1,
+                       deliver_until=deliver_until,
+                       retries=5)
+        self._outq.enqueue(self._msg, msgdata, listid='test.example.com')
+        self._runner.run()
+        items = get_queue_messages('retry', expected_count=1)
+        self.assertEqual(items[0].msgdata['deliver_after'], deliver_until)
 
     def test_two_temporary_failures(self):
         # The first time there are temporary failures, the message just gets
@@ -19,6 +19,7 @@
 
 import unittest
 
+from datetime import timedelta
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.runners.retry import RetryRunner
@@ -26,6 +27,7 @@ from mailman.testing.helpers import (
     get_queue_messages, make_testable_runner,
     specialized_message_from_string as message_from_string)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.datetime import now
 
 
 class TestRetryRunner(unittest.TestCase):
@@ -50,3 +52,13 @@ Message-Id: <first>
         self._retryq.enqueue(self._msg, self._msgdata)
         self._runner.run()
         get_queue_messages('out', expected_count=1)
+
+    def test_message_not_due(self):
+        # Messages stay in the retry queue until their retry is due.
+        deliver_after = now() + timedelta(minutes=15)
+        self._retryq.enqueue(self._msg, self._msgdata,
+                             deliver_after=deliver_after)
+        self._runner.run()
+        get_queue_messages('out', expected_count=0)
+        items = get_queue_messages('retry', expected_count=1)
+        self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
@@ -171,6 +171,9 @@ class Bounces:
         # The default pipeline to send accepted messages through to the
         # mailing list's members.
         mlist.posting_pipeline = 'default-posting-pipeline'
+        # The queue priority of the postings to this mailing list.  None
+        # follows the [priorities]default setting.
+        mlist.queue_priority = None
         # The processing chain that messages posted to this mailing list's
         # -owner address gets processed by.
         mlist.owner_chain = 'default-owner-chain'
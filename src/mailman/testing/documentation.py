@@ -23,6 +23,7 @@ distributions.  doctest discovery currently requires file system traversal.
 
 from inspect import isfunction, ismethod
 from mailman.app.lifecycle import create_list
+from mailman.app.senders import SENDERS_KEY
 from mailman.config import config
 from mailman.testing.helpers import call_api, specialized_message_from_string
 from mailman.testing.layers import SMTPLayer
@@ -42,13 +43,14 @@ def stop():
 
 def dump_msgdata(msgdata, *additional_skips):
     """Dump in a more readable way a message metadata dictionary."""
-    if len(msgdata) == 0:
-        print('*Empty*')
-        return
     skips = set(additional_skips)
     # Some stuff we always want to skip, because their values will always be
     # variable data.
     skips.add('received_time')
+    skips.add(SENDERS_KEY)
+    if len(set(msgdata) - skips) == 0:
+        print('*Empty*')
+        return
     longest = max(len(key) for key in msgdata if key not in skips)
     for key in sorted(msgdata):
         if key in skips:
@@ -45,6 +45,7 @@ from mailman.interfaces.styles import IStyleManager
 from mailman.interfaces.usermanager import IUserManager
 from mailman.runners.digest import DigestRunner
 from mailman.utilities.mailbox import Mailbox
+from sqlalchemy.event import listen, remove
 from unittest import mock
 from urllib.error import HTTPError
 from urllib.parse import urlencode
@@ -103,6 +104,8 @@ class _Bag:
 def get_queue_messages(queue_name, sort_on=None, expected_count=None):
     """Return and clear all the messages in the given queue.
 
+    Deferred messages which are not due yet are returned last.
+
     :param queue_name: A string naming a queue.
     :param sort_on: The message header to sort on.  If None (the default),
         no sorting is performed.
@@ -113,7 +116,7 @@ def get_queue_messages(queue_name, sort_on=None, expected_count=None):
     """
     queue = config.switchboards[queue_name]
     messages = []
-    for filebase in queue.files:
+    for filebase in queue.files + queue.get_deferred():
         msg, msgdata = queue.dequeue(filebase)
         messages.append(_Bag(msg=msg, msgdata=msgdata))
         queue.finish(filebase)
@@ -397,6 +400,26 @@ def temporary_db(db):
         config.db = real_db
 
 
+@public
+@contextmanager
+def counted_statements():
+    """Record the SQL statements executed on the database within the block.
+
+    :return: A context manager providing the list of statements, which grows
+        as they are executed.
+    :rtype: list of str
+    """
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    listen(config.db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        remove(config.db.engine, 'before_cursor_execute', record)
+
+
 @public
 class chdir:
     """A context manager for temporary directory changing."""
@@ -445,7 +468,7 @@ def reset_the_world():
     """Reset everything:
 
     * Clear out the database
-    * Remove all residual queue and digest files
+    * Remove all residual queue, digest and recipients files
     * Clear the message store
     * Reset the global style manager
 
@@ -454,11 +477,12 @@ def reset_the_world():
     """
     # Reset the database between tests.
     config.db._reset()
-    # Remove any digest files and members.txt file (for the file-recips
-    # handler) in the lists' data directories.
+    # Remove any digest files, members.txt file (for the file-recips
+    # handler) and cached recipients files in the lists' data directories.
     for dirpath, dirnames, filenames in os.walk(config.LIST_DATA_DIR):
         for filename in filenames:
-            if filename.endswith('.mmdf') or filename == 'members.txt':
+            if (filename.endswith('.mmdf') or filename == 'members.txt' or
+                    filename.startswith('recipients-')):
                 os.remove(os.path.join(dirpath, filename))
     # Remove all residual queue files.
     for dirpath, dirnames, filenames in os.walk(config.QUEUE_DIR):
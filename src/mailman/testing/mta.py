@@ -60,7 +60,13 @@ class StatisticsChannel(Channel):
             self.push('503 Duplicate HELO/EHLO')
         else:
             self._SMTPChannel__greeting = arg
+            # This lets smtpd accept parameters to MAIL and RCPT.
+            self.extended_smtp = True
             self.push('250-%s' % self._SMTPChannel__fqdn)
+            for extension in self._server.extensions:
+                self.push('250-%s' % extension)
+            # smtpd only accepts the SMTPUTF8 parameter when it's enabled.
+            self.enable_SMTPUTF8 = ('SMTPUTF8' in self._server.extensions)
             self.push('250 AUTH PLAIN')
 
     def smtp_STAT(self, arg):
@@ -149,6 +155,8 @@ class ConnectionCountingServer(QueueServer):
         self._oob_queue = oob_queue
         self._err_queue = err_queue
         self._last_error = None
+        # The ESMTP extensions announced besides AUTH, e.g. 8BITMIME.
+        self.extensions = []
 
     def next_error(self, command):
         """Return the next error for the SMTP command, if there is one.
@@ -182,8 +190,11 @@ class ConnectionCountingServer(QueueServer):
         log.info('[ConnectionCountingServer] accepted: %s', address)
         StatisticsChannel(self, connection, address)
 
-    def process_message(self, peer, mailfrom, rcpttos, data):
-        # Provide a guaranteed order to recpttos.
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        # Provide a guaranteed order to recpttos.  Newer versions of smtpd
+        # also pass the ESMTP MAIL and RCPT options, and the data as bytes.
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'surrogateescape')
         QueueServer.process_message(
             self, peer, mailfrom, sorted(rcpttos), data)
 
@@ -191,6 +202,7 @@ class ConnectionCountingServer(QueueServer):
         """See `lazr.smtp.server.Server`."""
         QueueServer.reset(self)
         self._connection_count = 0
+        self.extensions = []
 
     def send_statistics(self):
         """Send the current connection statistics to the controller."""